@@ -1,10 +1,25 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from llama_model import LlamaAnalyzer
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from blob_store import COPY_BLOCK_BYTES, BlobStore, UploadError, is_digest
 from diff_detector import compare_documents
-from rag_engine import RagEngine
+from index_registry import IndexRegistry
+from inference_sidecar import INFERENCE_SOCKET, RemoteIndexRegistry
+from jobs import JobManager, QueueFullError
+from manifest import scan_folder
+from metrics import REGISTRY, collect_timings, gauge, histogram, span
+from model_loader import LazyModel, warm_up_in_order
+from utils import inference_config
+import anyio
+import asyncio
+import io
+import json
 import os
 import logging
+import time
+from typing import IO, Callable, Dict, List, Optional
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,59 +36,250 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global instances
-rag_engine = None
-llama_analyzer = None
+# The remote backend serves the models and the corpus indexes from the inference sidecar
+INFERENCE_CONFIG = inference_config()
+REMOTE_INFERENCE = INFERENCE_CONFIG.get("backend") == "remote"
+SIDECAR_SOCKET = INFERENCE_CONFIG.get("socket") or INFERENCE_SOCKET
+
+def load_rag_engine():
+    # Imported here so faiss / sentence-transformers load off the startup path
+    from rag_engine import RagEngine
+    if REMOTE_INFERENCE:
+        # Embed in the inference sidecar too, so no worker holds a copy of the model
+        from inference_sidecar import RemoteEmbedder
+        embedder = RemoteEmbedder(SIDECAR_SOCKET)
+        return RagEngine(model_name=embedder.model_name, embedder=embedder)
+    return RagEngine()
+
+def load_llama_analyzer():
+    from llama_model import LlamaAnalyzer
+    return LlamaAnalyzer()
+
+# Global instances, loaded lazily
+rag_engine = LazyModel("rag_engine", load_rag_engine)
+llama_analyzer = LazyModel("llama_analyzer", load_llama_analyzer)
+# Warm models up in the background at startup instead of on first request
+PRELOAD_MODELS = os.environ.get("CIA_PRELOAD_MODELS", "1") == "1"
+job_manager = JobManager()
+# Uploaded files by content digest, laid out as snapshot folders
+blob_store = BlobStore()
+# One index per corpus, each behind its own read-write lock; all share the rag_engine model.
+# With the remote backend the indexes live in the inference sidecar, shared by all workers.
+if REMOTE_INFERENCE:
+    index_registry = RemoteIndexRegistry(SIDECAR_SOCKET)
+else:
+    index_registry = IndexRegistry(lambda: rag_engine.get())
+
+REQUEST_SECONDS = histogram("cia_http_request_duration_seconds", "HTTP request latency",
+                            ("method", "route", "status"))
+JOBS_ACTIVE = gauge("cia_jobs_active", "Analysis jobs running or queued")
+MODEL_READY = gauge("cia_model_ready", "1 once the model has loaded", ("model",))
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # The route template keeps /jobs/{job_id} to one series instead of one per job
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method, route=route,
+                            status=str(response.status_code))
+    return response
 
 @app.on_event("startup")
 async def startup_event():
-    global rag_engine, llama_analyzer
-    logger.info("Initializing RAG engine and LLaMA analyzer...")
-    rag_engine = RagEngine()
-    llama_analyzer = LlamaAnalyzer()
-    logger.info("Initialization complete!")
+    if PRELOAD_MODELS:
+        logger.info("Warming up RAG engine and LLaMA analyzer in the background...")
+        warm_up_in_order([rag_engine, llama_analyzer])
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    job_manager.shutdown()
 
 @app.get("/")
 async def root():
+    """Liveness: the process is up, whether or not models have loaded"""
     return {"message": "Change Impact Analysis API is running"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 once both models are loaded, 503 until then"""
+    status = {"rag_engine": rag_engine.status(), "llama_analyzer": llama_analyzer.status()}
+    if not (rag_engine.ready and llama_analyzer.ready):
+        raise HTTPException(status_code=503, detail=status)
+    return status
+
+def run_analysis(old_folder: str, new_folder: str, progress: Optional[Callable[[str, float], None]] = None,
+                 emit: Optional[Callable[[str, object], None]] = None) -> Dict:
+    """Blocking analysis pipeline; runs on the job pool, never on the event loop.
+
+    With emit, intermediate results and generated text are pushed out as they are ready.
+    The result carries per-stage timings; endpoints return them only when asked.
+    """
+    with collect_timings() as timings, span("analysis"):
+        result = _run_analysis(old_folder, new_folder, progress or (lambda stage, fraction: None), emit)
+    result["timings"] = timings.to_dict()
+    return result
+
+def _run_analysis(old_folder: str, new_folder: str, progress: Callable[[str, float], None],
+                  emit: Optional[Callable[[str, object], None]]) -> Dict:
+    logger.info(f"Analyzing changes between {old_folder} and {new_folder}")
+    
+    # Step 1: Compare documents
+    progress("diffing", 0.05)
+    with span("diffing"):
+        # One walk of the old tree feeds both the differ and the indexer
+        old_manifest = scan_folder(old_folder)
+        differences = compare_documents(old_folder, new_folder, old_manifest=old_manifest)
+    if emit:
+        emit("differences", differences)
+    
+    if not differences:
+        return {"differences": [], "impact": "No changes detected between document versions."}
+    
+    with span("model_wait"):
+        rag_engine.get()
+        analyzer = llama_analyzer.get()
+    # Step 2: Get the RAG index of the old version for context, built or loaded as needed
+    progress("indexing", 0.3)
+    with index_registry.acquire(old_folder, manifest=old_manifest) as engine:
+        # Step 3: Find related contexts for all changes in one batched search,
+        # then merge duplicate and overlapping hits and diversify them
+        progress("retrieval", 0.6)
+        candidates = engine.related_contexts([diff["description"] for diff in differences])
+    
+    # Keep the best passages that fit the prompt's context budget
+    with span("context_packing"):
+        related_contexts = analyzer.select_contexts(candidates)
+    if emit:
+        emit("contexts", related_contexts)
+    
+    # Step 4: Use LLaMA for impact analysis
+    progress("generation", 0.7)
+    with span("generation"):
+        if emit:
+            pieces = []
+            for text in analyzer.stream_impact(differences, related_contexts):
+                pieces.append(text)
+                emit("token", text)
+            impact_analysis = "".join(pieces)
+        else:
+            impact_analysis = analyzer.analyze_impact(differences, related_contexts)
+    
+    return {
+        "differences": differences,
+        "impact_analysis": impact_analysis,
+        "related_contexts_count": len(related_contexts)
+    }
+
+def analysis_response(result: Dict, timings: bool) -> Dict:
+    """The analysis result, with its per-stage timings only if the caller asked for them"""
+    if timings:
+        return result
+    return {key: value for key, value in result.items() if key != "timings"}
+
+def submit_analysis(old_folder: str, new_folder: str):
+    # Validate folders exist
+    if not os.path.exists(old_folder) or not os.path.exists(new_folder):
+        raise HTTPException(status_code=400, detail="One or both folders don't exist")
+    try:
+        return job_manager.submit("analyze", run_analysis, old_folder, new_folder)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=f"Analysis queue is full, retry later ({str(e)})")
+
+@app.post("/diff/")
+async def diff_documents(old_folder: str, new_folder: str):
+    """File-level differences only; needs no models, so it is served during warm-up"""
+    if not os.path.exists(old_folder) or not os.path.exists(new_folder):
+        raise HTTPException(status_code=400, detail="One or both folders don't exist")
+    try:
+        differences = await run_in_threadpool(compare_documents, old_folder, new_folder)
+        return {"differences": differences}
+    except Exception as e:
+        logger.error(f"Error during diff: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Diff failed: {str(e)}")
+
 @app.post("/analyze/")
-async def analyze_changes(old_folder: str, new_folder: str):
+async def analyze_changes(old_folder: str, new_folder: str, timings: bool = False):
+    """Run an analysis and wait for it; the work happens on the job pool"""
+    job = submit_analysis(old_folder, new_folder)
     try:
-        # Validate folders exist
-        if not os.path.exists(old_folder) or not os.path.exists(new_folder):
-            raise HTTPException(status_code=400, detail="One or both folders don't exist")
-        
-        logger.info(f"Analyzing changes between {old_folder} and {new_folder}")
-        
-        # Step 1: Compare documents
-        differences = compare_documents(old_folder, new_folder)
-        
-        if not differences:
-            return {"differences": [], "impact": "No changes detected between document versions."}
-        
-        # Step 2: Build RAG index from old version for context
-        rag_engine.build_index(old_folder)
-        
-        # Step 3: Find related contexts for each change
-        related_contexts = []
-        for diff in differences:
-            contexts = rag_engine.search_related(diff["description"], top_k=2)
-            related_contexts.extend(contexts)
-        
-        # Step 4: Use LLaMA for impact analysis
-        impact_analysis = llama_analyzer.analyze_impact(differences, related_contexts)
-        
-        return {
-            "differences": differences,
-            "impact_analysis": impact_analysis,
-            "related_contexts_count": len(related_contexts)
-        }
-        
+        return analysis_response(await asyncio.wrap_future(job.future), timings)
     except Exception as e:
         logger.error(f"Error during analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
+def stream_analysis(old_folder: str, new_folder: str, emit: Callable[[str, object], None],
+                    timings: bool = False, progress: Optional[Callable[[str, float], None]] = None):
+    """run_analysis that always finishes the event stream with done or error.
+
+    Errors are raised again after the error event, so the job is marked failed.
+    """
+    try:
+        result = run_analysis(old_folder, new_folder, progress=progress, emit=emit)
+    except Exception as e:
+        emit("error", {"detail": f"Analysis failed: {str(e)}"})
+        raise
+    done = {"related_contexts_count": result.get("related_contexts_count", 0)}
+    if timings:
+        done["timings"] = result["timings"]
+    emit("done", done)
+    return result
+
+@app.post("/analyze/stream")
+async def analyze_changes_stream(old_folder: str, new_folder: str, timings: bool = False):
+    """Server-Sent Events: differences, then retrieved contexts, then generated tokens"""
+    if not os.path.exists(old_folder) or not os.path.exists(new_folder):
+        raise HTTPException(status_code=400, detail="One or both folders don't exist")
+    
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    
+    def emit(event: str, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+    
+    try:
+        job_manager.submit("analyze_stream", stream_analysis, old_folder, new_folder, emit, timings)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=f"Analysis queue is full, retry later ({str(e)})")
+    
+    async def event_stream():
+        while True:
+            event, data = await events.get()
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            if event in ("done", "error"):
+                break
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/jobs/analyze", status_code=202)
+async def submit_analysis_job(old_folder: str, new_folder: str):
+    """Queue an analysis and return its job ID immediately"""
+    job = submit_analysis(old_folder, new_folder)
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, timings: bool = False):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {job.error}")
+    if not job.done:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return analysis_response(job.result, timings)
+
+def build_corpus_index(folder_path: str) -> Dict:
+    with index_registry.acquire(folder_path) as engine:
+        return engine.summary()
+
 @app.post("/build-index/")
 async def build_knowledge_base(folder_path: str):
     """Build RAG index from a knowledge base folder"""
@@ -81,12 +287,158 @@ async def build_knowledge_base(folder_path: str):
         if not os.path.exists(folder_path):
             raise HTTPException(status_code=400, detail="Folder doesn't exist")
         
-        rag_engine.build_index(folder_path)
-        return {"message": f"Knowledge base built from {folder_path}"}
+        summary = await run_in_threadpool(build_corpus_index, folder_path)
+        return {"message": f"Knowledge base built from {folder_path}", **summary}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to build index: {str(e)}")
 
+class IndexUpdateRequest(BaseModel):
+    folder_path: str
+    changed_paths: List[str]
+
+@app.post("/index/update")
+async def update_knowledge_base(request: IndexUpdateRequest):
+    """Re-index only the changed files of the knowledge base folder"""
+    try:
+        if not os.path.exists(request.folder_path):
+            raise HTTPException(status_code=400, detail="Folder doesn't exist")
+        
+        summary = await run_in_threadpool(
+            index_registry.update, request.folder_path, request.changed_paths
+        )
+        return {"message": f"Knowledge base updated from {request.folder_path}", **summary}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update index: {str(e)}")
+
+class BlobQuery(BaseModel):
+    digests: List[str]
+
+@app.post("/blobs/missing")
+async def missing_blobs(query: BlobQuery):
+    """Which of these content digests the backend has no copy of, so clients send each file once"""
+    return {"missing": await run_in_threadpool(blob_store.missing, query.digests)}
+
+class RequestBodyReader(io.RawIOBase):
+    """A request body as a blocking file, read on a threadpool thread as the chunks arrive"""
+
+    def __init__(self, request: Request):
+        self._chunks = request.stream()
+        self._pending = b""
+        self._finished = False
+
+    async def _next_chunk(self) -> Optional[bytes]:
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending and not self._finished:
+            chunk = anyio.from_thread.run(self._next_chunk)
+            self._finished = chunk is None
+            self._pending = chunk or b""
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+def store_snapshot(archive: Optional[IO[bytes]], filename: str, known_files: Dict[str, str]) -> Dict:
+    unpacked = list(blob_store.unpack(archive, filename)) if archive is not None else []
+    files = dict(known_files)
+    files.update((path, digest) for path, digest, _, _ in unpacked)
+    snapshot_id, folder = blob_store.snapshot(files)
+    logger.info(f"Snapshot {snapshot_id}: {len(files)} files, {len(unpacked)} uploaded")
+    return {
+        "snapshot": snapshot_id,
+        "folder": folder,
+        "files": len(files),
+        "uploaded_files": len(unpacked),
+        "stored_bytes": sum(size for _, _, size, stored in unpacked if stored),
+        "deduplicated_files": sum(1 for _, _, _, stored in unpacked if not stored),
+    }
+
+@app.post("/snapshots")
+async def upload_snapshot(request: Request, files: str = "{}"):
+    """Store one version of a document folder on the backend and return the folder holding it.
+
+    The archive is a tar (optionally compressed) or zip of files; files is a JSON object
+    mapping more relative paths to the content digests of files the backend already has
+    (see /blobs/missing). The returned folder can be passed to /analyze/ and the other endpoints.
+
+    A tar archive sent as the raw request body (any content type but multipart, files in the
+    query string) is unpacked as it arrives. A multipart form with archive and files fields
+    is written to a temporary file in full before unpacking starts, so large uploads should
+    use the raw body; zip archives need the form, as they are read from the end.
+    """
+    form = None
+    try:
+        archive, filename = None, ""
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            files = form.get("files", files)
+            upload = form.get("archive")
+            if upload is not None and not isinstance(upload, str):
+                archive, filename = upload.file, upload.filename or ""
+        elif request.headers.get("content-length", "0") != "0" or "transfer-encoding" in request.headers:
+            archive = io.BufferedReader(RequestBodyReader(request), COPY_BLOCK_BYTES)
+        known_files = json.loads(files)
+        if not isinstance(known_files, dict) or not all(
+                isinstance(path, str) and isinstance(digest, str) and is_digest(digest)
+                for path, digest in known_files.items()):
+            raise UploadError("files must map paths to content digests")
+        return await run_in_threadpool(store_snapshot, archive, filename, known_files)
+    except (UploadError, json.JSONDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid upload: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error storing upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+    finally:
+        if form is not None:
+            await form.close()
+
+@app.get("/cache/embeddings")
+async def embedding_cache_stats():
+    """Hit/miss counters of the embedding cache, for sizing it"""
+    if not rag_engine.ready:
+        raise HTTPException(status_code=503, detail="RAG engine is still loading")
+    return rag_engine.get().cache_stats()
+
+@app.get("/indexes")
+async def loaded_indexes():
+    """Corpus indexes in memory, their estimated size and the memory budget"""
+    return index_registry.stats()
+
+@app.get("/cache/responses")
+async def response_cache_stats():
+    """Hit/miss and de-duplication counters of the LLM response cache"""
+    if not llama_analyzer.ready:
+        raise HTTPException(status_code=503, detail="LLaMA analyzer is still loading")
+    return llama_analyzer.get().response_cache.stats()
+
+@app.get("/inference/stats")
+async def inference_stats():
+    """Generation backend, throughput (tokens/sec) and resident memory"""
+    if not llama_analyzer.ready:
+        raise HTTPException(status_code=503, detail="LLaMA analyzer is still loading")
+    return llama_analyzer.get().inference_stats()
+
+@app.get("/metrics")
+async def metrics():
+    """Counters, gauges and latency histograms in the Prometheus text format"""
+    JOBS_ACTIVE.set(job_manager.active_count())
+    MODEL_READY.set(int(rag_engine.ready), model="rag_engine")
+    MODEL_READY.set(int(llama_analyzer.ready), model="llama_analyzer")
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import zlib
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# A stage slower than this multiple of the baseline counts as a regression in --compare
+REGRESSION_THRESHOLD = 1.2
+
+
+class HashingEmbedder:
+    """Hashed bag-of-words vectors in place of a sentence-transformers model.
+
+    Lets the index and search stages run at realistic shapes without downloading a model.
+    """
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, **_) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for word in text.split():
+                vectors[row, zlib.crc32(word.encode("utf-8")) % self.dimension] += 1.0
+        return vectors
+
+
+class StageTimer:
+    """Wall time and memory of each named benchmark stage"""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, Dict] = {}
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the block; the yielded dict collects stage-specific numbers"""
+        from utils import peak_memory_bytes, resident_memory_bytes
+
+        info = {}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        logger.info(f"Stage {name}...")
+        start = time.perf_counter()
+        yield info
+        info["seconds"] = time.perf_counter() - start
+        info["rss_bytes"] = resident_memory_bytes()
+        info["peak_rss_bytes"] = peak_memory_bytes()
+        if self.trace_memory:
+            # Python-level allocations only (numpy included, faiss/torch internals not)
+            info["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        self.stages[name] = info
+        logger.info(f"Stage {name}: {info['seconds']:.3f}s")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _folder_bytes(folder: str) -> int:
+    from tree_walker import walk_tree
+    return sum(info.size for info in walk_tree(folder).values())
+
+
+def run_benchmark(workdir: str, corpus: Dict, queries: int = 100, top_k: int = 3,
+                  embedder: str = "hashing", trace_memory: bool = False) -> Dict:
+    """Generate a corpus under workdir and time every pipeline stage on it.
+
+    All caches live under workdir, so each run starts cold. embedder is "hashing" (no model)
+    or "sentence-transformers"; generation always uses the stub backend.
+    """
+    import utils
+    utils.CACHE_DIR = os.path.join(workdir, "cache")
+
+    from synthetic_corpus import generate_corpus
+    from diff_detector import compare_documents, get_detailed_diff, get_detailed_diffs, read_file
+
+    timer = StageTimer(trace_memory)
+    results = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "queries": queries,
+            "top_k": top_k,
+            "embedder": embedder,
+        },
+    }
+
+    with timer.stage("corpus_generation") as info:
+        truth = generate_corpus(os.path.join(workdir, "corpus"), **corpus)
+        old_folder, new_folder = truth["old_folder"], truth["new_folder"]
+        info["old_bytes"] = _folder_bytes(old_folder)
+        info["new_bytes"] = _folder_bytes(new_folder)
+    results["corpus"] = {
+        **truth["params"],
+        "modified": len(truth["modified"]),
+        "renamed": len(truth["renamed"]),
+        "deleted": len(truth["deleted"]),
+        "added": len(truth["added"]),
+    }
+    total_bytes = timer.stages["corpus_generation"]["old_bytes"] + timer.stages["corpus_generation"]["new_bytes"]
+
+    # Document comparison: cold caches, then the unchanged trees again
+    for name in ("compare_documents_cold", "compare_documents_warm"):
+        with timer.stage(name) as info:
+            differences = compare_documents(old_folder, new_folder)
+            info["differences"] = len(differences)
+            info["by_type"] = {kind: sum(1 for d in differences if d["type"] == kind)
+                               for kind in ("modified", "added", "deleted")}
+        info["mb_per_second"] = total_bytes / 1e6 / max(info["seconds"], 1e-9)
+
+    # Line diffs of the edited files, texts read up front so only diffing is timed
+    pairs = [(os.path.join(old_folder, name), os.path.join(new_folder, name)) for name in truth["modified"]]
+    text_pairs = [(read_file(old), read_file(new)) for old, new in pairs]
+    with timer.stage("get_detailed_diff") as info:
+        for old_text, new_text in text_pairs:
+            get_detailed_diff(old_text, new_text)
+        info["pairs"] = len(text_pairs)
+    with timer.stage("get_detailed_diffs_parallel") as info:
+        get_detailed_diffs(text_pairs)
+        info["pairs"] = len(text_pairs)
+
+    from rag_engine import RagEngine
+    from embedding_cache import EmbeddingCache
+
+    def make_engine(cache_name: str) -> RagEngine:
+        model = HashingEmbedder() if embedder == "hashing" else None
+        cache = EmbeddingCache("benchmark", cache_dir=os.path.join(workdir, cache_name))
+        return RagEngine(embedding_cache=cache, embedder=model)
+
+    with timer.stage("rag_engine_init"):
+        engine = make_engine("embeddings")
+    with timer.stage("build_index") as info:
+        engine.build_index(old_folder, use_cache=False)
+        info["chunks"] = engine.store.chunk_count
+        info["index"] = type(engine.index).__name__
+    with timer.stage("build_index_cached") as info:
+        engine.build_index(old_folder)
+        info["chunks"] = engine.store.chunk_count
+
+    query_texts = [d["description"] for d in differences]
+    query_texts = (query_texts * (queries // max(1, len(query_texts)) + 1))[:queries] if query_texts else []
+    with timer.stage("search_related") as info:
+        for query in query_texts:
+            engine.search_related(query, top_k=top_k)
+        info["queries"] = len(query_texts)
+    with timer.stage("search_related_batch") as info:
+        engine.search_related_batch(query_texts, top_k=top_k)
+        info["queries"] = len(query_texts)
+    for name in ("search_related", "search_related_batch"):
+        stage = timer.stages[name]
+        stage["ms_per_query"] = 1000 * stage["seconds"] / max(1, stage["queries"])
+
+    # End to end through the HTTP layer, with fresh caches and the stub generator
+    _benchmark_endpoint(workdir, old_folder, new_folder, timer, make_engine)
+    results["stages"] = timer.stages
+    return results
+
+
+def _benchmark_endpoint(workdir: str, old_folder: str, new_folder: str, timer: StageTimer, make_engine):
+    import utils
+    utils.CACHE_DIR = os.path.join(workdir, "cache_endpoint")
+
+    from fastapi.testclient import TestClient
+    import app
+    from llama_model import LlamaAnalyzer
+    from model_loader import LazyModel
+
+    app.rag_engine = LazyModel("rag_engine", lambda: make_engine("embeddings_endpoint"))
+    app.llama_analyzer = LazyModel("llama_analyzer", lambda: LlamaAnalyzer(config={"backend": "stub"}))
+    client = TestClient(app.app)
+
+    with timer.stage("models_load"):
+        app.rag_engine.get()
+        app.llama_analyzer.get()
+
+    params = {"old_folder": old_folder, "new_folder": new_folder}
+    for name in ("analyze_endpoint_cold", "analyze_endpoint_warm"):
+        with timer.stage(name) as info:
+            response = client.post("/analyze/", params=params)
+            info["status_code"] = response.status_code
+            if response.status_code == 200:
+                info["related_contexts"] = response.json().get("related_contexts_count", 0)
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = REGRESSION_THRESHOLD) -> List[Dict]:
+    """Per-stage time ratios of current to baseline; ratio above threshold marks a regression"""
+    rows = []
+    for name, stage in current["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before:
+            continue
+        ratio = stage["seconds"] / max(before["seconds"], 1e-9)
+        rows.append({
+            "stage": name,
+            "baseline_seconds": before["seconds"],
+            "seconds": stage["seconds"],
+            "ratio": ratio,
+            "regression": ratio > threshold,
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on a synthetic corpus")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=8192)
+    parser.add_argument("--change-rate", type=float, default=0.2)
+    parser.add_argument("--rename-rate", type=float, default=0.05)
+    parser.add_argument("--delete-rate", type=float, default=0.02)
+    parser.add_argument("--add-rate", type=float, default=0.02)
+    parser.add_argument("--encodings", default="utf-8,latin-1", help="Comma-separated, e.g. utf-8,latin-1,utf-16")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--embedder", choices=("hashing", "sentence-transformers"), default="hashing")
+    parser.add_argument("--trace-memory", action="store_true", help="Also record tracemalloc peaks (slower)")
+    parser.add_argument("--workdir", help="Where to put the corpus and caches (default: a temp dir)")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.output else logging.WARNING, stream=sys.stderr)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cia-benchmark-")
+    corpus_params = {
+        "files": args.files, "file_size": args.file_size, "change_rate": args.change_rate,
+        "rename_rate": args.rename_rate, "delete_rate": args.delete_rate, "add_rate": args.add_rate,
+        "encodings": args.encodings.split(","), "seed": args.seed,
+    }
+    results = run_benchmark(workdir, corpus_params, queries=args.queries, top_k=args.top_k,
+                            embedder=args.embedder, trace_memory=args.trace_memory)
+
+    if args.compare:
+        with open(args.compare) as f:
+            results["comparison"] = compare_results(json.load(f), results)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        for row in results["comparison"]:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['stage']:32s} {row['baseline_seconds']:9.3f}s -> {row['seconds']:9.3f}s "
+                  f"x{row['ratio']:.2f}{flag}", file=sys.stderr)
+        sys.exit(1 if any(row["regression"] for row in results["comparison"]) else 0)
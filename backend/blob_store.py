@@ -0,0 +1,226 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import tarfile
+import zipfile
+import posixpath
+import tempfile
+import time
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+from metrics import counter
+from utils import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes one uploaded archive may unpack to, against archive bombs; 0 means no limit
+MAX_UPLOAD_BYTES = int(os.environ.get("CIA_MAX_UPLOAD_BYTES", str(4 * 1024 ** 3)))
+COPY_BLOCK_BYTES = 1024 * 1024
+# Snapshot folders kept; least recently used ones beyond it are deleted, then blobs none links to
+SNAPSHOT_CACHE_ENTRIES = int(os.environ.get("CIA_SNAPSHOT_CACHE_ENTRIES", "64"))
+# Unlinked blobs stored or uploaded again this recently stay, for snapshots still being sent
+BLOB_GRACE_SECONDS = int(os.environ.get("CIA_BLOB_GRACE_SECONDS", "3600"))
+DIGEST_HEX_CHARS = 32
+
+UPLOADED_BYTES = counter("cia_uploaded_bytes_total", "Bytes of uploaded files, by whether the store already had them",
+                         ("result",))
+
+
+class UploadError(ValueError):
+    """An upload that cannot be accepted: bad archive, unsafe path, unknown digest or too large"""
+
+
+def is_digest(value: str) -> bool:
+    return len(value) == DIGEST_HEX_CHARS and all(c in "0123456789abcdef" for c in value)
+
+
+def safe_member_path(name: str) -> Optional[str]:
+    """Normalized relative POSIX path of an archive member, or None if it would escape the folder"""
+    path = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if path in ("", ".") or path == ".." or path.startswith("../") or ":" in path.split("/")[0]:
+        return None
+    return path
+
+
+class BlobStore:
+    """Uploaded file contents, stored once each under their content digest.
+
+    Digests are content_digest's BLAKE2b, so clients can tell which files the store already
+    has before sending anything. Blobs are read-only once written. A snapshot is a set of
+    (path, digest) pairs laid out as a folder of hard links to the blobs; its name is derived
+    from those pairs, so uploading the same files again yields the same folder, and the
+    manifest, diff and index caches keyed by it are reused.
+    """
+
+    def __init__(self, root: Optional[str] = None, snapshot_root: Optional[str] = None):
+        self.root = root or get_cache_dir("blobs")
+        self.snapshot_root = snapshot_root or get_cache_dir("snapshots")
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.snapshot_root, exist_ok=True)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return is_digest(digest) and os.path.exists(self.blob_path(digest))
+
+    def missing(self, digests: List[str]) -> List[str]:
+        """The digests the store has no blob for, in the given order"""
+        return [digest for digest in dict.fromkeys(digests) if not self.has(digest)]
+
+    def put(self, stream: IO[bytes], budget: Optional[List[int]] = None) -> Tuple[str, int, bool]:
+        """Store a file read from stream in blocks; returns (digest, size, newly stored).
+
+        budget is a one-element list of bytes still allowed, decremented as data is read.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    block = stream.read(COPY_BLOCK_BYTES)
+                    if not block:
+                        break
+                    size += len(block)
+                    if budget is not None:
+                        budget[0] -= len(block)
+                        if budget[0] < 0:
+                            raise UploadError(f"Upload unpacks to more than {MAX_UPLOAD_BYTES} bytes")
+                    hasher.update(block)
+                    out.write(block)
+            digest = hasher.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                UPLOADED_BYTES.inc(size, result="deduplicated")
+                try:
+                    os.utime(path)  # recency for prune
+                except OSError:
+                    pass
+                return digest, size, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+            UPLOADED_BYTES.inc(size, result="stored")
+            return digest, size, True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def unpack(self, archive: IO[bytes], filename: str = "") -> Iterator[Tuple[str, str, int, bool]]:
+        """Yield (path, digest, size, newly stored) for each regular file of a tar or zip archive.
+
+        Tar archives, compressed or not, are read as a stream, one member at a time; zip
+        needs its central directory at the end, so archive must be seekable for it.
+        Links, devices and members whose paths leave the archive root are skipped.
+        """
+        budget = [MAX_UPLOAD_BYTES or float("inf")]
+        if filename.lower().endswith(".zip") or (archive.seekable() and zipfile.is_zipfile(archive)):
+            archive.seek(0)
+            try:
+                with zipfile.ZipFile(archive) as zf:
+                    for info in zf.infolist():
+                        path = safe_member_path(info.filename)
+                        if info.is_dir() or path is None:
+                            continue
+                        with zf.open(info) as member:
+                            yield (path, *self.put(member, budget))
+            except zipfile.BadZipFile as e:
+                raise UploadError(f"Not a valid zip archive: {str(e)}") from e
+            return
+
+        if archive.seekable():
+            archive.seek(0)
+        try:
+            with tarfile.open(fileobj=archive, mode="r|*") as tf:
+                for info in tf:
+                    path = safe_member_path(info.name)
+                    if not info.isfile() or path is None:
+                        continue
+                    yield (path, *self.put(tf.extractfile(info), budget))
+        except tarfile.TarError as e:
+            raise UploadError(f"Not a valid tar or zip archive: {str(e)}") from e
+
+    def snapshot(self, files: Dict[str, str]) -> Tuple[str, str]:
+        """(snapshot ID, folder) holding each path of files as a link to its digest's blob"""
+        directories = set()
+        for path, digest in files.items():
+            if safe_member_path(path) != path:
+                raise UploadError(f"Unsafe path: {path}")
+            if not self.has(digest):
+                raise UploadError(f"Unknown content digest for {path}: {digest}")
+            parts = path.split("/")
+            directories.update("/".join(parts[:i]) for i in range(1, len(parts)))
+        conflicts = sorted(directories.intersection(files))
+        if conflicts:
+            raise UploadError(f"Path is both a file and a directory: {conflicts[0]}")
+        snapshot_id = hashlib.blake2b(json.dumps(sorted(files.items())).encode("utf-8"), digest_size=16).hexdigest()
+        folder = os.path.join(self.snapshot_root, snapshot_id)
+        if os.path.isdir(folder):
+            try:
+                os.utime(folder)  # recency for prune
+            except OSError:
+                pass
+            return snapshot_id, folder
+
+        tmp_folder = f"{folder}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(tmp_folder)
+            for path, digest in files.items():
+                target = os.path.join(tmp_folder, *path.split("/"))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                try:
+                    os.link(self.blob_path(digest), target)
+                except OSError:
+                    shutil.copyfile(self.blob_path(digest), target)  # no hard links on this filesystem
+            try:
+                os.rename(tmp_folder, folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+                # Another request laid out the same snapshot first
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        self.prune()
+        return snapshot_id, folder
+
+    def prune(self, keep: int = SNAPSHOT_CACHE_ENTRIES) -> Tuple[int, int]:
+        """Delete all but the keep most recently used snapshots, then the blobs no snapshot links to.
+
+        A blob is unlinked when its link count is back to one. Ones stored or uploaded again
+        within BLOB_GRACE_SECONDS are kept. Blobs copied into snapshots on filesystems
+        without hard links count as unlinked, since those snapshots do not need them.
+        Returns (snapshots, blobs) deleted.
+        """
+        snapshots = []
+        for entry in os.scandir(self.snapshot_root):
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                try:
+                    snapshots.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue
+        pruned = sorted(snapshots, reverse=True)[keep:]
+        if not pruned:
+            return 0, 0
+        for _, path in pruned:
+            logger.info(f"Pruning snapshot {os.path.basename(path)}")
+            shutil.rmtree(path, ignore_errors=True)
+
+        blobs = 0
+        cutoff = time.time() - BLOB_GRACE_SECONDS
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    stat = entry.stat()
+                    if stat.st_nlink == 1 and stat.st_mtime < cutoff:
+                        os.remove(entry.path)
+                        blobs += 1
+                except OSError:
+                    continue
+        logger.info(f"Pruned {len(pruned)} snapshots and {blobs} unlinked blobs")
+        return len(pruned), blobs
@@ -0,0 +1,63 @@
+import os
+import logging
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from line_diff import mapped_file
+from tree_walker import walk_tree
+from utils import decode_bytes
+
+logger = logging.getLogger(__name__)
+
+# Window and overlap in bytes; ~1000 bytes of prose stays within MiniLM's 256 tokens
+CHUNK_WINDOW = int(os.environ.get("CIA_CHUNK_WINDOW", "1000"))
+CHUNK_OVERLAP = int(os.environ.get("CIA_CHUNK_OVERLAP", "200"))
+
+
+class Chunk(NamedTuple):
+    file_name: str
+    offset: int
+    length: int
+    text: str
+
+
+def _cut_point(buf, start: int, end: int) -> int:
+    """Move a chunk end back to the last whitespace so words (and UTF-8 sequences) stay whole"""
+    if end >= len(buf):
+        return len(buf)
+    for sep in (b"\n", b" "):
+        cut = buf.rfind(sep, start + 1, end)
+        if cut > start:
+            return cut + 1
+    return end
+
+
+def iter_file_chunks(file_path: str, file_name: str, window: int = CHUNK_WINDOW,
+                     overlap: int = CHUNK_OVERLAP) -> Iterator[Chunk]:
+    """Yield overlapping chunks of a file with their byte spans, reading it through mmap"""
+    step_back = min(overlap, window // 2)
+    with mapped_file(file_path) as buf:
+        start = 0
+        while start < len(buf):
+            end = _cut_point(buf, start, start + window)
+            text = decode_bytes(buf[start:end])
+            if text.strip():
+                yield Chunk(file_name, start, end - start, text)
+            if end >= len(buf):
+                break
+            start = max(start + 1, _cut_point(buf, start, end - step_back))
+
+
+def iter_folder_chunks(folder_path: str, window: int = CHUNK_WINDOW, overlap: int = CHUNK_OVERLAP,
+                       file_names: Optional[Iterable[str]] = None) -> Iterator[Chunk]:
+    """Yield chunks for the given files of a folder (default: the whole tree), one file in memory at a time"""
+    if file_names is None:
+        file_names = [name for name, info in walk_tree(folder_path).items() if not info.too_large]
+    for file_name in sorted(file_names):
+        file_path = os.path.join(folder_path, file_name)
+        if not os.path.isfile(file_path):
+            continue
+        try:
+            yield from iter_file_chunks(file_path, file_name, window, overlap)
+        except Exception as e:
+            logger.warning(f"Could not read file {file_name}: {str(e)}")
+
@@ -0,0 +1,148 @@
+import os
+import math
+import logging
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Hits retrieved per change before de-duplication and packing
+CONTEXT_CANDIDATES = int(os.environ.get("CIA_CONTEXT_CANDIDATES", "4"))
+# Prompt tokens given to related passages
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CIA_CONTEXT_TOKEN_BUDGET", "768"))
+# Longest single passage, so merged spans cannot crowd out every other document
+MAX_PASSAGE_TOKENS = int(os.environ.get("CIA_CONTEXT_PASSAGE_TOKENS", "256"))
+# MMR trade-off between relevance (1.0) and diversity (0.0); 1.0 turns MMR off
+MMR_LAMBDA = float(os.environ.get("CIA_MMR_LAMBDA", "0.7"))
+# Relevance boost per doubling of the number of changes that retrieved a passage
+REPEAT_BONUS = 0.1
+# A passage trimmed shorter than this is not worth its place in the prompt
+MIN_PASSAGE_TOKENS = 32
+
+
+def context_line(context: Dict) -> str:
+    """How a passage appears in the prompt"""
+    return f"{context['file_name']}: {context['content']}\n"
+
+
+def aggregate_hits(results: List[List[Dict]]) -> List[Dict]:
+    """Merge the hits of all queries into one entry per chunk, most relevant first.
+
+    relevance is the best similarity any query gave the chunk, boosted when several
+    changes retrieved it.
+    """
+    by_chunk = {}
+    for query_index, hits in enumerate(results):
+        for hit in hits:
+            key = (hit["file_name"], hit["offset"])
+            entry = by_chunk.get(key)
+            if entry is None:
+                entry = by_chunk[key] = {**hit, "queries": []}
+            entry["queries"].append(query_index)
+            entry["similarity_score"] = max(entry["similarity_score"], hit["similarity_score"])
+
+    for entry in by_chunk.values():
+        entry.pop("rank", None)  # per-query ranks mean nothing once merged
+        entry["relevance"] = entry["similarity_score"] * (1 + REPEAT_BONUS * math.log2(len(entry["queries"])))
+    return sorted(by_chunk.values(), key=lambda entry: -entry["relevance"])
+
+
+def merge_overlapping(candidates: List[Dict], read_passage: Callable[[str, int, int], str]) -> List[Dict]:
+    """Join hits whose byte spans in the same file overlap or touch into one passage.
+
+    Neighbouring chunks share their overlap region, so keeping both repeats that text.
+    """
+    by_file: Dict[str, List[Dict]] = {}
+    for candidate in candidates:
+        by_file.setdefault(candidate["file_name"], []).append(candidate)
+
+    merged = []
+    for file_name, spans in by_file.items():
+        spans.sort(key=lambda span: span["offset"])
+        current = None
+        for span in spans:
+            if current is not None and span["offset"] <= current["offset"] + current["length"]:
+                end = max(current["offset"] + current["length"], span["offset"] + span["length"])
+                current["length"] = end - current["offset"]
+                current["queries"] = sorted(set(current["queries"]) | set(span["queries"]))
+                current["similarity_score"] = max(current["similarity_score"], span["similarity_score"])
+                current["relevance"] = max(current["relevance"], span["relevance"])
+                current["content"] = None
+                continue
+            current = dict(span)
+            merged.append(current)
+
+    for passage in merged:
+        if passage["content"] is None:
+            passage["content"] = read_passage(passage["file_name"], passage["offset"], passage["length"])
+    return sorted(merged, key=lambda passage: -passage["relevance"])
+
+
+def mmr_rerank(candidates: List[Dict], vectors: np.ndarray, mmr_lambda: float = MMR_LAMBDA) -> List[Dict]:
+    """Order candidates by maximal marginal relevance.
+
+    Each pick maximizes mmr_lambda * relevance - (1 - mmr_lambda) * max cosine similarity
+    to the passages already picked, so near-duplicates sink below distinct passages.
+    """
+    if len(candidates) < 2:
+        return list(candidates)
+    vectors = np.asarray(vectors, dtype='float32')
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+    relevance = np.array([candidate["relevance"] for candidate in candidates], dtype='float32')
+    relevance = relevance / max(float(relevance.max()), 1e-12)
+
+    remaining = list(range(len(candidates)))
+    redundancy = np.zeros(len(candidates), dtype='float32')
+    order = []
+    while remaining:
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy[remaining]
+        pick = remaining.pop(int(np.argmax(scores)))
+        order.append(pick)
+        redundancy = np.maximum(redundancy, similarity[pick])
+    return [candidates[i] for i in order]
+
+
+def assemble_contexts(results: List[List[Dict]], read_passage: Callable[[str, int, int], str],
+                      vectors: Optional[Callable[[List[Dict]], np.ndarray]] = None,
+                      mmr_lambda: float = MMR_LAMBDA) -> List[Dict]:
+    """Per-query search results to one ranked, de-duplicated candidate list.
+
+    vectors gives one embedding per merged passage for the MMR step, which is skipped without it.
+    """
+    candidates = merge_overlapping(aggregate_hits(results), read_passage)
+    if vectors is not None and mmr_lambda < 1.0 and len(candidates) > 1:
+        candidates = mmr_rerank(candidates, vectors(candidates), mmr_lambda)
+    logger.info(f"{sum(len(hits) for hits in results)} hits assembled into {len(candidates)} passages")
+    return candidates
+
+
+def pack_contexts(candidates: List[Dict], count_tokens: Callable[[str], int],
+                  truncate: Callable[[str, int], str], budget: int = CONTEXT_TOKEN_BUDGET,
+                  max_passage_tokens: int = MAX_PASSAGE_TOKENS) -> List[Dict]:
+    """Take passages in order while they fit the token budget.
+
+    A passage longer than max_passage_tokens, or than the room left, is trimmed when that
+    leaves at least MIN_PASSAGE_TOKENS; otherwise it is skipped in favour of shorter ones
+    further down.
+    """
+    packed = []
+    remaining = budget
+    for candidate in candidates:
+        if remaining < MIN_PASSAGE_TOKENS:
+            break
+        limit = min(remaining, max_passage_tokens)
+        cost = count_tokens(context_line(candidate))
+        if cost > limit:
+            overhead = count_tokens(context_line({**candidate, "content": ""}))
+            room = limit - overhead
+            if room < MIN_PASSAGE_TOKENS:
+                continue
+            candidate = {**candidate, "content": truncate(candidate["content"], room), "truncated": True}
+            cost = count_tokens(context_line(candidate))
+            if cost > remaining:
+                continue
+        packed.append(candidate)
+        remaining -= cost
+    return packed
@@ -1,19 +1,47 @@
 import os
+import bisect
 import difflib
-from typing import List, Dict
+import multiprocessing
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Tuple
 import logging
 
+from line_diff import STREAMING_DIFF_BYTES, diff_files
+from manifest import DiffCache, scan_folder
+from metrics import BYTES_READ, CACHE_REQUESTS, counter, span
+from sketch_index import SketchIndex
+from utils import decode_bytes
+
 logger = logging.getLogger(__name__)
 
+# Content similarity above which two files are treated as old/new versions of each other
+SIMILARITY_THRESHOLD = 0.6
+# Sketch candidates per old file that get the full SequenceMatcher ratio
+MATCH_CANDIDATES = 3
+# Old files with no sketch candidates are scored against every remaining new file
+# when that comes to at most this many pairs
+EXHAUSTIVE_MATCH_PAIRS = 4096
+# Files with fewer shingles than this can differ in every shingle and still be similar;
+# they are also scored against the new files whose size allows the threshold
+SHORT_FILE_SHINGLES = 16
+# Worker processes for pair scoring; below PARALLEL_MIN_PAIRS the serial path is faster
+DIFF_WORKERS = int(os.environ.get("CIA_DIFF_WORKERS", "0")) or (os.cpu_count() or 1)
+PARALLEL_MIN_PAIRS = 16
+MAX_CHUNK_SIZE = 32
+
+FILES_COMPARED = counter("cia_files_compared_total", "Files seen by compare_documents", ("side",))
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
 def read_file(file_path: str) -> str:
     """Read file content with error handling"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except UnicodeDecodeError:
-        # Try with different encoding
-        with open(file_path, 'r', encoding='latin-1') as f:
-            return f.read()
+        with open(file_path, 'rb') as f:
+            return decode_bytes(f.read())
     except Exception as e:
         logger.error(f"Error reading file {file_path}: {str(e)}")
         return ""
@@ -38,36 +66,217 @@ def get_detailed_diff(old_text: str, new_text: str) -> Dict:
         "diff_preview": "".join(diff_lines[:20])  # First 20 lines of diff
     }
 
-def compare_documents(old_folder: str, new_folder: str) -> List[Dict]:
-    """Compare documents between old and new versions"""
+def _modified_entry(old_file: str, new_file: str, diff_details: Dict) -> Dict:
+    return {
+        "file": f"{old_file} → {new_file}",
+        "type": "modified",
+        "description": f"{old_file} updated to {new_file}",
+        "details": diff_details
+    }
+
+def _score_pair(old_path: str, new_path: str) -> Dict:
+    """Run the full similarity check for one candidate pair"""
+    if max(os.path.getsize(old_path), os.path.getsize(new_path)) > STREAMING_DIFF_BYTES:
+        # Very large files are compared by line hashes without decoding them whole
+        details = diff_files(old_path, new_path, min_ratio=SIMILARITY_THRESHOLD)
+        if details is not None and details.pop("ratio") > SIMILARITY_THRESHOLD:
+            return {"similar": True, "details": details}
+        return {"similar": False, "details": None}
+    
+    old_content = read_file(old_path)
+    new_content = read_file(new_path)
+    matcher = difflib.SequenceMatcher(None, old_content, new_content)
+    if (matcher.real_quick_ratio() > SIMILARITY_THRESHOLD
+            and matcher.quick_ratio() > SIMILARITY_THRESHOLD
+            and matcher.ratio() > SIMILARITY_THRESHOLD):
+        return {"similar": True, "details": get_detailed_diff(old_content, new_content)}
+    return {"similar": False, "details": None}
+
+def _score_pair_args(paths: Tuple[str, str]) -> Dict:
+    return _score_pair(*paths)
+
+def _detailed_diff_args(texts: Tuple[str, str]) -> Dict:
+    return get_detailed_diff(*texts)
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Return a shared worker pool, started on first use"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn avoids forking a server process that has model threads running
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+def _parallel_map(func, items: List, workers: Optional[int]) -> List:
+    """Map func over items, in order, on the worker pool or serially for small inputs"""
+    workers = workers or DIFF_WORKERS
+    if workers <= 1 or len(items) < PARALLEL_MIN_PAIRS:
+        return [func(item) for item in items]
+    chunk_size = max(1, min(MAX_CHUNK_SIZE, len(items) // (workers * 4)))
+    return list(_get_pool(workers).map(func, items, chunksize=chunk_size))
+
+def get_detailed_diffs(text_pairs: List[Tuple[str, str]], workers: Optional[int] = None) -> List[Dict]:
+    """get_detailed_diff for many (old_text, new_text) pairs, results in input order"""
+    return _parallel_map(_detailed_diff_args, text_pairs, workers)
+
+def _size_window(size: int) -> Tuple[float, float]:
+    """Sizes a file can have and still reach SIMILARITY_THRESHOLD against one of size bytes"""
+    # ratio = 2 * matches / (a + b) is at most 2 * min(a, b) / (a + b)
+    spread = (2 - SIMILARITY_THRESHOLD) / SIMILARITY_THRESHOLD
+    return size / spread, size * spread
+
+def _candidate_pairs(unmatched_old: List[str], old_manifest: Dict[str, Dict], new_manifest: Dict[str, Dict],
+                     sketch_index: SketchIndex) -> List[Tuple[str, set]]:
+    """(old file, new files to score it against) for each old file still unmatched.
+
+    Sketch candidates share shingles with the old file, which files of a few words that
+    differ in one of them need not do. Those are caught by always scoring the new file at
+    the same path, and by scoring old files without candidates exhaustively when few
+    enough remain, or else short ones against new files of a compatible size.
+    """
+    new_pool = sorted(sketch_index.keys())
+    result = []
+    orphans = set()
+    for old_file in unmatched_old:
+        sketch = tuple(old_manifest[old_file]["sketch"])
+        new_matches = {new_file for new_file, _ in sketch_index.candidates(sketch, top_n=MATCH_CANDIDATES)}
+        if not new_matches:
+            orphans.add(old_file)
+        if old_file in sketch_index:
+            new_matches.add(old_file)
+        result.append((old_file, new_matches))
+    
+    if not orphans or not new_pool:
+        return result
+    if len(orphans) * len(new_pool) <= EXHAUSTIVE_MATCH_PAIRS:
+        for old_file, new_matches in result:
+            if old_file in orphans:
+                new_matches.update(new_pool)
+        return result
+    
+    short = sorted((new_manifest[f]["size"], f) for f in new_pool
+                   if len(new_manifest[f]["sketch"]) < SHORT_FILE_SHINGLES)
+    sizes = [size for size, _ in short]
+    for old_file, new_matches in result:
+        entry = old_manifest[old_file]
+        if old_file in orphans and len(entry["sketch"]) < SHORT_FILE_SHINGLES:
+            low, high = _size_window(entry["size"])
+            new_matches.update(f for _, f in short[bisect.bisect_left(sizes, low):bisect.bisect_right(sizes, high)])
+    return result
+
+def compare_documents(old_folder: str, new_folder: str, use_cache: bool = True,
+                      workers: Optional[int] = None, old_manifest: Optional[Dict[str, Dict]] = None,
+                      new_manifest: Optional[Dict[str, Dict]] = None) -> List[Dict]:
+    """Compare documents between old and new versions.
+
+    Both trees are walked recursively; files are named by their path relative to the
+    folder. With use_cache, folder manifests skip re-reading unchanged files and pair
+    results are reused across runs by content digest. Uncached pairs are scored
+    on up to `workers` processes (default DIFF_WORKERS; 1 forces serial).
+    A manifest already scanned by the caller is used instead of walking that folder again.
+    """
     differences = []
+    diff_cache = DiffCache() if use_cache else None
+    
+    with span("diff_manifest"):
+        if old_manifest is None:
+            old_manifest = scan_folder(old_folder, persist=use_cache)
+        if new_manifest is None:
+            new_manifest = scan_folder(new_folder, persist=use_cache)
+    old_files = set(old_manifest)
+    new_files = set(new_manifest)
+    
+    FILES_COMPARED.inc(len(old_files), side="old")
+    FILES_COMPARED.inc(len(new_files), side="new")
+    
+    # Identical content pairs up by digest without any text comparison
+    new_by_digest = defaultdict(list)
+    for new_file, entry in new_manifest.items():
+        if not entry.get("skipped"):
+            new_by_digest[entry["digest"]].append(new_file)
+    
+    # Files over the size limit were never read; one on both sides can only be reported as such
+    for file_name in sorted(old_files & new_files):
+        if old_manifest[file_name].get("skipped") or new_manifest[file_name].get("skipped"):
+            size = max(old_manifest[file_name]["size"], new_manifest[file_name]["size"])
+            differences.append({
+                "file": file_name,
+                "type": "skipped",
+                "description": f"File {file_name} was not compared: {size} bytes is over the size limit",
+                "details": {"reason": "too_large", "size": size}
+            })
+    
+    unmatched_old = []
+    matched_new = set()
+    for old_file, entry in old_manifest.items():
+        if entry.get("skipped"):
+            continue
+        same_content = [f for f in new_by_digest.get(entry["digest"], []) if f not in matched_new]
+        if not same_content:
+            unmatched_old.append(old_file)
+        elif old_file in same_content:
+            matched_new.add(old_file)  # unchanged file
+        else:
+            matched_new.add(same_content[0])
+            differences.append(_modified_entry(
+                old_file, same_content[0], {"additions": 0, "deletions": 0, "diff_preview": ""}
+            ))
+    
+    # Binary files cannot be scored; one whose content changed in place is reported as such
+    for old_file in [f for f in unmatched_old if old_manifest[f]["binary"]]:
+        unmatched_old.remove(old_file)
+        if old_file in new_files and old_file not in matched_new and not new_manifest[old_file].get("skipped"):
+            matched_new.add(old_file)
+            differences.append(_modified_entry(
+                old_file, old_file, {"additions": 0, "deletions": 0, "diff_preview": "", "binary": True}
+            ))
+    
+    # Match remaining files by content similarity, scoring only the best sketch candidates
+    sketch_index = SketchIndex()
+    for new_file, entry in new_manifest.items():
+        if new_file not in matched_new and not entry["binary"] and not entry.get("skipped"):
+            sketch_index.add(new_file, tuple(entry["sketch"]))
+    
+    pairs = []
+    for old_file, new_matches in _candidate_pairs(unmatched_old, old_manifest, new_manifest, sketch_index):
+        pairs.extend((old_file, new_file) for new_file in sorted(new_matches))
+    
+    results = [
+        diff_cache.get(old_manifest[o]["digest"], new_manifest[n]["digest"]) if diff_cache else None
+        for o, n in pairs
+    ]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if diff_cache:
+        CACHE_REQUESTS.inc(len(pairs) - len(pending), cache="diff", result="hit")
+        CACHE_REQUESTS.inc(len(pending), cache="diff", result="miss")
+    # Scoring runs in worker processes, so its reads are counted here
+    BYTES_READ.inc(sum(old_manifest[pairs[i][0]]["size"] + new_manifest[pairs[i][1]]["size"] for i in pending),
+                   component="diff")
+    with span("diff_scoring"):
+        scored = _parallel_map(
+            _score_pair_args,
+            [(old_manifest[pairs[i][0]]["path"], new_manifest[pairs[i][1]]["path"]) for i in pending],
+            workers
+        )
+    for i, result in zip(pending, scored):
+        results[i] = result
+        if diff_cache:
+            old_file, new_file = pairs[i]
+            diff_cache.put(old_manifest[old_file]["digest"], new_manifest[new_file]["digest"], result)
+    
+    if len(pending) < len(pairs):
+        logger.info(f"Reused {len(pairs) - len(pending)} cached diff results")
     
-    old_files = set(os.listdir(old_folder))
-    new_files = set(os.listdir(new_folder))
-    
-    # --- NEW: match files by content similarity ---
-    for old_file in old_files:
-        for new_file in new_files:
-            old_path = os.path.join(old_folder, old_file)
-            new_path = os.path.join(new_folder, new_file)
-
-            if os.path.isfile(old_path) and os.path.isfile(new_path):
-                old_content = read_file(old_path)
-                new_content = read_file(new_path)
-
-                similarity = difflib.SequenceMatcher(None, old_content, new_content).ratio()
-                if similarity > 0.6:  # threshold: treat as modified
-                    diff_details = get_detailed_diff(old_content, new_content)
-                    differences.append({
-                        "file": f"{old_file} → {new_file}",
-                        "type": "modified",
-                        "description": f"{old_file} updated to {new_file}",
-                        "details": diff_details
-                    })
+    for (old_file, new_file), result in zip(pairs, results):
+        if result["similar"]:
+            differences.append(_modified_entry(old_file, new_file, result["details"]))
     
     # Check for deleted files
     deleted_files = old_files - new_files
-    for file_name in deleted_files:
+    for file_name in sorted(deleted_files):
         differences.append({
             "file": file_name,
             "type": "deleted",
@@ -77,7 +286,7 @@ def compare_documents(old_folder: str, new_folder: str) -> List[Dict]:
     
     # Check for new files
     new_files_only = new_files - old_files
-    for file_name in new_files_only:
+    for file_name in sorted(new_files_only):
         differences.append({
             "file": file_name,
             "type": "added",
@@ -0,0 +1,243 @@
+import os
+import json
+import mmap
+import uuid
+import shutil
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from utils import get_cache_dir
+
+STORE_FILE = "store.json"
+# Per-document and per-chunk columns, saved as raw machine arrays next to the index
+COLUMNS = {
+    "doc_name": "i",         # index into the interned name table
+    "doc_segment": "i",      # segment file holding the document bytes
+    "doc_offset": "q",       # start of the document within its segment
+    "doc_length": "q",
+    "doc_first_chunk": "q",  # position of the document's first chunk in the chunk columns
+    "doc_chunks": "i",       # number of chunks; -1 once the document is removed
+    "chunk_offset": "q",     # start of the chunk within its document
+    "chunk_length": "i",
+}
+COPY_BLOCK_BYTES = 1024 * 1024
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_scratch_dir = None
+_scratch_lock = threading.Lock()
+
+
+def scratch_dir() -> str:
+    """This process's directory for segments not yet saved with an index.
+
+    Directories left behind by processes that are gone are removed the first time it is made.
+    """
+    global _scratch_dir
+    with _scratch_lock:
+        if _scratch_dir is None:
+            root = get_cache_dir("documents")
+            for name in os.listdir(root):
+                if name.isdigit() and int(name) != os.getpid() and not _alive(int(name)):
+                    shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            _scratch_dir = os.path.join(root, str(os.getpid()))
+            os.makedirs(_scratch_dir, exist_ok=True)
+        return _scratch_dir
+
+
+class DocumentStore:
+    """Append-only bytes of indexed documents, with their chunk spans.
+
+    Document bytes are appended to a segment file, a new one per build or update, which is
+    never modified once committed and is memory-mapped for reads, so the corpus stays in
+    the page cache rather than in process memory. Everything else lives in flat arrays
+    indexed by document ID, plus one table of interned file names. Removing a document
+    only drops it from the live set; its bytes go when no saved index refers to them.
+
+    New segments are written to the process's scratch directory and deleted on close().
+    save() hard-links every segment into the index-cache entry, so each entry holds the
+    bytes it needs, indexes saved from the same store share them on disk, and deleting an
+    entry frees whatever no other entry links to.
+    """
+
+    def __init__(self):
+        self.segments: List[str] = []
+        # Where each segment is read from: the scratch directory or the entry it was loaded from
+        self.segment_paths: List[str] = []
+        # Segments this store wrote and has to delete on close
+        self._scratch: List[str] = []
+        self.names: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+        for column, code in COLUMNS.items():
+            setattr(self, column, array(code))
+        # File name -> ID of its live document
+        self.doc_ids: Dict[str, int] = {}
+        self.chunk_count = 0
+        self._writer = None
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def document_count(self) -> int:
+        return len(self.doc_ids)
+
+    def _intern(self, name: str) -> int:
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add_document(self, name: str, file_path: str) -> int:
+        """Append a file's bytes as a new document and return its ID; it replaces any live one of that name"""
+        if self._writer is None:
+            self.segments.append(f"{uuid.uuid4().hex}.blob")
+            self.segment_paths.append(os.path.join(scratch_dir(), self.segments[-1]))
+            self._scratch.append(self.segment_paths[-1])
+            self._writer = open(self.segment_paths[-1], 'wb')
+        start = self._writer.tell()
+        with open(file_path, 'rb') as f:
+            shutil.copyfileobj(f, self._writer, COPY_BLOCK_BYTES)
+
+        self.remove(name)
+        doc_id = len(self.doc_chunks)
+        self.doc_name.append(self._intern(name))
+        self.doc_segment.append(len(self.segments) - 1)
+        self.doc_offset.append(start)
+        self.doc_length.append(self._writer.tell() - start)
+        self.doc_first_chunk.append(len(self.chunk_offset))
+        self.doc_chunks.append(0)
+        self.doc_ids[self.names[self.doc_name[doc_id]]] = doc_id
+        return doc_id
+
+    def add_chunk(self, doc_id: int, offset: int, length: int) -> int:
+        """Record the next chunk of the document added last; returns its number within the document"""
+        if doc_id != len(self.doc_chunks) - 1:
+            raise ValueError("Chunks can only be added to the most recently added document")
+        self.chunk_offset.append(offset)
+        self.chunk_length.append(length)
+        self.doc_chunks[doc_id] += 1
+        self.chunk_count += 1
+        return self.doc_chunks[doc_id] - 1
+
+    def commit(self):
+        """Finish the segment being written; reads see documents only after this"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def remove(self, name: str) -> Optional[Tuple[int, int]]:
+        """Drop the live document of that name; returns (document ID, chunk count) or None"""
+        doc_id = self.doc_ids.pop(name, None)
+        if doc_id is None:
+            return None
+        chunks = self.doc_chunks[doc_id]
+        self.doc_chunks[doc_id] = -1
+        self.chunk_count -= chunks
+        return doc_id, chunks
+
+    def chunk(self, doc_id: int, number: int) -> Optional[Tuple[str, int, int]]:
+        """(file name, offset, length) of a live chunk, or None if it was removed"""
+        if doc_id >= len(self.doc_chunks) or number >= self.doc_chunks[doc_id]:
+            return None
+        position = self.doc_first_chunk[doc_id] + number
+        return self.names[self.doc_name[doc_id]], self.chunk_offset[position], self.chunk_length[position]
+
+    def chunks_within(self, name: str, offset: int, length: int) -> Tuple[int, List[int]]:
+        """(document ID, numbers of the live chunks lying wholly inside a span of that document)"""
+        doc_id = self.doc_ids[name]
+        first = self.doc_first_chunk[doc_id]
+        return doc_id, [number for number in range(self.doc_chunks[doc_id])
+                        if offset <= self.chunk_offset[first + number]
+                        and self.chunk_offset[first + number] + self.chunk_length[first + number] <= offset + length]
+
+    def _segment(self, segment: int) -> mmap.mmap:
+        buf = self._maps.get(segment)
+        if buf is None:
+            with self._lock:
+                buf = self._maps.get(segment)
+                if buf is None:
+                    with open(self.segment_paths[segment], 'rb') as f:
+                        buf = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return buf
+
+    def read(self, name: str, offset: int, length: int) -> bytes:
+        """Bytes of a span of the live document of that name"""
+        doc_id = self.doc_ids[name]
+        length = max(0, min(length, self.doc_length[doc_id] - offset))
+        if not length:
+            return b""
+        start = self.doc_offset[doc_id] + offset
+        return self._segment(self.doc_segment[doc_id])[start:start + length]
+
+    def memory_bytes(self) -> int:
+        """Memory of the arrays and the name table; mapped segments are left to the page cache"""
+        arrays = sum(len(getattr(self, column)) * getattr(self, column).itemsize for column in COLUMNS)
+        return arrays + sum(len(name) + 50 for name in self.names)
+
+    def save(self, path: str):
+        """Write the arrays and name table into the directory path, and link the segments there"""
+        self.commit()
+        for segment, segment_path in zip(self.segments, self.segment_paths):
+            target = os.path.join(path, segment)
+            try:
+                os.link(segment_path, target)
+            except OSError:
+                shutil.copyfile(segment_path, target)  # no hard links across filesystems
+        for column in COLUMNS:
+            with open(os.path.join(path, f"{column}.bin"), 'wb') as f:
+                getattr(self, column).tofile(f)
+        with open(os.path.join(path, STORE_FILE), 'w') as f:
+            json.dump({"segments": self.segments, "names": self.names}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "DocumentStore":
+        """Store saved in path; raises FileNotFoundError if a segment it needs is gone"""
+        store = cls()
+        with open(os.path.join(path, STORE_FILE), 'r') as f:
+            saved = json.load(f)
+        for segment in saved["segments"]:
+            if not os.path.exists(os.path.join(path, segment)):
+                raise FileNotFoundError(f"Document segment {segment} is missing")
+        store.segments = saved["segments"]
+        store.segment_paths = [os.path.join(path, segment) for segment in store.segments]
+        store.names = saved["names"]
+        store._name_ids = {name: i for i, name in enumerate(store.names)}
+        for column in COLUMNS:
+            values = getattr(store, column)
+            column_path = os.path.join(path, f"{column}.bin")
+            with open(column_path, 'rb') as f:
+                values.fromfile(f, os.path.getsize(column_path) // values.itemsize)
+        for doc_id, chunks in enumerate(store.doc_chunks):
+            if chunks >= 0:
+                store.doc_ids[store.names[store.doc_name[doc_id]]] = doc_id
+                store.chunk_count += chunks
+        # Mapped now, so the store keeps working if its cache entry is pruned while it is in use
+        for segment, segment_path in enumerate(store.segment_paths):
+            if os.path.getsize(segment_path):
+                store._segment(segment)
+        return store
+
+    def close(self):
+        """Unmap the segments and delete the ones written here; saved copies are kept"""
+        self.commit()
+        with self._lock:
+            for buf in self._maps.values():
+                buf.close()
+            self._maps.clear()
+        for segment_path in self._scratch:
+            try:
+                os.remove(segment_path)
+            except OSError:
+                pass
+        self._scratch.clear()
@@ -0,0 +1,283 @@
+import os
+import json
+import fcntl
+import atexit
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on cached vectors per model; least recently used entries are evicted
+MAX_ENTRIES = int(os.environ.get("CIA_EMBEDDING_CACHE_ENTRIES", "200000"))
+# Reads are appended to the key log in batches of this many keys, or with the next write
+RECENCY_FLUSH_KEYS = int(os.environ.get("CIA_EMBEDDING_CACHE_RECENCY_FLUSH", "1024"))
+# The key log is rewritten once it holds this many records per live entry
+LOG_COMPACT_RATIO = 4
+VECTORS_FILE = "vectors.bin"
+KEY_LOG_FILE = "keys.log"
+# flock target shared by every process using a cache directory; the log itself is replaced on compaction
+LOCK_FILE = "keys.lock"
+
+_shared_caches: Dict[str, "EmbeddingCache"] = {}
+_shared_lock = threading.Lock()
+
+
+def text_key(text: str) -> str:
+    """Content hash used as the cache key for a text"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings keyed by content hash, stored as a memory-mapped matrix with LRU slots.
+
+    Which key holds which row lives in an append-only log: a JSON header line, then one
+    "key slot" line each time a key is written or, in batches, read. Replaying it in order
+    gives the slots and their recency, since a slot taken over by a new key drops the old
+    one. It is compacted when it grows to LOG_COMPACT_RATIO records per entry.
+
+    Processes can share a cache directory: writes take an exclusive flock on LOCK_FILE and
+    replay the records other processes appended since the last look before choosing slots.
+    """
+
+    def __init__(self, model_name: str, max_entries: int = MAX_ENTRIES, dtype: str = "float16",
+                 cache_dir: Optional[str] = None):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        model_key = hashlib.blake2b(model_name.encode("utf-8"), digest_size=8).hexdigest()
+        self.cache_dir = cache_dir or get_cache_dir(os.path.join("embeddings", model_key))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._dimension = None
+        # key -> row in the matrix, ordered from least to most recently used
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        # row -> the key last written there, and the first row never written
+        self._owners: Dict[int, str] = {}
+        self._next_slot = 0
+        # Keys read since the last append, persisted lazily
+        self._touched: "OrderedDict[str, None]" = OrderedDict()
+        self._log_records = 0
+        # How much of which log file has been replayed
+        self._log_offset = 0
+        self._log_inode = None
+        with self._file_lock():
+            self._load()
+
+    @property
+    def _log_path(self) -> str:
+        return os.path.join(self.cache_dir, KEY_LOG_FILE)
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _header(self) -> Dict:
+        return {"dtype": self.dtype.name, "max_entries": self.max_entries, "dimension": self._dimension}
+
+    def _load(self):
+        try:
+            with open(self._log_path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                header_line = f.readline()
+                header = json.loads(header_line)
+                tail = f.read()
+        except FileNotFoundError:
+            return
+        except ValueError:
+            header, header_line, tail = {}, b"", b""
+        if header.get("dtype") != self.dtype.name or header.get("max_entries") != self.max_entries:
+            self._reset()
+            return
+        self._dimension = header["dimension"]
+        self._log_inode = inode
+        self._log_offset = len(header_line)
+        self._replay_tail(tail)
+        self._open_vectors()
+
+    def _replay_tail(self, data: bytes):
+        """Apply the complete records in data, read from the log at the replayed offset"""
+        # Anything after the last newline is a partial record from an interrupted append
+        end = data.rfind(b"\n") + 1
+        records = data[:end].decode("utf-8").split("\n")[:-1]
+        for record in records:
+            key, _, slot = record.partition(" ")
+            if not slot.isdigit():
+                continue
+            slot = int(slot)
+            owner = self._owners.get(slot)
+            if owner is not None and owner != key and self._slots.get(owner) == slot:
+                del self._slots[owner]
+            self._owners[slot] = key
+            self._next_slot = max(self._next_slot, slot + 1)
+            self._slots[key] = slot
+            self._slots.move_to_end(key)
+        self._log_records += len(records)
+        self._log_offset += end
+
+    def _sync(self):
+        """Catch up with records other processes appended to the log"""
+        try:
+            stat = os.stat(self._log_path)
+        except FileNotFoundError:
+            if self._log_inode is not None:
+                self._clear()
+            return
+        if stat.st_ino != self._log_inode or stat.st_size < self._log_offset:
+            # Compacted or reset elsewhere: replay it from the start
+            self._clear()
+            self._load()
+        elif stat.st_size > self._log_offset:
+            with open(self._log_path, 'rb') as f:
+                f.seek(self._log_offset)
+                self._replay_tail(f.read())
+
+    def _clear(self):
+        self._slots.clear()
+        self._owners.clear()
+        self._next_slot = 0
+        self._vectors = None
+        self._dimension = None
+        self._log_records = 0
+        self._log_offset = 0
+        self._log_inode = None
+
+    def _reset(self):
+        logger.info("Embedding cache layout changed, starting empty")
+        for name in (VECTORS_FILE, KEY_LOG_FILE):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _open_vectors(self):
+        path = os.path.join(self.cache_dir, VECTORS_FILE)
+        mode = 'r+' if os.path.exists(path) else 'w+'
+        self._vectors = np.memmap(path, dtype=self.dtype, mode=mode,
+                                  shape=(self.max_entries, self._dimension))
+
+    def get_many(self, keys: List[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """Return ({position: vector} for cached keys, positions of missing keys)"""
+        found, missing = {}, []
+        with self._lock:
+            with self._file_lock(shared=True):
+                self._sync()
+            for i, key in enumerate(keys):
+                slot = self._slots.get(key)
+                if slot is None:
+                    missing.append(i)
+                    continue
+                found[i] = np.asarray(self._vectors[slot], dtype=np.float32)
+                self._slots.move_to_end(key)
+                self._touched[key] = None
+                self._touched.move_to_end(key)
+            self.hits += len(found)
+            self.misses += len(missing)
+            if len(self._touched) >= RECENCY_FLUSH_KEYS:
+                with self._file_lock():
+                    self._sync()
+                    self._append([])
+        return found, missing
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        """Store vectors, evicting the least recently used entries when full"""
+        if not keys:
+            return
+        with self._lock, self._file_lock():
+            # Slots are chosen from the log as every process has written it so far
+            self._sync()
+            if self._vectors is None:
+                self._dimension = int(vectors.shape[1])
+                self._open_vectors()
+            for key, vector in zip(keys, vectors):
+                slot = self._slots.get(key)
+                if slot is None:
+                    if self._next_slot < self.max_entries:
+                        slot = self._next_slot
+                        self._next_slot += 1
+                    else:
+                        _, slot = self._slots.popitem(last=False)
+                        self.evictions += 1
+                    self._slots[key] = slot
+                    self._owners[slot] = key
+                self._vectors[slot] = vector
+                self._slots.move_to_end(key)
+            self._vectors.flush()
+            self._append(keys)
+
+    def flush(self):
+        """Persist the recency of keys read since the last write"""
+        with self._lock:
+            if self._touched and self._vectors is not None:
+                with self._file_lock():
+                    self._sync()
+                    self._append([])
+
+    def _append(self, written: List[str]):
+        """Log pending reads, then the written keys, after their vectors are on disk.
+
+        Called under the exclusive file lock, right after _sync.
+        """
+        keys = [key for key in self._touched if key in self._slots] + list(dict.fromkeys(written))
+        self._touched.clear()
+        if self._log_records + len(keys) > LOG_COMPACT_RATIO * max(len(self._slots), 1024):
+            self._compact()
+            return
+        data = "".join(f"{key} {self._slots[key]}\n" for key in keys).encode("utf-8")
+        with open(self._log_path, 'ab') as f:
+            if self._log_inode is None:
+                header = (json.dumps(self._header()) + "\n").encode("utf-8")
+                f.write(header)
+                self._log_inode = os.fstat(f.fileno()).st_ino
+                self._log_offset = len(header)
+            f.write(data)
+        self._log_records += len(keys)
+        self._log_offset += len(data)
+
+    def _compact(self):
+        """Rewrite the log as one record per live key, least recently used first"""
+        tmp_path = f"{self._log_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write((json.dumps(self._header()) + "\n").encode("utf-8"))
+            f.write("".join(f"{key} {slot}\n" for key, slot in self._slots.items()).encode("utf-8"))
+            self._log_offset = f.tell()
+            self._log_inode = os.fstat(f.fileno()).st_ino
+        os.replace(tmp_path, self._log_path)
+        self._log_records = len(self._slots)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model_name": self.model_name,
+                "entries": len(self._slots),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def get_embedding_cache(model_name: str) -> EmbeddingCache:
+    """Process-wide cache instance for a model"""
+    with _shared_lock:
+        if model_name not in _shared_caches:
+            _shared_caches[model_name] = cache = EmbeddingCache(model_name)
+            atexit.register(cache.flush)
+        return _shared_caches[model_name]
@@ -0,0 +1,246 @@
+import os
+import time
+import logging
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# Corpus sizes (in vectors) at which "auto" moves to the next backend
+HNSW_MIN_VECTORS = 50_000
+IVF_PQ_MIN_VECTORS = 1_000_000
+
+DEFAULT_NPROBE = int(os.environ.get("CIA_INDEX_NPROBE", "16"))
+DEFAULT_EF_SEARCH = int(os.environ.get("CIA_INDEX_EF_SEARCH", "64"))
+HNSW_M = 32
+# faiss wants ~39 training points per IVF centroid
+TRAIN_POINTS_PER_LIST = 39
+MAX_TRAIN_SAMPLE = 256 * 1024
+# 8-bit PQ codebooks have 256 centroids each
+PQ_MIN_TRAIN = 256 * TRAIN_POINTS_PER_LIST
+
+
+def choose_index_kind(expected_vectors: int) -> str:
+    """Pick a backend from the expected corpus size"""
+    if expected_vectors < HNSW_MIN_VECTORS:
+        return "flat"
+    if expected_vectors < IVF_PQ_MIN_VECTORS:
+        return "hnsw"
+    return "ivf_pq"
+
+
+def _nlist_for(n_vectors: int) -> int:
+    return max(1, min(65536, int(4 * np.sqrt(max(n_vectors, 1))), n_vectors // TRAIN_POINTS_PER_LIST))
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    """Largest sub-quantizer count of at most dimension / 4 that divides dimension"""
+    for m in range(max(1, dimension // 4), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Return float32 unit vectors so inner product equals cosine similarity"""
+    vectors = np.ascontiguousarray(vectors, dtype='float32').copy()
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def create_index(kind: str, dimension: int, expected_vectors: int) -> faiss.Index:
+    """Create an empty inner-product index of the given kind"""
+    if kind == "flat":
+        return faiss.IndexFlatIP(dimension)
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 80
+        return index
+    if kind in ("ivf_flat", "ivf_pq"):
+        nlist = _nlist_for(expected_vectors)
+        quantizer = faiss.IndexFlatIP(dimension)
+        if kind == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, _pq_subquantizers(dimension), 8,
+                                faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown index kind: {kind}")
+
+
+def base_index(index: faiss.Index) -> faiss.Index:
+    """The index wrapped by an ID map, or the index itself"""
+    if hasattr(index, "id_map"):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def supports_removal(index: faiss.Index) -> bool:
+    """HNSW graphs cannot delete vectors; the others can"""
+    return not hasattr(base_index(index), "hnsw")
+
+
+def index_memory_bytes(index: faiss.Index) -> int:
+    """Rough resident size of an index: vector codes, graph links and ID maps"""
+    base = base_index(index)
+    if hasattr(base, "hnsw"):
+        per_vector = faiss.downcast_index(base.storage).code_size + 4 * base.hnsw.nb_neighbors(0)
+    else:
+        try:
+            per_vector = faiss.extract_index_ivf(base).code_size + 8  # codes plus their list IDs
+        except RuntimeError:
+            per_vector = base.code_size
+    if hasattr(index, "id_map"):
+        per_vector += 48 if isinstance(index, faiss.IndexIDMap2) else 8  # IDMap2 also keeps a hash map
+    return index.ntotal * per_vector
+
+
+def configure_search(index: faiss.Index, nprobe: int = DEFAULT_NPROBE, ef_search: int = DEFAULT_EF_SEARCH):
+    """Apply query-time parameters to whatever index type this is"""
+    index = base_index(index)
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+        return
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+
+class IndexBuilder:
+    """Builds an ID-mapped index from streamed batches, training on a sample first when needed"""
+
+    def __init__(self, kind: str = "auto", expected_vectors: int = 0,
+                 nprobe: int = DEFAULT_NPROBE, ef_search: int = DEFAULT_EF_SEARCH):
+        self.kind = choose_index_kind(expected_vectors) if kind == "auto" else kind
+        if self.kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown index kind: {kind}")
+        self.expected_vectors = expected_vectors
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.index = None
+        self._pending: List[np.ndarray] = []
+        self._pending_ids: List[np.ndarray] = []
+        self._pending_count = 0
+
+    @property
+    def _needs_training(self) -> bool:
+        return self.kind in ("ivf_flat", "ivf_pq")
+
+    def _train_size(self) -> int:
+        return min(MAX_TRAIN_SAMPLE, _nlist_for(self.expected_vectors) * TRAIN_POINTS_PER_LIST)
+
+    def _create(self, kind: str, dimension: int, expected_vectors: int):
+        self.index = faiss.IndexIDMap2(create_index(kind, dimension, expected_vectors))
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        vectors = normalize(vectors)
+        ids = np.asarray(ids, dtype='int64')
+        if self.index is not None and self.index.is_trained:
+            self.index.add_with_ids(vectors, ids)
+            return
+        if not self._needs_training:
+            self._create(self.kind, vectors.shape[1], self.expected_vectors)
+            self.index.add_with_ids(vectors, ids)
+            return
+        # Hold batches back until there are enough vectors to train the coarse quantizer
+        self._pending.append(vectors)
+        self._pending_ids.append(ids)
+        self._pending_count += len(vectors)
+        if self._pending_count >= self._train_size():
+            self._train_and_flush()
+
+    def _train_and_flush(self):
+        sample = np.vstack(self._pending)
+        sample_ids = np.concatenate(self._pending_ids)
+        self._pending, self._pending_ids, self._pending_count = [], [], 0
+        n = len(sample)
+        if n < TRAIN_POINTS_PER_LIST * 4:
+            logger.info(f"Only {n} vectors, using a flat index instead of {self.kind}")
+            self.kind = "flat"
+            self._create("flat", sample.shape[1], n)
+        else:
+            if self.kind == "ivf_pq" and n < PQ_MIN_TRAIN:
+                logger.info(f"Only {n} vectors, too few to train PQ codebooks; using ivf_flat")
+                self.kind = "ivf_flat"
+            # Size the lists from what is actually there if the corpus came in small
+            expected = self.expected_vectors if n >= self._train_size() else n
+            self._create(self.kind, sample.shape[1], expected)
+            start = time.time()
+            self.index.train(sample)
+            logger.info(f"Trained {self.kind} index on {n} vectors in {time.time() - start:.1f}s")
+        self.index.add_with_ids(sample, sample_ids)
+
+    def finish(self) -> Optional[faiss.Index]:
+        if self._pending:
+            self._train_and_flush()
+        if self.index is not None:
+            configure_search(self.index, self.nprobe, self.ef_search)
+        return self.index
+
+
+def build_index_from_vectors(vectors: np.ndarray, kind: str, **params) -> faiss.Index:
+    builder = IndexBuilder(kind, expected_vectors=len(vectors), **params)
+    builder.add(vectors, np.arange(len(vectors)))
+    return builder.finish()
+
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, top_k: int = 10,
+                  configs: Optional[List[Dict]] = None) -> List[Dict]:
+    """Recall@k and per-query latency of each backend config against the flat baseline"""
+    configs = configs or [
+        {"kind": "flat"},
+        {"kind": "hnsw", "ef_search": 32},
+        {"kind": "hnsw", "ef_search": 128},
+        {"kind": "ivf_flat", "nprobe": 8},
+        {"kind": "ivf_flat", "nprobe": 32},
+        {"kind": "ivf_pq", "nprobe": 16},
+    ]
+    queries = normalize(queries)
+    _, truth = build_index_from_vectors(vectors, "flat").search(queries, top_k)
+
+    report = []
+    for config in configs:
+        config = dict(config)
+        kind = config.pop("kind")
+        start = time.time()
+        index = build_index_from_vectors(vectors, kind, **config)
+        build_seconds = time.time() - start
+
+        start = time.time()
+        _, found = index.search(queries, top_k)
+        search_seconds = time.time() - start
+
+        hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+        report.append({
+            "kind": kind,
+            "params": config,
+            "recall_at_k": hits / truth.size,
+            "latency_ms_per_query": 1000 * search_seconds / len(queries),
+            "build_seconds": build_seconds,
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of FAISS backends against a flat index")
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    # Clustered synthetic data behaves closer to sentence embeddings than uniform noise
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((max(1, args.vectors // 100), args.dimension)).astype('float32')
+    data = centers[rng.integers(len(centers), size=args.vectors)]
+    data += 0.3 * rng.standard_normal(data.shape).astype('float32')
+    query_data = data[rng.integers(args.vectors, size=args.queries)]
+    query_data = query_data + 0.1 * rng.standard_normal(query_data.shape).astype('float32')
+
+    print(json.dumps(recall_report(data, query_data, args.top_k), indent=2))
@@ -0,0 +1,247 @@
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+from manifest import scan_folder
+from metrics import CACHE_REQUESTS, counter, gauge, span
+
+if TYPE_CHECKING:
+    from rag_engine import RagEngine
+
+logger = logging.getLogger(__name__)
+
+# Estimated bytes of corpus indexes kept in memory on the host; least recently used ones beyond it
+# are dropped. faiss copies flat and HNSW indexes into each process's heap even when they are read
+# memory-mapped, so without the inference sidecar every uvicorn worker (WEB_CONCURRENCY of them)
+# gets an equal share of it; the sidecar is the only process holding indexes and gets all of it.
+HOST_INDEX_MEMORY_BUDGET = int(os.environ.get("CIA_INDEX_MEMORY_BUDGET", str(2 * 1024 ** 3)))
+INDEX_MEMORY_BUDGET = HOST_INDEX_MEMORY_BUDGET // max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+
+INDEXES_LOADED = gauge("cia_indexes_loaded", "Corpus indexes held in memory")
+INDEX_MEMORY = gauge("cia_index_memory_bytes", "Estimated memory of the corpus indexes held in memory")
+INDEX_EVICTIONS = counter("cia_index_evictions_total", "Corpus indexes dropped from memory", ("reason",))
+
+
+class ReadWriteLock:
+    """Many readers or one writer; a waiting writer holds back new readers so it is not starved"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class _Entry:
+    def __init__(self, fingerprint: str, folder_path: str):
+        self.fingerprint = fingerprint
+        self.folder_path = folder_path
+        self.lock = ReadWriteLock()
+        self.engine = None
+        # Requests currently using the entry; only unreferenced entries are evicted
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.memory_bytes = 0
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.fingerprint, self.folder_path
+
+
+class IndexRegistry:
+    """Corpus indexes held side by side, keyed by (corpus fingerprint, folder).
+
+    Each index has its own read-write lock: searches share it, updates take it alone.
+    Updates read from and apply to one folder, so identical folders get separate entries,
+    though they load the same files from the index cache. Entries nobody holds
+    are dropped least recently used first once the estimated memory of all of them goes
+    over memory_budget; they stay in the index cache and are reloaded on the next use.
+    engine_provider returns the RagEngine whose model every corpus engine shares.
+    """
+
+    def __init__(self, engine_provider: Callable[[], "RagEngine"], memory_budget: int = INDEX_MEMORY_BUDGET):
+        self._provider = engine_provider
+        self.memory_budget = memory_budget
+        self._entries: Dict[Tuple[str, str], _Entry] = {}
+        # Folder -> key of its newest contents; entries for older contents are stale
+        self._current: Dict[str, Tuple[str, str]] = {}
+        # Entries updated onto contents another entry already holds; closed once released
+        self._retired: List[_Entry] = []
+        self._lock = threading.Lock()
+
+    def _checkout(self, key: Tuple[str, str]) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(*key)
+            entry.refs += 1
+            entry.last_used = time.monotonic()
+            self._current[entry.folder_path] = key
+            return entry
+
+    def _checkin(self, entry: _Entry):
+        with self._lock:
+            entry.refs -= 1
+        self._evict()
+
+    def _load(self, entry: _Entry, manifest: Optional[Dict[str, Dict]]):
+        """Give the entry an engine, from the index cache or by building; call with its write lock held"""
+        engine = self._provider().for_corpus()
+        if not engine.load_index(entry.fingerprint, entry.folder_path):
+            engine.build_index(entry.folder_path, manifest=manifest)
+        entry.engine = engine
+        entry.memory_bytes = engine.memory_bytes()
+
+    @contextmanager
+    def acquire(self, folder_path: str, manifest: Optional[Dict[str, Dict]] = None) -> Iterator["RagEngine"]:
+        """The engine indexing folder_path's current contents, read-locked for the block.
+
+        manifest is the folder's scan_folder result when the caller already has it.
+        """
+        folder_path = os.path.abspath(folder_path)
+        with span("indexing"):
+            if manifest is None:
+                manifest = scan_folder(folder_path)
+            entry = self._checkout((self._provider().corpus_fingerprint(folder_path, manifest), folder_path))
+            try:
+                CACHE_REQUESTS.inc(cache="index_registry", result="hit" if entry.engine else "miss")
+                if entry.engine is None:
+                    with entry.lock.write():
+                        if entry.engine is None:
+                            self._load(entry, manifest)
+            except BaseException:
+                self._checkin(entry)
+                raise
+        try:
+            with entry.lock.read():
+                yield entry.engine
+        finally:
+            self._checkin(entry)
+
+    def update(self, folder_path: str, changed_paths: List[str]) -> Dict:
+        """RagEngine.update_index on the folder's index, with the entry write-locked.
+
+        The entry moves to the fingerprint of the updated contents. A folder with no index
+        yet is indexed from scratch.
+        """
+        folder_path = os.path.abspath(folder_path)
+        with self._lock:
+            key = self._current.get(folder_path)
+        if key is None:
+            with self.acquire(folder_path) as engine:
+                return {"mode": "rebuild", "documents": engine.store.document_count, "chunks": engine.store.chunk_count}
+
+        entry = self._checkout(key)
+        try:
+            with entry.lock.write():
+                if entry.engine is None:
+                    # Evicted since; the index cache still has the pre-update index
+                    self._load(entry, None)
+                summary = entry.engine.update_index(folder_path, changed_paths)
+                entry.memory_bytes = entry.engine.memory_bytes()
+                self._rekey(entry, (entry.engine.fingerprint, folder_path))
+        finally:
+            self._checkin(entry)
+        return summary
+
+    def _rekey(self, entry: _Entry, key: Tuple[str, str]):
+        with self._lock:
+            self._current[entry.folder_path] = key
+            if key == entry.key:
+                return
+            if self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+            if key in self._entries:
+                # Another request already indexed the new contents; this copy goes when released
+                self._retired.append(entry)
+                return
+            entry.fingerprint = key[0]
+            self._entries[key] = entry
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            for entry in [entry for entry in self._retired if not entry.refs]:
+                self._retired.remove(entry)
+                evicted.append((entry, "stale"))
+            for key, entry in list(self._entries.items()):
+                if entry.refs:
+                    continue
+                if entry.engine is None:
+                    del self._entries[key]  # failed to load
+                elif self._current.get(entry.folder_path) != key:
+                    del self._entries[key]
+                    evicted.append((entry, "stale"))
+
+            loaded = [entry for entry in self._entries.values() if entry.engine is not None]
+            total = sum(entry.memory_bytes for entry in loaded)
+            for entry in sorted(loaded, key=lambda entry: entry.last_used):
+                if total <= self.memory_budget:
+                    break
+                if entry.refs:
+                    continue
+                del self._entries[entry.key]
+                total -= entry.memory_bytes
+                evicted.append((entry, "memory"))
+            INDEXES_LOADED.set(len(self._entries))
+            INDEX_MEMORY.set(total)
+
+        for entry, reason in evicted:
+            INDEX_EVICTIONS.inc(reason=reason)
+            logger.info(f"Dropping {reason} index for {entry.folder_path} ({entry.memory_bytes} bytes)")
+            if reason == "memory":
+                try:
+                    entry.engine.persist()
+                except Exception as e:
+                    logger.warning(f"Could not cache FAISS index: {str(e)}")
+            entry.engine.close()
+
+    def stats(self) -> Dict:
+        """Indexes in memory with their estimated size, users and idle time"""
+        now = time.monotonic()
+        with self._lock:
+            indexes = [{
+                "folder_path": entry.folder_path,
+                "fingerprint": entry.fingerprint,
+                "loaded": entry.engine is not None,
+                "memory_bytes": entry.memory_bytes,
+                "refs": entry.refs,
+                "idle_seconds": round(now - entry.last_used, 3),
+            } for entry in sorted(self._entries.values(), key=lambda entry: -entry.last_used)]
+        return {
+            "memory_budget": self.memory_budget,
+            "memory_bytes": sum(index["memory_bytes"] for index in indexes),
+            "indexes": indexes,
+        }
@@ -0,0 +1,408 @@
+import os
+import copy
+import time
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import torch
+from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
+
+from metrics import counter, histogram
+from utils import inference_config, resident_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BACKENDS = ("pipeline", "cpu_int8", "stub", "remote")
+
+# Every analysis prompt starts with this, so its attention keys/values are computed once
+SHARED_PROMPT_PREFIX = "Document Change Impact Analysis:\n\n"
+
+TOKENS_GENERATED = counter("cia_generated_tokens_total", "Tokens generated", ("backend",))
+GENERATION_SECONDS = histogram("cia_generation_duration_seconds", "Time per generator call", ("backend",))
+
+
+def _batch_ready(tokenizer):
+    """Decoder-only models need left padding (and some pad token) to generate in batches"""
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+
+class GenerationStats:
+    """Throughput of the generations run by a backend"""
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.generations = 0
+        self.total_tokens = 0
+        self.total_seconds = 0.0
+        self.last_tokens_per_second = None
+        self.prefix_cache_hits = 0
+
+    def record(self, new_tokens: int, seconds: float, prefix_reused: bool = False):
+        TOKENS_GENERATED.inc(new_tokens, backend=self.backend)
+        GENERATION_SECONDS.observe(seconds, backend=self.backend)
+        with self._lock:
+            self.generations += 1
+            self.total_tokens += new_tokens
+            self.total_seconds += seconds
+            self.last_tokens_per_second = new_tokens / seconds if seconds > 0 else None
+            if prefix_reused:
+                self.prefix_cache_hits += 1
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "generations": self.generations,
+                "total_tokens": self.total_tokens,
+                "tokens_per_second": self.total_tokens / self.total_seconds if self.total_seconds else None,
+                "last_tokens_per_second": self.last_tokens_per_second,
+                "prefix_cache_hits": self.prefix_cache_hits,
+            }
+
+
+class TokenizerAccess:
+    """Thread-safe token counting and trimming on top of a backend's tokenizer"""
+
+    def _set_tokenizer(self, tokenizer):
+        self.tokenizer = _batch_ready(tokenizer)
+        # Fast tokenizers fail with "Already borrowed" when used from two threads at once
+        self.tokenizer_lock = threading.Lock()
+
+    def count_tokens(self, text: str) -> int:
+        with self.tokenizer_lock:
+            return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """text cut down to its first max_tokens tokens"""
+        with self.tokenizer_lock:
+            ids = self.tokenizer(text, add_special_tokens=False).input_ids
+            if len(ids) <= max_tokens:
+                return text
+            return self.tokenizer.decode(ids[:max(0, max_tokens)], skip_special_tokens=True)
+
+
+class PipelineBackend(TokenizerAccess):
+    """Full-precision transformers pipeline, on GPU when one is available"""
+
+    name = "pipeline"
+
+    def __init__(self, model_name: str, **_):
+        self.model_name = model_name
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        logger.info(f"Using device: {self.device}")
+        self.generator = pipeline(
+            "text-generation",
+            model=model_name,
+            device=0 if self.device == "cuda" else -1
+        )
+        self._set_tokenizer(self.generator.tokenizer)
+        self.generation_stats = GenerationStats(self.name)
+
+    def _tokenize(self, prompts, **kwargs):
+        # Only tokenizing holds the lock; the model call itself runs alongside other requests
+        with self.tokenizer_lock:
+            inputs = self.tokenizer(prompts, return_tensors="pt", **kwargs)
+        return inputs.to(self.generator.model.device)
+
+    @torch.inference_mode()
+    def generate(self, prompt: str, streamer=None, **params) -> str:
+        inputs = self._tokenize(prompt)
+        start = time.time()
+        output = self.generator.model.generate(**inputs, streamer=streamer,
+                                               pad_token_id=self.tokenizer.pad_token_id, **params)
+        new_tokens = output[0, inputs.input_ids.shape[1]:]
+        self.generation_stats.record(len(new_tokens), time.time() - start)
+        with self.tokenizer_lock:
+            return self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+
+    @torch.inference_mode()
+    def generate_batch(self, prompts: List[str], batch_size: int = 4, **params) -> List[str]:
+        texts = []
+        for i in range(0, len(prompts), batch_size):
+            inputs = self._tokenize(prompts[i:i + batch_size], padding=True)
+            start = time.time()
+            output = self.generator.model.generate(**inputs, pad_token_id=self.tokenizer.pad_token_id, **params)
+            new_tokens = output[:, inputs.input_ids.shape[1]:]
+            generated = int((new_tokens != self.tokenizer.pad_token_id).sum())
+            self.generation_stats.record(generated, time.time() - start)
+            with self.tokenizer_lock:
+                decoded = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+            texts.extend(text.strip() for text in decoded)
+        return texts
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.name,
+            "model": self.model_name,
+            "device": self.device,
+            "resident_memory_bytes": resident_memory_bytes(),
+            **self.generation_stats.to_dict(),
+        }
+
+
+class CpuInt8Backend(TokenizerAccess):
+    """CPU generation with int8 dynamically quantized Linear layers.
+
+    Weights of every nn.Linear are stored as int8 and activations are quantized on the fly,
+    roughly quartering their memory and speeding up the matmuls on CPUs with VNNI/AVX2.
+    The key/value cache of the shared prompt prefix is computed once and reused by every call.
+    """
+
+    name = "cpu_int8"
+
+    def __init__(self, model_name: str, threads: Optional[int] = None, **_):
+        self.model_name = model_name
+        self.threads = threads or max(1, (os.cpu_count() or 1) // 2)
+        # One intra-op pool sized for the node; inter-op parallelism only adds contention here
+        torch.set_num_threads(self.threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # can only be set before the first parallel op in the process
+
+        start = time.time()
+        self._set_tokenizer(AutoTokenizer.from_pretrained(model_name))
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        model.eval()
+        self.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info(f"Loaded {model_name} with int8 dynamic quantization in {time.time() - start:.1f}s "
+                    f"({self.threads} threads)")
+
+        self.generation_stats = GenerationStats(self.name)
+        self._prefix_ids, self._prefix_cache = self._encode_prefix(SHARED_PROMPT_PREFIX)
+
+    @torch.inference_mode()
+    def _encode_prefix(self, prefix: str):
+        with self.tokenizer_lock:
+            inputs = self.tokenizer(prefix, return_tensors="pt")
+        # The same inputs generate passes, token_type_ids included where the tokenizer gives them
+        outputs = self.model(**inputs, use_cache=True)
+        cache = outputs.past_key_values
+        if hasattr(cache, "to_legacy_cache"):
+            cache = cache.to_legacy_cache()
+        return inputs.input_ids[0].tolist(), cache
+
+    def _prefix_for(self, input_ids: torch.Tensor):
+        """A private copy of the prefix cache when the prompt tokenizes to the same leading ids"""
+        n = len(self._prefix_ids)
+        if input_ids.shape[1] <= n or input_ids[0, :n].tolist() != self._prefix_ids:
+            return None
+        # generate extends the cache in place, so each call gets its own copy
+        return copy.deepcopy(self._prefix_cache)
+
+    @torch.inference_mode()
+    def generate(self, prompt: str, streamer=None, **params) -> str:
+        with self.tokenizer_lock:
+            inputs = self.tokenizer(prompt, return_tensors="pt")
+        past_key_values = self._prefix_for(inputs.input_ids)
+
+        start = time.time()
+        output = self.model.generate(
+            **inputs,
+            past_key_values=past_key_values,
+            streamer=streamer,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **params
+        )
+        new_tokens = output[0, inputs.input_ids.shape[1]:]
+        self.generation_stats.record(len(new_tokens), time.time() - start, past_key_values is not None)
+        with self.tokenizer_lock:
+            return self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+
+    @torch.inference_mode()
+    def generate_batch(self, prompts: List[str], batch_size: int = 4, **params) -> List[str]:
+        """Greedy generation for several prompts per forward pass.
+
+        Left padding shifts the shared prefix to a different position in each row, so batches
+        do not use the prefix cache.
+        """
+        texts = []
+        for i in range(0, len(prompts), batch_size):
+            with self.tokenizer_lock:
+                inputs = self.tokenizer(prompts[i:i + batch_size], return_tensors="pt", padding=True)
+            start = time.time()
+            output = self.model.generate(**inputs, pad_token_id=self.tokenizer.pad_token_id, **params)
+            new_tokens = output[:, inputs.input_ids.shape[1]:]
+            generated = int((new_tokens != self.tokenizer.pad_token_id).sum())
+            self.generation_stats.record(generated, time.time() - start)
+            with self.tokenizer_lock:
+                decoded = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+            texts.extend(text.strip() for text in decoded)
+        return texts
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.name,
+            "model": self.model_name,
+            "device": "cpu",
+            "threads": self.threads,
+            "prefix_tokens": len(self._prefix_ids),
+            "resident_memory_bytes": resident_memory_bytes(),
+            **self.generation_stats.to_dict(),
+        }
+
+
+class WhitespaceTokenizer:
+    """Word-level stand-in for a model tokenizer"""
+
+    model_max_length = 4096
+    pad_token = eos_token = ""
+    padding_side = "left"
+
+    def __call__(self, text: str, add_special_tokens: bool = False):
+        return SimpleNamespace(input_ids=text.split())
+
+    def decode(self, ids, skip_special_tokens: bool = True) -> str:
+        return " ".join(ids)
+
+
+class StubBackend(TokenizerAccess):
+    """Canned, deterministic output with no model weights, for benchmarks and tests.
+
+    Produces max_new_tokens words, optionally sleeping seconds_per_token per word to stand in
+    for a real model's decode speed.
+    """
+
+    name = "stub"
+
+    def __init__(self, model_name: str = "stub", seconds_per_token: float = 0.0, **_):
+        self.model_name = model_name
+        self.seconds_per_token = float(seconds_per_token)
+        self._set_tokenizer(WhitespaceTokenizer())
+        self.generation_stats = GenerationStats(self.name)
+
+    def _answer(self, prompt: str, max_new_tokens: int = 100, **_) -> str:
+        seed = int(hashlib.blake2b(prompt.encode("utf-8"), digest_size=4).hexdigest(), 16)
+        words = ("impact", "review", "update", "reference", "section", "risk", "dependency", "change")
+        return " ".join(words[(seed + i) % len(words)] for i in range(max_new_tokens))
+
+    def generate(self, prompt: str, streamer=None, **params) -> str:
+        start = time.time()
+        text = self._answer(prompt, **params)
+        n_tokens = params.get("max_new_tokens", 100)
+        time.sleep(self.seconds_per_token * n_tokens)
+        if streamer is not None:
+            streamer.on_finalized_text(text, stream_end=True)
+        self.generation_stats.record(n_tokens, time.time() - start)
+        return text
+
+    def generate_batch(self, prompts: List[str], batch_size: int = 4, **params) -> List[str]:
+        return [self.generate(prompt, **params) for prompt in prompts]
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.name,
+            "model": self.model_name,
+            "device": "cpu",
+            "resident_memory_bytes": resident_memory_bytes(),
+            **self.generation_stats.to_dict(),
+        }
+
+
+class RemoteBackend(TokenizerAccess):
+    """Generation in the inference sidecar, shared by every app worker on the host.
+
+    Only the tokenizer is loaded here, for prompt budgeting; the model named by the
+    sidecar replaces model_name. Requests from all workers are batched by the sidecar.
+    """
+
+    name = "remote"
+
+    def __init__(self, model_name: str = None, socket: Optional[str] = None, **_):
+        from inference_sidecar import INFERENCE_SOCKET, sidecar_call
+
+        self.socket_path = socket or INFERENCE_SOCKET
+        info = sidecar_call(self.socket_path, {"op": "info"})
+        self.model_name = info["model"]
+        self.served_backend = info["backend"]
+        if self.served_backend == "stub":
+            self._set_tokenizer(WhitespaceTokenizer())
+        else:
+            self._set_tokenizer(AutoTokenizer.from_pretrained(self.model_name))
+        self.generation_stats = GenerationStats(self.name)
+
+    def _request(self, prompts: List[str], streamer=None, **params) -> List[str]:
+        from inference_sidecar import SidecarError, sidecar_request
+
+        message = {"op": "generate", "prompts": prompts, "params": params, "stream": streamer is not None}
+        texts = None
+        for reply in sidecar_request(self.socket_path, message):
+            if streamer is not None and "text" in reply:
+                streamer.on_finalized_text(reply["text"], stream_end=False)
+            if reply.get("done"):
+                texts = reply.get("texts")
+        if streamer is not None:
+            streamer.on_finalized_text("", stream_end=True)
+        if texts is None:
+            raise SidecarError("Inference sidecar finished the request without generated texts")
+        return texts
+
+    def generate(self, prompt: str, streamer=None, **params) -> str:
+        start = time.time()
+        text = self._request([prompt], streamer, **params)[0]
+        self.generation_stats.record(self.count_tokens(text), time.time() - start)
+        return text
+
+    def generate_batch(self, prompts: List[str], batch_size: int = 4, **params) -> List[str]:
+        """All prompts in one request; the sidecar batches them with other workers' requests"""
+        start = time.time()
+        texts = self._request(prompts, **params)
+        for text in texts:
+            self.generation_stats.record(self.count_tokens(text), (time.time() - start) / len(texts))
+        return texts
+
+    def stats(self) -> Dict:
+        from inference_sidecar import SidecarError, sidecar_call
+
+        try:
+            sidecar = sidecar_call(self.socket_path, {"op": "stats"}, timeout=5)
+            sidecar.pop("done", None)
+        except SidecarError as e:
+            sidecar = {"error": str(e)}
+        return {
+            "backend": self.name,
+            "model": self.model_name,
+            "socket": self.socket_path,
+            "resident_memory_bytes": resident_memory_bytes(),
+            **self.generation_stats.to_dict(),
+            "sidecar": sidecar,
+        }
+
+
+def create_backend(backend: str, model_name: str, **options):
+    """Instantiate a generation backend by name"""
+    if backend == "pipeline":
+        return PipelineBackend(model_name, **options)
+    if backend == "cpu_int8":
+        return CpuInt8Backend(model_name, **options)
+    if backend == "stub":
+        return StubBackend(model_name, **options)
+    if backend == "remote":
+        return RemoteBackend(model_name, **options)
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Time a generation backend on an analysis-style prompt")
+    parser.add_argument("model", help="Model name or local path, e.g. a tiny checkpoint directory")
+    parser.add_argument("--backend", choices=INFERENCE_BACKENDS, default="cpu_int8")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    generator = create_backend(args.backend, args.model, threads=args.threads)
+    prompt = (SHARED_PROMPT_PREFIX + "CHANGES DETECTED:\n1. Modified api.md (Type: modified)\n"
+              "\nANALYSIS:\nProvide impact assessment and recommendations:")
+    for _ in range(args.runs):
+        generator.generate(prompt, max_new_tokens=args.max_new_tokens, do_sample=False)
+    print(json.dumps(generator.stats(), indent=2))
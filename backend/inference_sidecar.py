@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import queue
+import base64
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from contextlib import contextmanager
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from context_assembly import CONTEXT_CANDIDATES
+
+logger = logging.getLogger(__name__)
+
+# Unix socket of the sidecar; app workers with the "remote" backend connect here
+INFERENCE_SOCKET = os.environ.get("CIA_INFERENCE_SOCKET", "/tmp/cia-inference.sock")
+# How long the sidecar waits for more requests to join a batch, and the largest batch it runs
+BATCH_WINDOW_SECONDS = float(os.environ.get("CIA_BATCH_WINDOW_MS", "10")) / 1000
+MAX_BATCH = int(os.environ.get("CIA_MAX_BATCH", "8"))
+# Streamed generations run outside the batches, on their connection's thread, this many at a time
+MAX_STREAMS = int(os.environ.get("CIA_MAX_STREAMS", "2"))
+# Embedding requests are small and many, so they batch wider than generations
+MAX_EMBED_BATCH_TEXTS = 512
+
+_HEADER = struct.Struct("!I")
+
+
+class SidecarError(RuntimeError):
+    """The sidecar is unreachable or failed the request"""
+
+
+def send_message(sock: socket.socket, message: Dict):
+    payload = json.dumps(message).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _receive_exactly(sock: socket.socket, n: int) -> Optional[bytes]:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return bytes(buf)
+
+
+def receive_message(sock: socket.socket) -> Optional[Dict]:
+    """The next length-prefixed JSON message, or None when the peer has closed the connection"""
+    header = _receive_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    payload = _receive_exactly(sock, _HEADER.unpack(header)[0])
+    if payload is None:
+        return None
+    return json.loads(payload)
+
+
+def sidecar_request(socket_path: str, message: Dict, timeout: Optional[float] = None) -> Iterator[Dict]:
+    """Send one request and yield its replies; the last one carries "done": True"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            raise SidecarError(f"Inference sidecar at {socket_path} is not reachable: {str(e)}") from e
+        send_message(sock, message)
+        while True:
+            reply = receive_message(sock)
+            if reply is None:
+                raise SidecarError("Inference sidecar closed the connection")
+            if "error" in reply:
+                raise SidecarError(reply["error"])
+            yield reply
+            if reply.get("done"):
+                return
+
+
+def sidecar_call(socket_path: str, message: Dict, timeout: Optional[float] = None) -> Dict:
+    """Send one request and return its final reply"""
+    for reply in sidecar_request(socket_path, message, timeout):
+        pass
+    return reply
+
+
+def encode_vectors(vectors: np.ndarray) -> Dict:
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    return {"shape": list(vectors.shape), "vectors": base64.b64encode(vectors.tobytes()).decode("ascii")}
+
+
+def decode_vectors(reply: Dict) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(reply["vectors"]), dtype='float32').reshape(reply["shape"])
+
+
+class RemoteEmbedder:
+    """SentenceTransformer-style encode() served by the inference sidecar"""
+
+    def __init__(self, socket_path: str = INFERENCE_SOCKET):
+        self.socket_path = socket_path
+        info = sidecar_call(socket_path, {"op": "info"})
+        self.model_name = info["embedding_model"]
+        self.dimension = info["dimension"]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, **_) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype='float32')
+        return decode_vectors(sidecar_call(self.socket_path, {"op": "embed", "texts": list(texts)}))
+
+
+class RemoteCorpus:
+    """The sidecar's index of one folder, with the RagEngine methods the app retrieves through"""
+
+    def __init__(self, socket_path: str, folder_path: str):
+        self.socket_path = socket_path
+        self.folder_path = folder_path
+
+    def related_contexts(self, queries: List[str], top_k: int = CONTEXT_CANDIDATES) -> List[Dict]:
+        message = {"op": "contexts", "folder": self.folder_path, "queries": queries, "top_k": top_k}
+        return sidecar_call(self.socket_path, message)["contexts"]
+
+    def summary(self) -> Dict:
+        return sidecar_call(self.socket_path, {"op": "index_summary", "folder": self.folder_path})["summary"]
+
+
+class RemoteIndexRegistry:
+    """IndexRegistry's interface over the sidecar's registry, so app workers hold no indexes.
+
+    Folders are resolved here and read by the sidecar, which runs on the same host.
+    """
+
+    def __init__(self, socket_path: str = INFERENCE_SOCKET):
+        self.socket_path = socket_path
+
+    @contextmanager
+    def acquire(self, folder_path: str, manifest: Optional[Dict[str, Dict]] = None) -> Iterator[RemoteCorpus]:
+        """A handle on folder_path's index; the sidecar loads or builds it on first use"""
+        yield RemoteCorpus(self.socket_path, os.path.abspath(folder_path))
+
+    def update(self, folder_path: str, changed_paths: List[str]) -> Dict:
+        message = {"op": "index_update", "folder": os.path.abspath(folder_path), "changed_paths": changed_paths}
+        return sidecar_call(self.socket_path, message)["summary"]
+
+    def stats(self) -> Dict:
+        return sidecar_call(self.socket_path, {"op": "indexes"}, timeout=5)["indexes"]
+
+
+class _Batcher:
+    """Runs submitted items on one thread, several at a time when they arrive close together"""
+
+    def __init__(self, name: str, run_batch: Callable[[List], List], window: float, max_items: int,
+                 size: Callable[[object], int] = lambda item: 1):
+        self.name = name
+        self._run_batch = run_batch
+        self.window = window
+        self.max_items = max_items
+        self._size = size
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        threading.Thread(target=self._loop, name=f"sidecar-{name}", daemon=True).start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            total = self._size(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while total < self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                total += self._size(batch[-1][0])
+
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+            try:
+                results = self._run_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else None,
+            }
+
+
+class InferenceSidecar:
+    """One process holding the generator, the embedding model and the corpus indexes for every
+    app worker on a host.
+
+    Workers connect over a Unix socket. Generation requests that arrive within
+    BATCH_WINDOW_SECONDS of each other with the same parameters run as one generate_batch
+    call; embedding requests are concatenated into one encode call. Streamed generations run
+    beside the batches, at most max_streams at once, and send their text as it is produced,
+    so a long stream does not hold up batched requests. Retrieval runs against the
+    sidecar's IndexRegistry, so each index is held in memory once per host.
+    """
+
+    def __init__(self, backend, engine, registry=None, socket_path: str = INFERENCE_SOCKET,
+                 window: float = BATCH_WINDOW_SECONDS, max_batch: int = MAX_BATCH,
+                 max_streams: int = MAX_STREAMS):
+        from index_registry import HOST_INDEX_MEMORY_BUDGET, IndexRegistry
+
+        self.backend = backend
+        self.engine = engine
+        self.embedding_model = engine.model_name
+        # The sidecar is the only process holding indexes, so it gets the whole host budget
+        self.registry = registry or IndexRegistry(lambda: engine, HOST_INDEX_MEMORY_BUDGET)
+        self.socket_path = socket_path
+        self.generations = _Batcher("generate", self._generate_batch, window, max_batch)
+        self.embeddings = _Batcher("embed", self._embed_batch, window, MAX_EMBED_BATCH_TEXTS, size=len)
+        self.max_streams = max_streams
+        self._stream_slots = threading.BoundedSemaphore(max_streams)
+        self._stream_lock = threading.Lock()
+        self.streams_active = 0
+        self.streams = 0
+
+    def _generate_batch(self, items: List[Dict]) -> List:
+        results: List = [None] * len(items)
+        groups: Dict[str, List[int]] = {}
+        for i, item in enumerate(items):
+            groups.setdefault(json.dumps(item["params"], sort_keys=True), []).append(i)
+        for members in groups.values():
+            params = items[members[0]]["params"]
+            try:
+                texts = self.backend.generate_batch([items[i]["prompt"] for i in members],
+                                                    batch_size=len(members), **params)
+            except Exception as e:
+                texts = [e] * len(members)
+            for i, text in zip(members, texts):
+                results[i] = text
+        return results
+
+    def _embed_batch(self, items: List[List[str]]) -> List[np.ndarray]:
+        # Shared with retrieval's query encoding; fast tokenizers fail on concurrent use
+        with self.engine.encode_lock:
+            vectors = np.asarray(self.engine.embedder.encode([text for texts in items for text in texts]),
+                                 dtype='float32')
+        results, start = [], 0
+        for texts in items:
+            results.append(vectors[start:start + len(texts)])
+            start += len(texts)
+        return results
+
+    def _generate_stream(self, sock: socket.socket, prompt: str, params: Dict) -> str:
+        """One streamed generation on the calling thread, once a stream slot is free"""
+        with self._stream_slots:
+            with self._stream_lock:
+                self.streams_active += 1
+                self.streams += 1
+            try:
+                return self.backend.generate(prompt, streamer=self._streamer(sock), **params)
+            finally:
+                with self._stream_lock:
+                    self.streams_active -= 1
+
+    def _streamer(self, sock: socket.socket):
+        from transformers import TextStreamer
+
+        class SocketStreamer(TextStreamer):
+            def on_finalized_text(self, text: str, stream_end: bool = False):
+                if text:
+                    send_message(sock, {"text": text})
+
+        return SocketStreamer(self.backend.tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+    def handle(self, sock: socket.socket, message: Dict) -> Dict:
+        """The final reply to one request; streamed text is sent on sock before it"""
+        op = message.get("op")
+        if op == "info":
+            return {
+                "backend": self.backend.name,
+                "model": self.backend.model_name,
+                "model_max_length": self.backend.tokenizer.model_max_length,
+                "embedding_model": self.embedding_model,
+                "dimension": self.engine.embedder.get_sentence_embedding_dimension(),
+            }
+        if op == "embed":
+            return encode_vectors(self.embeddings.submit(message["texts"]).result())
+        if op == "generate":
+            params = message.get("params", {})
+            if message.get("stream"):
+                if len(message["prompts"]) != 1:
+                    raise ValueError("Streaming takes exactly one prompt")
+                return {"texts": [self._generate_stream(sock, message["prompts"][0], params)]}
+            futures = [self.generations.submit({"prompt": prompt, "params": params})
+                       for prompt in message["prompts"]]
+            return {"texts": [future.result() for future in futures]}
+        if op == "contexts":
+            with self.registry.acquire(message["folder"]) as engine:
+                return {"contexts": engine.related_contexts(message["queries"], message["top_k"])}
+        if op == "index_summary":
+            with self.registry.acquire(message["folder"]) as engine:
+                return {"summary": engine.summary()}
+        if op == "index_update":
+            return {"summary": self.registry.update(message["folder"], message["changed_paths"])}
+        if op == "indexes":
+            return {"indexes": self.registry.stats()}
+        if op == "stats":
+            with self._stream_lock:
+                streaming = {"active": self.streams_active, "total": self.streams, "limit": self.max_streams}
+            return {**self.backend.stats(), "generate_batching": self.generations.stats(),
+                    "embed_batching": self.embeddings.stats(), "streaming": streaming}
+        raise ValueError(f"Unknown operation: {op}")
+
+    def serve_forever(self):
+        sidecar = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    message = receive_message(self.request)
+                    if message is None:
+                        return
+                    try:
+                        reply = sidecar.handle(self.request, message)
+                    except Exception as e:
+                        logger.error(f"Sidecar request {message.get('op')} failed: {str(e)}")
+                        reply = {"error": str(e)}
+                    send_message(self.request, {**reply, "done": True})
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left behind by a previous run
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        os.chmod(self.socket_path, 0o660)
+        logger.info(f"Inference sidecar ({self.backend.name} {self.backend.model_name}, "
+                    f"{self.embedding_model}) listening on {self.socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Serve generation, embeddings and retrieval to app workers over a Unix socket")
+    parser.add_argument("--socket", default=INFERENCE_SOCKET)
+    parser.add_argument("--backend", help="Generation backend (default: the inference config)")
+    parser.add_argument("--model", help="Generator model (default: the inference config)")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2",
+                        help='SentenceTransformer model, or "hashing" for the model-free benchmark embedder')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from inference_backends import create_backend, inference_config
+    from llama_model import GENERATOR_MODEL
+
+    config = inference_config()
+    config.update({key: value for key, value in
+                   {"backend": args.backend, "model": args.model, "threads": args.threads}.items() if value})
+    config.pop("socket", None)
+    backend_name = config.pop("backend", "pipeline")
+    if backend_name == "remote":
+        parser.error("The sidecar needs a local backend")
+    generator = create_backend(backend_name, config.pop("model", GENERATOR_MODEL), **config)
+
+    from rag_engine import RagEngine
+    if args.embedding_model == "hashing":
+        from benchmark import HashingEmbedder
+        engine = RagEngine(args.embedding_model, embedder=HashingEmbedder())
+    else:
+        engine = RagEngine(args.embedding_model)
+
+    InferenceSidecar(generator, engine, socket_path=args.socket).serve_forever()
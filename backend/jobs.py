@@ -0,0 +1,113 @@
+import os
+import time
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Analyses running at once, and how many more may wait before submissions are refused
+ANALYSIS_WORKERS = int(os.environ.get("CIA_ANALYSIS_WORKERS", "2"))
+ANALYSIS_QUEUE_DEPTH = int(os.environ.get("CIA_ANALYSIS_QUEUE_DEPTH", "8"))
+# Finished jobs kept for status/result lookups
+KEEP_FINISHED_JOBS = 256
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at its depth limit"""
+
+
+class Job:
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future: Optional[Future] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def set_progress(self, stage: str, progress: float):
+        self.stage = stage
+        self.progress = progress
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """Runs blocking jobs on a bounded thread pool with a queue-depth limit"""
+
+    def __init__(self, max_workers: int = ANALYSIS_WORKERS, max_queued: int = ANALYSIS_QUEUE_DEPTH,
+                 keep_finished: int = KEEP_FINISHED_JOBS):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def active_count(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.done)
+
+    def submit(self, kind: str, func: Callable, *args, **kwargs) -> Job:
+        """Queue func(*args, progress=callback, **kwargs); raises QueueFullError when saturated"""
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if not job.done)
+            if active >= self.max_workers + self.max_queued:
+                raise QueueFullError(f"{active} jobs already running or queued")
+            job = Job(kind)
+            self._jobs[job.id] = job
+            self._prune()
+        job.future = self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job: Job, func: Callable, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = func(*args, progress=job.set_progress, **kwargs)
+            job.status = "succeeded"
+            job.set_progress("done", 1.0)
+            return job.result
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = "failed"
+            raise
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,358 @@
+import mmap
+import bisect
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utils import decode_bytes
+
+# Files above this size are diffed through line hashes instead of in-memory strings
+STREAMING_DIFF_BYTES = 8 * 1024 * 1024
+PREVIEW_LINES = 20
+CONTEXT_LINES = 3
+
+Opcode = Tuple[str, int, int, int, int]
+
+
+class EditLimitExceeded(Exception):
+    """The sequences need more single-line inserts and deletes than the search was allowed"""
+
+
+@contextmanager
+def mapped_file(file_path: str):
+    """Memory-map a file read-only; yields b"" for empty files"""
+    with open(file_path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            yield b""
+            return
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def hash_lines(buf) -> Tuple[array, array]:
+    """Return (line hashes, line start offsets) for a buffer, lines kept with their endings"""
+    hashes = array('q')
+    offsets = array('Q')
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        end = buf.find(b"\n", pos)
+        end = size if end < 0 else end + 1
+        hashes.append(hash(buf[pos:end]))
+        offsets.append(pos)
+        pos = end
+    offsets.append(size)
+    return hashes, offsets
+
+
+def _midpoint(a, b, left: int, top: int, right: int, bottom: int, max_edits: Optional[int] = None):
+    """Middle snake of the box, as ((x1, y1), (x2, y2)), or None for an empty box.
+
+    The snake at depth d splits a path of 2d - 1 or 2d edits, so with max_edits the search
+    stops, raising EditLimitExceeded, once d passes half of it.
+    """
+    width = right - left
+    height = bottom - top
+    size = width + height
+    if size == 0:
+        return None
+    delta = width - height
+    odd = delta % 2 != 0
+    max_d = (size + 1) // 2
+    if max_edits is not None and (max_edits + 1) // 2 < max_d:
+        max_d = (max_edits + 1) // 2
+        limited = True
+    else:
+        limited = False
+
+    if max_d < 0:
+        raise EditLimitExceeded()
+
+    vf = [0] * (2 * max_d + 2)
+    vb = [0] * (2 * max_d + 2)
+    vf[1] = left
+    vb[1] = bottom
+
+    for d in range(max_d + 1):
+        # Forward search
+        for k in range(d, -d - 1, -2):
+            c = k - delta
+            if k == -d or (k != d and vf[k - 1] < vf[k + 1]):
+                px = x = vf[k + 1]
+            else:
+                px = vf[k - 1]
+                x = px + 1
+            y = top + (x - left) - k
+            py = y if (d == 0 or x != px) else y - 1
+            while x < right and y < bottom and a[x] == b[y]:
+                x += 1
+                y += 1
+            vf[k] = x
+            if odd and -(d - 1) <= c <= d - 1 and y >= vb[c]:
+                return (px, py), (x, y)
+
+        # Backward search
+        for c in range(d, -d - 1, -2):
+            k = c + delta
+            if c == -d or (c != d and vb[c - 1] > vb[c + 1]):
+                py = y = vb[c + 1]
+            else:
+                py = vb[c - 1]
+                y = py - 1
+            x = left + (y - top) + k
+            px = x if (d == 0 or y != py) else x + 1
+            while x > left and y > top and a[x - 1] == b[y - 1]:
+                x -= 1
+                y -= 1
+            vb[c] = y
+            if not odd and -d <= k <= d and x <= vf[k]:
+                return (x, y), (px, py)
+    if limited:
+        raise EditLimitExceeded()
+    return None
+
+
+def _find_path(a, b, left: int, top: int, right: int, bottom: int,
+               max_edits: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Points of a shortest edit path through the box, found in linear space"""
+    path = []
+    # Each box splits around its middle snake into a head box and a tail box;
+    # an empty box contributes its corner point. The boxes' edits add up to the whole
+    # path's, so only the first search needs the limit.
+    stack = [(left, top, right, bottom)]
+    while stack:
+        box_left, box_top, box_right, box_bottom = stack.pop()
+        snake = _midpoint(a, b, box_left, box_top, box_right, box_bottom, max_edits)
+        max_edits = None
+        if snake is None:
+            path.append((box_left, box_top))
+            continue
+        (start_x, start_y), (finish_x, finish_y) = snake
+        stack.append((finish_x, finish_y, box_right, box_bottom))
+        stack.append((box_left, box_top, start_x, start_y))
+    return path
+
+
+def _edit_steps(a, b, max_edits: Optional[int] = None,
+                anchors: Optional[List[Tuple[int, int]]] = None) -> Iterator[Opcode]:
+    """Single-line equal/delete/insert steps along an edit path.
+
+    Lines unique to both sides anchor the path, as in patience diff, and the gaps between
+    anchors get a shortest edit path each, so scattered edits to a long file cost about
+    the sum of the gaps' squares rather than the whole length times the edits.
+    """
+    n, m = len(a), len(b)
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and a[n - 1 - suffix] == b[m - 1 - suffix]:
+        suffix += 1
+
+    if prefix:
+        yield ("equal", 0, prefix, 0, prefix)
+
+    if anchors is None:
+        anchors, _ = unique_matches(a, b)
+    inside = [(i, j) for i, j in anchors if prefix <= i < n - suffix and prefix <= j < m - suffix]
+    path = []
+    x, y = prefix, prefix
+    for i, j in inside + [(n - suffix, m - suffix)]:
+        gap = _find_path(a, b, x, y, i, j, max_edits)
+        if max_edits is not None:
+            max_edits -= sum(abs((x2 - x1) - (y2 - y1)) for (x1, y1), (x2, y2) in zip(gap, gap[1:]))
+        path.extend(gap)
+        x, y = i + 1, j + 1
+    for (x1, y1), (x2, y2) in zip(path, path[1:]):
+        # Leading diagonal, at most one horizontal/vertical step, trailing diagonal
+        while x1 < x2 and y1 < y2 and a[x1] == b[y1]:
+            yield ("equal", x1, x1 + 1, y1, y1 + 1)
+            x1 += 1
+            y1 += 1
+        if x2 - x1 > y2 - y1:
+            yield ("delete", x1, x1 + 1, y1, y1)
+            x1 += 1
+        elif x2 - x1 < y2 - y1:
+            yield ("insert", x1, x1, y1, y1 + 1)
+            y1 += 1
+        while x1 < x2 and y1 < y2:
+            yield ("equal", x1, x1 + 1, y1, y1 + 1)
+            x1 += 1
+            y1 += 1
+
+    if suffix:
+        yield ("equal", n - suffix, n, m - suffix, m)
+
+
+def diff_opcodes(a, b, max_edits: Optional[int] = None,
+                 anchors: Optional[List[Tuple[int, int]]] = None) -> Iterator[Opcode]:
+    """Yield difflib-style opcodes for two sequences of line hashes.
+
+    With max_edits, raises EditLimitExceeded if the sequences need more single-line
+    inserts and deletes than that. anchors is unique_matches' result, if already known.
+    """
+    current = None
+    for tag, i1, i2, j1, j2 in _edit_steps(a, b, max_edits, anchors):
+        if current is None:
+            current = (tag, i1, i2, j1, j2)
+            continue
+        if (tag == "equal") == (current[0] == "equal"):
+            # Adjacent runs of the same kind; mixed deletes/inserts become a replace
+            _, ci1, _, cj1, _ = current
+            if tag != "equal":
+                if ci1 == i2:
+                    tag = "insert"
+                elif cj1 == j2:
+                    tag = "delete"
+                else:
+                    tag = "replace"
+            current = (tag, ci1, i2, cj1, j2)
+            continue
+        yield current
+        current = (tag, i1, i2, j1, j2)
+    if current:
+        yield current
+
+
+def _grouped_opcodes(codes: List[Opcode], n: int = CONTEXT_LINES) -> Iterator[List[Opcode]]:
+    """Same grouping as SequenceMatcher.get_grouped_opcodes"""
+    codes = list(codes)
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unique_matches(a, b) -> Tuple[List[Tuple[int, int]], int]:
+    """(anchors, repeated) for two line sequences, in O(n log n).
+
+    anchors are the (old, new) positions of the longest in-order run of lines that occur
+    once on each side, as patience diff pairs them; repeated is how many occurrences of
+    the other lines the two sides have in common. No edit path matches more lines than
+    len(anchors) + repeated, since lines unique to both sides can only be matched in order.
+    """
+    counts_a, counts_b = Counter(a), Counter(b)
+    position = {line: i for i, line in enumerate(a) if counts_a[line] == 1}
+    pairs = [(position[line], j) for j, line in enumerate(b) if counts_b[line] == 1 and line in position]
+    # Longest increasing run of old positions, with back links to recover it
+    tails: List[int] = []
+    tail_pairs: List[int] = []
+    back = [-1] * len(pairs)
+    for p, (i, _) in enumerate(pairs):
+        at = bisect.bisect_left(tails, i)
+        if at:
+            back[p] = tail_pairs[at - 1]
+        if at == len(tails):
+            tails.append(i)
+            tail_pairs.append(p)
+        else:
+            tails[at] = i
+            tail_pairs[at] = p
+    anchors = []
+    p = tail_pairs[-1] if tail_pairs else -1
+    while p >= 0:
+        anchors.append(pairs[p])
+        p = back[p]
+    anchors.reverse()
+    repeated = sum(min(count, counts_b[line]) for line, count in counts_a.items()
+                   if line in counts_b and (count > 1 or counts_b[line] > 1))
+    return anchors, repeated
+
+
+def diff_files(old_path: str, new_path: str, preview_lines: int = PREVIEW_LINES,
+               min_ratio: Optional[float] = None) -> Optional[Dict]:
+    """Line-level diff of two files without loading their text.
+
+    Returns the same fields as diff_detector.get_detailed_diff, plus a line-based
+    similarity ratio. Peak memory is proportional to the line count.
+    With min_ratio, returns None as soon as the ratio cannot exceed it: the ratio is
+    1 - edits / lines, so the edit search is cut off at (1 - min_ratio) * lines edits.
+    """
+    with mapped_file(old_path) as old_buf, mapped_file(new_path) as new_buf:
+        old_hashes, old_offsets = hash_lines(old_buf)
+        new_hashes, new_offsets = hash_lines(new_buf)
+        total = len(old_hashes) + len(new_hashes)
+        anchors, repeated = unique_matches(old_hashes, new_hashes)
+        max_edits = None
+        if min_ratio is not None:
+            # Upper bound on the ratio, telling reordered content apart without an edit search
+            if total and 2.0 * (len(anchors) + repeated) / total <= min_ratio:
+                return None
+            max_edits = int((1 - min_ratio) * total)
+
+        preview: List[str] = []
+        additions = deletions = 0
+
+        def add_preview(line: str):
+            if len(preview) < preview_lines:
+                preview.append(line)
+
+        def add_lines(prefix: str, buf, offsets, start: int, stop: int):
+            for i in range(start, min(stop, start + preview_lines - len(preview))):
+                add_preview(prefix + decode_bytes(buf[offsets[i]:offsets[i + 1]]))
+
+        try:
+            opcodes = list(diff_opcodes(old_hashes, new_hashes, max_edits, anchors))
+        except EditLimitExceeded:
+            return None
+        matched = sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == "equal")
+
+        started = False
+        for group in _grouped_opcodes(opcodes):
+            if not started:
+                # The file headers start with -/+ and are counted like get_detailed_diff does
+                started = True
+                add_preview("--- ")
+                add_preview("+++ ")
+                additions += 1
+                deletions += 1
+            first, last = group[0], group[-1]
+            add_preview(f"@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@")
+            for tag, i1, i2, j1, j2 in group:
+                if tag == "equal":
+                    add_lines(" ", old_buf, old_offsets, i1, i2)
+                    continue
+                if tag in ("replace", "delete"):
+                    deletions += i2 - i1
+                    add_lines("-", old_buf, old_offsets, i1, i2)
+                if tag in ("replace", "insert"):
+                    additions += j2 - j1
+                    add_lines("+", new_buf, new_offsets, j1, j2)
+
+        return {
+            "additions": additions,
+            "deletions": deletions,
+            "diff_preview": "".join(preview),
+            "ratio": 2.0 * matched / total if total else 1.0,
+        }
@@ -1,49 +1,113 @@
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
-import torch
+from transformers import TextIteratorStreamer
+import os
 import logging
-from typing import List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Dict, Optional
+
+from context_assembly import CONTEXT_TOKEN_BUDGET, context_line, pack_contexts
+from inference_backends import SHARED_PROMPT_PREFIX, create_backend, inference_config
+from response_cache import ResponseCache, response_key
 
 logger = logging.getLogger(__name__)
 
+GENERATOR_MODEL = "mistralai/Mistral-7B-Instruct-v0.1"
+# Part of the response cache key, so changing them invalidates cached analyses
+GENERATION_PARAMS = {"max_new_tokens": 400, "min_new_tokens": 100, "do_sample": False}
+# Per-part summaries in map-reduce mode are kept short so several fit in one reduce prompt
+MAP_PARAMS = {"max_new_tokens": 160, "do_sample": False}
+
+# Prompts longer than this (in tokens) are split into map prompts and summarized first
+PROMPT_TOKEN_BUDGET = int(os.environ.get("CIA_PROMPT_TOKEN_BUDGET", "1536"))
+# Map prompts per generator call, and generator calls in flight at once
+MAP_BATCH_SIZE = int(os.environ.get("CIA_MAP_BATCH_SIZE", "4"))
+MAP_WORKERS = int(os.environ.get("CIA_MAP_WORKERS", "1"))
+# Rounds of folding partial analyses together before the final reduce prompt is used as is
+MAX_REDUCE_ROUNDS = 4
+# Room left in each map prompt for the part numbers in its header
+HEADER_SLACK_TOKENS = 8
+
+
+def group_by_token_budget(lines: List[str], count_tokens: Callable[[str], int], budget: int) -> List[List[str]]:
+    """Pack lines, in order, into groups whose token counts add up to at most budget.
+
+    A line that alone exceeds the budget becomes a group of its own.
+    """
+    groups = []
+    current, used = [], 0
+    for line in lines:
+        tokens = count_tokens(line)
+        if current and used + tokens > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append(line)
+        used += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def generation_params(n_differences: int) -> Dict:
+    """Scale the output length with the change set, up to GENERATION_PARAMS"""
+    max_new_tokens = min(GENERATION_PARAMS["max_new_tokens"], 120 + 40 * n_differences)
+    return {
+        **GENERATION_PARAMS,
+        "max_new_tokens": max_new_tokens,
+        "min_new_tokens": min(GENERATION_PARAMS["min_new_tokens"], max_new_tokens // 2),
+    }
+
+
 class LlamaAnalyzer:
-    def __init__(self, model_name="microsoft/DialoGPT-medium"):
-        """Initialize with a lighter model for demo purposes"""
+    def __init__(self, model_name="microsoft/DialoGPT-medium", response_cache: Optional[ResponseCache] = None,
+                 config: Optional[Dict] = None):
+        """Initialize the generator selected by the "inference" config section"""
+        config = dict(inference_config() if config is None else config)
+        self.backend_name = config.pop("backend", "pipeline")
+        self.model_id = config.pop("model", GENERATOR_MODEL)
+        self.prompt_token_budget = int(config.pop("prompt_token_budget", PROMPT_TOKEN_BUDGET))
+        self.map_batch_size = int(config.pop("map_batch_size", MAP_BATCH_SIZE))
+        self.map_workers = int(config.pop("map_workers", MAP_WORKERS))
+        self.context_token_budget = int(config.pop("context_token_budget", CONTEXT_TOKEN_BUDGET))
+        self.response_cache = response_cache or ResponseCache()
         try:
-            # Use a lighter model for demo - replace with LLaMA when available
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
-            logger.info(f"Using device: {self.device}")
-            
-            # For demo purposes, using a text generation model
             # Replace with actual LLaMA model: "meta-llama/Llama-2-7b-chat-hf"
-            self.generator = pipeline(
-                "text-generation",
-                model="mistralai/Mistral-7B-Instruct-v0.1",
-                device=0 if self.device == "cuda" else -1
-            )
-
+            self.generator = create_backend(self.backend_name, self.model_id, **config)
+            # The remote backend serves whatever model its sidecar loaded
+            self.model_id = self.generator.model_name
+            # Never plan prompts the model could not fit alongside its answer
+            context_window = self.generator.tokenizer.model_max_length
+            if context_window < 1_000_000:  # tokenizers without a limit report a huge sentinel
+                self.prompt_token_budget = min(self.prompt_token_budget,
+                                               context_window - GENERATION_PARAMS["max_new_tokens"])
             
-            logger.info("LLaMA Analyzer initialized successfully")
+            logger.info(f"LLaMA Analyzer initialized successfully ({self.backend_name} backend)")
             
         except Exception as e:
             logger.error(f"Error initializing LLaMA model: {str(e)}")
             # Fallback to simple text analysis
             self.generator = None
     
+    @property
+    def cache_model_id(self) -> str:
+        """Quantized output can differ from full precision, so backends do not share cache entries"""
+        return f"{self.model_id}:{self.backend_name}"
+    
+    def inference_stats(self) -> Dict:
+        if not self.generator:
+            return {"backend": None, "model": self.model_id}
+        return self.generator.stats()
+    
     def analyze_impact(self, differences: List[Dict], related_contexts: List[Dict]) -> str:
         """Analyze the impact of document changes"""
         try:
-            # Create analysis prompt
-            prompt = self._create_analysis_prompt(differences, related_contexts)
-            
             if self.generator:
-                # Use AI model for analysis
-                response = self.generator(
-                    prompt,
-                    max_length=400,
-                    min_length=100,
-                    do_sample=False
-                )
-                return response[0]['summary_text'].strip()
+                # Create analysis prompt, summarizing oversized change sets first
+                prompt = self._plan_prompt(differences, related_contexts)
+                params = generation_params(len(differences))
+                
+                # Use AI model for analysis; identical prompts are served from the cache
+                key = response_key(self.cache_model_id, params, prompt)
+                return self.response_cache.get_or_compute(key, lambda: self._generate(prompt, params))
             else:
                 # Fallback to rule-based analysis
                 return self._rule_based_analysis(differences, related_contexts)
@@ -52,22 +116,178 @@ class LlamaAnalyzer:
             logger.error(f"Error in impact analysis: {str(e)}")
             return self._rule_based_analysis(differences, related_contexts)
     
+    def _generate(self, prompt: str, params: Dict) -> str:
+        return self.generator.generate(prompt, **params)
+    
+    def count_tokens(self, text: str) -> int:
+        if not self.generator:
+            return len(text) // 4  # rough estimate for the rule-based fallback
+        return self.generator.count_tokens(text)
+    
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if not self.generator:
+            return text[:max_tokens * 4]
+        return self.generator.truncate(text, max_tokens)
+    
+    def select_contexts(self, candidates: List[Dict], budget: Optional[int] = None) -> List[Dict]:
+        """Best-first passages that fit the context token budget, measured with this model's tokenizer"""
+        return pack_contexts(candidates, self.count_tokens, self.truncate,
+                             self.context_token_budget if budget is None else budget)
+    
+    def _plan_prompt(self, differences: List[Dict], related_contexts: List[Dict]) -> str:
+        """The single analysis prompt if it fits the token budget, otherwise a map-reduce.
+
+        Map: the change lines are packed into budget-sized parts, each summarized on its own.
+        Reduce: the part summaries (folded together again while they do not fit) become the
+        prompt for the final analysis.
+        """
+        prompt = self._create_analysis_prompt(differences, related_contexts)
+        if self.count_tokens(prompt) <= self.prompt_token_budget:
+            return prompt
+        
+        lines = self._change_lines(differences)
+        budget = self.prompt_token_budget - self.count_tokens(self._map_prompt([], 1, 1)) - HEADER_SLACK_TOKENS
+        groups = group_by_token_budget(lines, self.count_tokens, budget)
+        logger.info(f"{len(differences)} changes exceed the {self.prompt_token_budget}-token prompt budget, "
+                    f"analyzing them in {len(groups)} parts")
+        summaries = self._run_map([self._map_prompt(group, i, len(groups)) for i, group in enumerate(groups, 1)])
+        
+        for _ in range(MAX_REDUCE_ROUNDS):
+            prompt = self._reduce_prompt(self._summary_lines(summaries), related_contexts)
+            if len(summaries) == 1 or self.count_tokens(prompt) <= self.prompt_token_budget:
+                return prompt
+            budget = self.prompt_token_budget - self.count_tokens(self._fold_prompt([]))
+            groups = group_by_token_budget(self._summary_lines(summaries), self.count_tokens, budget)
+            if len(groups) == len(summaries):
+                break  # summaries too long to pair up; trimming below is all that is left
+            summaries = self._run_map([self._fold_prompt(group) for group in groups])
+        
+        # Give every remaining summary an equal share of what the budget leaves
+        room = self.prompt_token_budget - self.count_tokens(self._reduce_prompt([], related_contexts))
+        share = max(1, room // len(summaries) - HEADER_SLACK_TOKENS)
+        summaries = [self.generator.truncate(summary, share) for summary in summaries]
+        return self._reduce_prompt(self._summary_lines(summaries), related_contexts)
+    
+    def _run_map(self, prompts: List[str]) -> List[str]:
+        """Summaries for the given prompts, generated in batches; cached per prompt"""
+        keys = [response_key(self.cache_model_id, MAP_PARAMS, prompt) for prompt in prompts]
+        results = [self.response_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        batches = [missing[i:i + self.map_batch_size] for i in range(0, len(missing), self.map_batch_size)]
+        
+        def run_batch(batch: List[int]) -> List[str]:
+            return self.generator.generate_batch([prompts[i] for i in batch], batch_size=len(batch), **MAP_PARAMS)
+        
+        if self.map_workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=self.map_workers, thread_name_prefix="impact-map") as pool:
+                outputs = list(pool.map(run_batch, batches))
+        else:
+            outputs = [run_batch(batch) for batch in batches]
+        
+        for batch, texts in zip(batches, outputs):
+            for i, text in zip(batch, texts):
+                results[i] = text
+                self.response_cache.put(keys[i], text)
+        return results
+    
+    def stream_impact(self, differences: List[Dict], related_contexts: List[Dict]) -> Iterator[str]:
+        """Yield the impact analysis text as the model generates it"""
+        if not self.generator:
+            yield self._rule_based_analysis(differences, related_contexts)
+            return
+        
+        try:
+            prompt = self._plan_prompt(differences, related_contexts)
+        except Exception as e:
+            logger.error(f"Error in impact analysis: {str(e)}")
+            yield self._rule_based_analysis(differences, related_contexts)
+            return
+        params = generation_params(len(differences))
+        key = response_key(self.cache_model_id, params, prompt)
+        
+        def produce() -> Iterator[str]:
+            streamer = TextIteratorStreamer(self.generator.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            errors = []
+            
+            def generate():
+                try:
+                    self.generator.generate(prompt, streamer=streamer, **params)
+                except Exception as e:
+                    errors.append(e)
+                    streamer.end()  # unblock the consumer
+            
+            thread = threading.Thread(target=generate, daemon=True)
+            thread.start()
+            for text in streamer:
+                if text:
+                    yield text
+            thread.join()
+            if errors:
+                raise errors[0]
+        
+        # Shares one generation with concurrent identical requests, streamed or not
+        streamed = False
+        try:
+            for text in self.response_cache.stream_or_compute(key, produce):
+                streamed = True
+                yield text
+        except Exception as e:
+            logger.error(f"Error in streamed impact analysis: {str(e)}")
+            if not streamed:
+                yield self._rule_based_analysis(differences, related_contexts)
+    
     def _create_analysis_prompt(self, differences: List[Dict], related_contexts: List[Dict]) -> str:
         """Create structured prompt for LLaMA"""
-        prompt = "Document Change Impact Analysis:\n\n"
+        prompt = SHARED_PROMPT_PREFIX
         
         prompt += "CHANGES DETECTED:\n"
-        for i, diff in enumerate(differences, 1):
-            prompt += f"{i}. {diff['description']} (Type: {diff['type']})\n"
+        prompt += "".join(self._change_lines(differences))
         
-        prompt += "\nRELATED DOCUMENTS:\n"
-        for i, context in enumerate(related_contexts[:3], 1):  # Limit to top 3
-            prompt += f"{i}. {context['file_name']}: {context['content'][:100]}...\n"
+        prompt += self._context_section(related_contexts)
         
         prompt += "\nANALYSIS:\nProvide impact assessment and recommendations:"
         
         return prompt
     
+    def _change_lines(self, differences: List[Dict]) -> List[str]:
+        return [f"{i}. {diff['description']} (Type: {diff['type']})\n" for i, diff in enumerate(differences, 1)]
+    
+    def _summary_lines(self, summaries: List[str]) -> List[str]:
+        # Re-encoded output can come to more tokens than were generated; keep each to its budget
+        cap = MAP_PARAMS["max_new_tokens"]
+        return [f"Part {i}: {self.generator.truncate(summary, cap)}\n" for i, summary in enumerate(summaries, 1)]
+    
+    def _context_section(self, related_contexts: List[Dict]) -> str:
+        """Related passages, already ranked and packed to the budget by select_contexts"""
+        section = "\nRELATED DOCUMENTS:\n"
+        for i, context in enumerate(related_contexts, 1):
+            section += f"{i}. {context_line(context)}"
+        return section
+    
+    def _map_prompt(self, change_lines: List[str], part: int, parts: int) -> str:
+        """Summarize one part of a large change set; related documents are left to the reduce pass"""
+        prompt = SHARED_PROMPT_PREFIX
+        prompt += f"CHANGES DETECTED (part {part} of {parts}):\n"
+        prompt += "".join(change_lines)
+        prompt += "\nANALYSIS:\nSummarize the impact of these changes in a few sentences:"
+        return prompt
+    
+    def _fold_prompt(self, summary_lines: List[str]) -> str:
+        """Merge several part summaries into one when they are too long to reduce together"""
+        prompt = SHARED_PROMPT_PREFIX
+        prompt += "PARTIAL ANALYSES:\n"
+        prompt += "".join(summary_lines)
+        prompt += "\nANALYSIS:\nCombine these into one short impact summary:"
+        return prompt
+    
+    def _reduce_prompt(self, summary_lines: List[str], related_contexts: List[Dict]) -> str:
+        prompt = SHARED_PROMPT_PREFIX
+        prompt += "PARTIAL ANALYSES:\n"
+        prompt += "".join(summary_lines)
+        prompt += self._context_section(related_contexts)
+        prompt += "\nANALYSIS:\nProvide impact assessment and recommendations:"
+        return prompt
+    
     def _rule_based_analysis(self, differences: List[Dict], related_contexts: List[Dict]) -> str:
         """Fallback rule-based analysis"""
         analysis = "## Impact Analysis Report\n\n"
@@ -0,0 +1,209 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+from line_diff import STREAMING_DIFF_BYTES, mapped_file
+from metrics import BYTES_READ, CACHE_REQUESTS
+from sketch_index import build_sketch, merge_sketches
+from tree_walker import (BINARY_SNIFF_BYTES, FILES_SKIPPED, IO_WORKERS, FileInfo, looks_binary,
+                         over_size_limit, walk_tree)
+from utils import decode_bytes, get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+# Read size for fingerprinting files above STREAMING_DIFF_BYTES
+CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def content_digest(data: bytes) -> str:
+    """BLAKE2b digest used to identify file content"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _fingerprint_file(file_path: str, size: int) -> Tuple[str, list, bool]:
+    """Digest, sketch and binary flag of a file; large files are processed in mapped chunks.
+
+    Binary files get no sketch, since their shingles mean nothing to similarity matching.
+    """
+    if size <= STREAMING_DIFF_BYTES:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        if looks_binary(data[:BINARY_SNIFF_BYTES]):
+            return content_digest(data), [], True
+        return content_digest(data), list(build_sketch(decode_bytes(data))), False
+
+    hasher = hashlib.blake2b(digest_size=16)
+    sketch = ()
+    with mapped_file(file_path) as buf:
+        binary = looks_binary(buf[:BINARY_SNIFF_BYTES])
+        pos = 0
+        while pos < len(buf):
+            # Cut chunks at line breaks so shingles are only lost at chunk edges
+            end = buf.find(b"\n", pos + CHUNK_BYTES)
+            end = len(buf) if end < 0 else end + 1
+            chunk = buf[pos:end]
+            hasher.update(chunk)
+            if not binary:
+                sketch = merge_sketches(sketch, build_sketch(decode_bytes(chunk)))
+            pos = end
+    return hasher.hexdigest(), list(sketch), binary
+
+
+def _write_json_atomic(path: str, payload: Dict):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def _manifest_path(folder: str) -> str:
+    key = hashlib.blake2b(os.path.abspath(folder).encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(get_cache_dir("manifests"), f"{key}.json")
+
+
+def load_manifest(folder: str) -> Dict[str, Dict]:
+    """Load the saved manifest entries for a folder, or an empty manifest"""
+    try:
+        with open(_manifest_path(folder), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("entries", {})
+
+
+def save_manifest(folder: str, entries: Dict[str, Dict]):
+    """Persist manifest entries for a folder"""
+    try:
+        _write_json_atomic(_manifest_path(folder), {
+            "version": MANIFEST_VERSION,
+            "folder": os.path.abspath(folder),
+            "entries": entries,
+        })
+    except OSError as e:
+        logger.warning(f"Could not save manifest for {folder}: {str(e)}")
+
+
+def build_manifest(folder: str, file_names: Iterable[str], persist: bool = True,
+                   workers: Optional[int] = None) -> Dict[str, Dict]:
+    """Return path, size, mtime, digest, sketch and binary flag for every regular file in file_names.
+
+    file_names are relative to folder. Files whose size and mtime match the saved manifest
+    are not read again; the others are read on up to workers threads (default IO_WORKERS).
+    """
+    files = {}
+    for file_name in file_names:
+        file_path = os.path.join(folder, file_name)
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            logger.error(f"Error reading file {file_path}: {str(e)}")
+            continue
+        if os.path.isfile(file_path):
+            files[file_name] = FileInfo(file_path, stat.st_size, stat.st_mtime_ns, over_size_limit(stat.st_size))
+    return _build_entries(folder, files, persist, workers)
+
+
+def scan_folder(folder: str, persist: bool = True, workers: Optional[int] = None, **walk_options) -> Dict[str, Dict]:
+    """Manifest of every file in the tree under folder, keyed by relative POSIX path.
+
+    One walk (see tree_walker.iter_tree for walk_options) whose stat results are reused,
+    so the differ and the indexer can share a single pass over a folder.
+    """
+    return _build_entries(folder, walk_tree(folder, **walk_options), persist, workers)
+
+
+def _fingerprint_entry(info: FileInfo) -> Dict:
+    if info.too_large:
+        # Not read: the digest only tells size and mtime apart, and "skipped" keeps it out of
+        # diffing and indexing
+        return {
+            "path": info.path,
+            "size": info.size,
+            "mtime_ns": info.mtime_ns,
+            "digest": content_digest(f"too_large {info.size} {info.mtime_ns}".encode("utf-8")),
+            "sketch": [],
+            "binary": False,
+            "skipped": "too_large",
+        }
+    try:
+        digest, sketch, binary = _fingerprint_file(info.path, info.size)
+        BYTES_READ.inc(info.size, component="manifest")
+    except Exception as e:
+        logger.error(f"Error reading file {info.path}: {str(e)}")
+        digest, sketch, binary = content_digest(b""), [], False
+    return {
+        "path": info.path,
+        "size": info.size,
+        "mtime_ns": info.mtime_ns,
+        "digest": digest,
+        "sketch": sketch,
+        "binary": binary,
+    }
+
+
+def _build_entries(folder: str, files: Dict[str, FileInfo], persist: bool, workers: Optional[int]) -> Dict[str, Dict]:
+    previous = load_manifest(folder) if persist else {}
+    entries = {}
+    pending = []
+
+    for file_name in sorted(files):
+        info = files[file_name]
+        cached = previous.get(file_name)
+        if (cached and cached["size"] == info.size and cached["mtime_ns"] == info.mtime_ns
+                and bool(cached.get("skipped")) == info.too_large):
+            entries[file_name] = cached
+            CACHE_REQUESTS.inc(cache="manifest", result="hit")
+        else:
+            entries[file_name] = None  # keeps the sorted order
+            pending.append(file_name)
+            CACHE_REQUESTS.inc(cache="manifest", result="miss")
+
+    # Reads and hashing overlap across threads; blake2b releases the GIL on large buffers
+    workers = min(workers or IO_WORKERS, len(pending))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manifest") as pool:
+            fingerprints = pool.map(_fingerprint_entry, [files[name] for name in pending])
+            entries.update(zip(pending, fingerprints))
+    else:
+        entries.update((name, _fingerprint_entry(files[name])) for name in pending)
+
+    binary = sum(1 for entry in entries.values() if entry["binary"])
+    if binary:
+        FILES_SKIPPED.inc(binary, reason="binary")
+    if persist:
+        save_manifest(folder, entries)
+    logger.info(f"Manifest for {folder}: {len(entries)} files ({binary} binary), "
+                f"{len(entries) - len(pending)} unchanged since last run")
+    return entries
+
+
+class DiffCache:
+    """On-disk cache of diff results keyed by (old digest, new digest)"""
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir or get_cache_dir("diffs")
+
+    def _path(self, old_digest: str, new_digest: str) -> str:
+        return os.path.join(self.cache_dir, old_digest[:2], f"{old_digest}_{new_digest}.json")
+
+    def get(self, old_digest: str, new_digest: str) -> Optional[Dict]:
+        try:
+            with open(self._path(old_digest, new_digest), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, old_digest: str, new_digest: str, result: Dict):
+        path = self._path(old_digest, new_digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_json_atomic(path, result)
+        except OSError as e:
+            logger.warning(f"Could not cache diff result: {str(e)}")
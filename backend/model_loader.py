@@ -0,0 +1,68 @@
+import time
+import threading
+import logging
+from typing import Any, Callable, Dict, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModel:
+    """A model built on first use or warmed up on a background thread, whichever comes first"""
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+        self.state = "not_loaded"
+        self.error = None
+        self.load_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        return self._value is not None
+
+    def get(self):
+        """Return the model, loading it (or waiting for the warm-up) if needed"""
+        if self._value is not None:
+            return self._value
+        with self._lock:
+            if self._value is None:
+                self.state = "loading"
+                start = time.time()
+                logger.info(f"Loading {self.name}...")
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self.state = "failed"
+                    self.error = str(e)
+                    logger.error(f"Failed to load {self.name}: {str(e)}")
+                    raise
+                self.load_seconds = time.time() - start
+                self.state = "ready"
+                self.error = None
+                logger.info(f"{self.name} loaded in {self.load_seconds:.1f}s")
+        return self._value
+
+    def warm_up(self):
+        """Start loading on a daemon thread"""
+        warm_up_in_order([self])
+
+    def status(self) -> Dict:
+        return {"state": self.state, "error": self.error, "load_seconds": self.load_seconds}
+
+
+def warm_up_in_order(models: Sequence[LazyModel]):
+    """Load models one after another on a daemon thread.
+
+    Models whose factories import torch must not load side by side: two threads importing
+    it at once see each other's half-initialized modules and both fail.
+    """
+    def load():
+        for model in models:
+            try:
+                model.get()
+            except Exception:
+                pass  # already logged; the next get() retries
+
+    threading.Thread(target=load, name="warm-up-" + "-".join(model.name for model in models), daemon=True).start()
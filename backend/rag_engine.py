@@ -2,87 +2,492 @@ from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import os
-from typing import List, Dict
+import json
+import hashlib
+import shutil
+import threading
+from typing import Iterable, List, Dict, Optional, Tuple
 import logging
 
+from chunker import CHUNK_OVERLAP, CHUNK_WINDOW, iter_file_chunks, iter_folder_chunks
+from context_assembly import CONTEXT_CANDIDATES, assemble_contexts
+from document_store import DocumentStore
+from index_backends import (
+    DEFAULT_EF_SEARCH, DEFAULT_NPROBE, IndexBuilder, configure_search, index_memory_bytes, normalize,
+    supports_removal
+)
+from embedding_cache import EmbeddingCache, get_embedding_cache, text_key
+from manifest import scan_folder
+from metrics import BYTES_READ, CACHE_REQUESTS, counter, span
+from utils import decode_bytes, get_cache_dir
+
 logger = logging.getLogger(__name__)
 
+INDEX_FILE = "index.faiss"
+METADATA_FILE = "metadata.json"
+# Chunks embedded per encode call while streaming a corpus into the index
+EMBED_BATCH_SIZE = 256
+# "auto" picks flat / hnsw / ivf_pq from the expected number of chunks
+INDEX_KIND = os.environ.get("CIA_INDEX_KIND", "auto")
+# Cached indexes kept on disk; the least recently used beyond this are deleted with their documents
+INDEX_CACHE_ENTRIES = int(os.environ.get("CIA_INDEX_CACHE_ENTRIES", "64"))
+# Chunk IDs are (document ID << CHUNK_ID_BITS) + chunk number within the document
+CHUNK_ID_BITS = 20
+CHUNK_NUMBER_MASK = (1 << CHUNK_ID_BITS) - 1
+
+DOCUMENTS_EMBEDDED = counter("cia_documents_embedded_total", "Texts run through the embedding model")
+
+def prune_index_cache(keep: int = INDEX_CACHE_ENTRIES):
+    """Delete all but the keep most recently used index-cache entries.
+
+    Engines already holding a pruned index keep working: its index and document segments
+    are mapped, and unlinked files stay readable until unmapped.
+    """
+    entries = []
+    for entry in os.scandir(get_cache_dir("indexes")):
+        if entry.is_dir() and not entry.name.endswith(".tmp"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+    for _, path in sorted(entries, reverse=True)[keep:]:
+        logger.info(f"Pruning cached index {os.path.basename(path)}")
+        shutil.rmtree(path, ignore_errors=True)
+
 class RagEngine:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
+    def __init__(self, model_name="all-MiniLM-L6-v2", embedding_cache: Optional[EmbeddingCache] = None,
+                 chunk_window: int = CHUNK_WINDOW, chunk_overlap: int = CHUNK_OVERLAP,
+                 index_kind: str = INDEX_KIND, nprobe: int = DEFAULT_NPROBE, ef_search: int = DEFAULT_EF_SEARCH,
+                 embedder=None):
         self.model_name = model_name
-        self.embedder = SentenceTransformer(model_name)
-        self.documents = []
-        self.file_names = []
+        # Anything with SentenceTransformer's encode(); benchmarks pass a model-free stand-in
+        self.embedder = embedder or SentenceTransformer(model_name)
+        self.embedding_cache = embedding_cache or get_embedding_cache(model_name)
+        # Fast tokenizers fail on concurrent use, so engines sharing an embedder share this lock
+        self.encode_lock = threading.Lock()
+        self.chunk_window = chunk_window
+        self.chunk_overlap = chunk_overlap
+        self.index_kind = index_kind
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.folder_path = None
+        # Document bytes and chunk spans; a chunk ID is resolved through its document ID
+        self.store = DocumentStore()
+        # Vectors of removed chunks still in indexes that cannot delete them (HNSW)
+        self.stale_vectors = 0
         self.index = None
+        # Cache file the index was memory-mapped from; mapped IVF lists are read-only
+        self.mapped_index_path = None
+        # corpus_fingerprint of the indexed folder contents, and the digest of each indexed file
+        self.fingerprint = None
+        self.digests: Optional[Dict[str, str]] = None
         logger.info(f"RAG Engine initialized with model: {model_name}")
     
-    def build_index(self, folder_path: str):
-        """Build FAISS index from documents in folder"""
+    def for_corpus(self) -> "RagEngine":
+        """An engine with no index that shares this one's model, caches and settings"""
+        engine = RagEngine(self.model_name, self.embedding_cache, self.chunk_window, self.chunk_overlap,
+                           self.index_kind, self.nprobe, self.ef_search, embedder=self.embedder)
+        engine.encode_lock = self.encode_lock
+        return engine
+    
+    def _encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        with self.encode_lock:
+            return np.asarray(self.embedder.encode(texts, **kwargs), dtype='float32')
+    
+    def embed_documents(self, documents: List[str]) -> np.ndarray:
+        """Embed documents, only encoding texts that are not in the embedding cache"""
+        keys = [text_key(doc) for doc in documents]
+        cached, missing = self.embedding_cache.get_many(keys)
+        logger.info(f"Embedding cache: {len(cached)} hits, {len(missing)} to encode")
+        CACHE_REQUESTS.inc(len(cached), cache="embedding", result="hit")
+        CACHE_REQUESTS.inc(len(missing), cache="embedding", result="miss")
+        
+        if missing:
+            with span("embedding"):
+                encoded = self._encode([documents[i] for i in missing], show_progress_bar=True)
+            DOCUMENTS_EMBEDDED.inc(len(missing))
+            self.embedding_cache.put_many([keys[i] for i in missing], encoded)
+            for i, vector in zip(missing, encoded):
+                cached[i] = vector
+        
+        return np.vstack([cached[i] for i in range(len(documents))]).astype('float32')
+    
+    def cache_stats(self) -> Dict:
+        """Embedding cache hit/miss counters"""
+        return self.embedding_cache.stats()
+    
+    def expected_chunks(self, manifest: Dict[str, Dict]) -> int:
+        """Estimate the number of chunks a folder will produce from its file sizes"""
+        stride = max(1, self.chunk_window - min(self.chunk_overlap, self.chunk_window // 2))
+        return sum(entry["size"] // stride + 1 for entry in manifest.values())
+    
+    def corpus_fingerprint(self, folder_path: str, manifest: Optional[Dict[str, Dict]] = None) -> str:
+        """Fingerprint of the folder contents, the embedding model and the index settings"""
+        manifest = manifest or scan_folder(folder_path)
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(
+            f"{self.model_name}\0{self.chunk_window}\0{self.chunk_overlap}\0{self.index_kind}".encode("utf-8")
+        )
+        for file_name in sorted(manifest):
+            hasher.update(f"\0{file_name}\0{manifest[file_name]['digest']}".encode("utf-8"))
+        return hasher.hexdigest()
+    
+    def _cache_path(self, fingerprint: str) -> str:
+        return os.path.join(get_cache_dir("indexes"), fingerprint)
+    
+    def save_index(self, fingerprint: str):
+        """Write the index and its document metadata to the index cache"""
+        path = self._cache_path(fingerprint)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(tmp_path, INDEX_FILE))
+        with open(os.path.join(tmp_path, METADATA_FILE), 'w') as f:
+            json.dump({
+                "model_name": self.model_name,
+                "stale_vectors": self.stale_vectors,
+                "digests": self.digests,
+            }, f)
+        self.store.save(tmp_path)
         try:
-            documents = []
-            file_names = []
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process saved the same corpus first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        prune_index_cache()
+    
+    def load_index(self, fingerprint: str, folder_path: str) -> bool:
+        """Load a cached index for the fingerprint; returns False if there is none.
+
+        folder_path, whose contents match the fingerprint, is where later updates read from.
+        """
+        path = self._cache_path(fingerprint)
+        index_path = os.path.join(path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return False
+        try:
+            with open(os.path.join(path, METADATA_FILE), 'r') as f:
+                metadata = json.load(f)
+            store = DocumentStore.load(path)
+            mapped_index_path = index_path
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+            except RuntimeError:
+                # Not every index type supports mmap
+                index = faiss.read_index(index_path)
+                mapped_index_path = None
+        except Exception as e:
+            logger.warning(f"Could not load cached index {fingerprint}: {str(e)}")
+            return False
+        
+        try:
+            os.utime(path)  # recency for prune_index_cache
+        except OSError:
+            pass
+        configure_search(index, self.nprobe, self.ef_search)
+        self.index = index
+        self.mapped_index_path = mapped_index_path
+        self.folder_path = folder_path
+        self.store.close()
+        self.store = store
+        self.stale_vectors = metadata["stale_vectors"]
+        self.fingerprint = fingerprint
+        self.digests = metadata.get("digests")
+        logger.info(f"Loaded cached FAISS index {fingerprint} with {store.chunk_count} chunks")
+        return True
+    
+    def build_index(self, folder_path: str, use_cache: bool = True, manifest: Optional[Dict[str, Dict]] = None):
+        """Build FAISS index from documents in folder, reusing a cached index when the folder is unchanged.
+
+        manifest is the folder's scan_folder result when the caller already has it.
+        Binary files are not indexed.
+        """
+        try:
+            if manifest is None:
+                manifest = scan_folder(folder_path, persist=use_cache)
+            fingerprint = self.corpus_fingerprint(folder_path, manifest)
+            if use_cache and self.load_index(fingerprint, folder_path):
+                CACHE_REQUESTS.inc(cache="index", result="hit")
+                return
+            if use_cache:
+                CACHE_REQUESTS.inc(cache="index", result="miss")
             
-            for file_name in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, file_name)
-                if os.path.isfile(file_path):
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            if content.strip():  # Only add non-empty files
-                                documents.append(content)
-                                file_names.append(file_name)
-                    except Exception as e:
-                        logger.warning(f"Could not read file {file_name}: {str(e)}")
+            documents = {name: entry for name, entry in manifest.items()
+                         if not entry["binary"] and not entry.get("skipped")}
+            builder = IndexBuilder(self.index_kind, self.expected_chunks(documents), self.nprobe, self.ef_search)
+            logger.info(f"Building {builder.kind} index")
+            self.store.close()
+            self.store, self.stale_vectors = DocumentStore(), 0
+            self._add_chunks(
+                folder_path,
+                iter_folder_chunks(folder_path, self.chunk_window, self.chunk_overlap, file_names=documents),
+                builder.add
+            )
             
-            if not documents:
+            with span("index_training"):
+                index = builder.finish()
+            if index is None:
                 logger.warning("No documents found to index")
                 return
             
-            logger.info(f"Embedding {len(documents)} documents...")
-            embeddings = self.embedder.encode(documents, show_progress_bar=True)
+            self.index = index
+            self.mapped_index_path = None
+            self.folder_path = folder_path
+            self.fingerprint = fingerprint
+            self.digests = {name: entry["digest"] for name, entry in documents.items()}
             
-            # Create FAISS index
-            dimension = embeddings.shape[1]
-            self.index = faiss.IndexFlatL2(dimension)
-            self.index.add(np.array(embeddings).astype('float32'))
+            logger.info(f"FAISS index built with {self.store.chunk_count} chunks "
+                        f"from {self.store.document_count} documents")
             
-            self.documents = documents
-            self.file_names = file_names
-            
-            logger.info(f"FAISS index built with {len(documents)} documents")
+            if use_cache:
+                try:
+                    self.save_index(fingerprint)
+                except Exception as e:
+                    logger.warning(f"Could not cache FAISS index: {str(e)}")
             
         except Exception as e:
             logger.error(f"Error building index: {str(e)}")
             raise
     
+    def _add_chunks(self, folder_path: str, chunks, add_vectors):
+        """Embed chunks batch by batch and pass (vectors, chunk IDs) to add_vectors.
+
+        Each file's chunks arrive together; its bytes are copied into the document store
+        when its first chunk is seen.
+        """
+        texts, ids = [], []
+        file_name, doc_id = None, None
+        
+        def flush_batch():
+            add_vectors(self.embed_documents(texts), np.array(ids, dtype='int64'))
+            texts.clear()
+            ids.clear()
+        
+        # Chunks are streamed from disk and embedded batch by batch
+        for chunk in chunks:
+            if chunk.file_name != file_name:
+                file_name = chunk.file_name
+                doc_id = self.store.add_document(file_name, os.path.join(folder_path, file_name))
+            texts.append(chunk.text)
+            ids.append((doc_id << CHUNK_ID_BITS) + self.store.add_chunk(doc_id, chunk.offset, chunk.length))
+            if len(texts) >= EMBED_BATCH_SIZE:
+                flush_batch()
+        if texts:
+            flush_batch()
+        self.store.commit()
+    
+    def _ensure_writable(self):
+        """Re-read a memory-mapped index into memory before changing it.
+
+        IVF lists read with IO_FLAG_MMAP are read-only, and adding to or removing from them
+        aborts the process inside faiss rather than raising. If the cache entry was pruned
+        in the meantime, the mapped index is copied instead.
+        """
+        if self.mapped_index_path is None:
+            return
+        if os.path.exists(self.mapped_index_path):
+            index = faiss.read_index(self.mapped_index_path)
+        else:
+            index = faiss.deserialize_index(faiss.serialize_index(self.index))
+        configure_search(index, self.nprobe, self.ef_search)
+        self.index = index
+        self.mapped_index_path = None
+    
+    def remove_documents(self, file_names: Iterable[str]) -> int:
+        """Remove all chunks of the given documents; returns the number of chunks removed"""
+        self._ensure_writable()
+        removed = 0
+        for file_name in file_names:
+            dropped = self.store.remove(file_name)
+            if dropped is None:
+                continue
+            doc_id, chunks = dropped
+            if supports_removal(self.index):
+                self.index.remove_ids(faiss.IDSelectorRange(doc_id << CHUNK_ID_BITS, (doc_id + 1) << CHUNK_ID_BITS))
+            else:
+                # The vectors stay in the graph and are skipped at search time
+                self.stale_vectors += chunks
+            removed += chunks
+        return removed
+    
+    def add_documents(self, file_names: Iterable[str]):
+        """Chunk, embed and add documents from the indexed folder; each gets a new document ID"""
+        def chunks():
+            for file_name in file_names:
+                file_path = os.path.join(self.folder_path, file_name)
+                if os.path.isfile(file_path):
+                    yield from iter_file_chunks(file_path, file_name, self.chunk_window, self.chunk_overlap)
+        
+        self._ensure_writable()
+        self._add_chunks(self.folder_path, chunks(),
+                         lambda vectors, ids: self.index.add_with_ids(normalize(vectors), ids))
+    
+    def replace_documents(self, file_names: Iterable[str]):
+        """Re-index documents whose content changed"""
+        file_names = list(file_names)
+        self.remove_documents(file_names)
+        self.add_documents(file_names)
+    
+    def update_index(self, folder_path: str, changed_paths: List[str]) -> Dict:
+        """Apply changes to the indexed folder: changed or new files are re-indexed, missing ones removed.
+
+        What changed is decided by comparing the folder's manifest digests with the indexed
+        ones, so the index saved under the new fingerprint matches the whole folder;
+        changed_paths, what the caller saw change, is only checked against that.
+        """
+        if self.index is None or os.path.abspath(folder_path) != os.path.abspath(self.folder_path or "") \
+                or self.digests is None:
+            logger.info(f"No index for {folder_path} yet, building it")
+            self.build_index(folder_path)
+            return {"mode": "rebuild", "documents": self.store.document_count, "chunks": self.store.chunk_count}
+        
+        # Paths the walk leaves out (ignored, too large, binary) are dropped like deleted files
+        manifest = scan_folder(folder_path)
+        digests = {name: entry["digest"] for name, entry in manifest.items()
+                   if not entry["binary"] and not entry.get("skipped")}
+        existing = sorted(name for name, digest in digests.items() if self.digests.get(name) != digest)
+        missing = sorted(set(self.digests) - set(digests))
+        unreported = set(existing).union(missing) - set(changed_paths)
+        if unreported:
+            logger.info(f"{len(unreported)} changed files were not in the update request, re-indexing them too")
+        chunks_before = self.store.chunk_count
+        removed = self.remove_documents(missing)
+        self.replace_documents(existing)
+        
+        if self.stale_vectors:
+            logger.info(f"{self.stale_vectors} removed vectors are filtered at search time until the next rebuild")
+        
+        self.fingerprint = self.corpus_fingerprint(folder_path, manifest)
+        self.digests = digests
+        try:
+            self.save_index(self.fingerprint)
+        except Exception as e:
+            logger.warning(f"Could not cache FAISS index: {str(e)}")
+        
+        return {
+            "mode": "incremental",
+            "updated": len(existing),
+            "removed": len(missing),
+            "chunks_removed": removed,
+            "chunks": self.store.chunk_count,
+            "chunks_delta": self.store.chunk_count - chunks_before,
+        }
+    
+    def memory_bytes(self) -> int:
+        """Estimated memory held by the index and the document store's tables"""
+        if self.index is None:
+            return 0
+        return index_memory_bytes(self.index) + self.store.memory_bytes()
+    
+    def close(self):
+        """Release the document store, deleting segments no saved index links to"""
+        self.store.close()
+    
+    def persist(self):
+        """Make sure the index cache holds this index, so dropping it from memory loses nothing"""
+        if self.index is not None and self.fingerprint and \
+                not os.path.exists(os.path.join(self._cache_path(self.fingerprint), INDEX_FILE)):
+            self.save_index(self.fingerprint)
+    
+    def read_passage(self, file_name: str, offset: int, length: int) -> str:
+        """Text of any byte span of an indexed file, e.g. several adjacent chunks joined"""
+        BYTES_READ.inc(length, component="retrieval")
+        return decode_bytes(self.store.read(file_name, offset, length))
+    
+    def _chunk(self, chunk_id: int) -> Optional[Tuple[str, int, int]]:
+        """(file name, offset, length) of a chunk ID, or None if its document was removed"""
+        return self.store.chunk(chunk_id >> CHUNK_ID_BITS, chunk_id & CHUNK_NUMBER_MASK)
+    
+    def _result(self, chunk: Tuple[str, int, int]) -> Dict:
+        """Materialize one hit, reading its span from the document store"""
+        file_name, offset, length = chunk
+        return {
+            "file_name": file_name,
+            "content": self.read_passage(file_name, offset, length),
+            "offset": offset,
+            "length": length,
+        }
+    
+    def summary(self) -> Dict:
+        """Documents and chunks in the index"""
+        return {"documents": self.store.document_count, "chunks": self.store.chunk_count}
+    
+    def related_contexts(self, queries: List[str], top_k: int = CONTEXT_CANDIDATES) -> List[Dict]:
+        """Search for all queries at once, then merge duplicate and overlapping hits and diversify them"""
+        with span("retrieval"):
+            results = self.search_related_batch(queries, top_k=top_k)
+        with span("context_assembly"):
+            return assemble_contexts(results, self.read_passage, vectors=self.passage_vectors)
+    
+    def passage_vectors(self, passages: List[Dict]) -> np.ndarray:
+        """Unit vectors of retrieved passages, for re-ranking; the embedding cache is not involved.
+
+        A passage is the average of its chunks' vectors, read back from the index. IVF lists
+        cannot give vectors back without a direct map, so passages there, and any the index
+        has no vectors for, are encoded again.
+        """
+        vectors = [None] * len(passages)
+        try:
+            for i, passage in enumerate(passages):
+                doc_id, numbers = self.store.chunks_within(passage["file_name"], passage["offset"], passage["length"])
+                if numbers:
+                    vectors[i] = np.mean([self.index.reconstruct((doc_id << CHUNK_ID_BITS) + number)
+                                          for number in numbers], axis=0)
+        except (RuntimeError, KeyError):
+            pass  # an index without reconstruct fails on the first passage
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            with span("passage_embedding"):
+                for i, vector in zip(missing, self._encode([passages[i]["content"] for i in missing])):
+                    vectors[i] = vector
+        return normalize(np.vstack(vectors))
+    
     def search_related(self, query: str, top_k: int = 3) -> List[Dict]:
-        """Search for related documents using semantic similarity"""
-        if not self.index or not self.documents:
+        """Search for related document chunks using semantic similarity"""
+        return self.search_related_batch([query], top_k=top_k)[0]
+    
+    def search_related_batch(self, queries: List[str], top_k: int = 3) -> List[List[Dict]]:
+        """Search for many queries with one encode pass and one index search.
+
+        Returns one result list per query, in query order.
+        """
+        if not self.index or not self.store.chunk_count:
             logger.warning("Index not built or no documents available")
+            return [[] for _ in queries]
+        if not queries:
             return []
         
         try:
-            # Encode query
-            query_embedding = self.embedder.encode([query])
-            
-            # Search
-            distances, indices = self.index.search(
-                np.array(query_embedding).astype('float32'), 
-                min(top_k, len(self.documents))
-            )
+            with span("query_embedding"):
+                query_embeddings = normalize(self._encode(queries))
+            # Over-fetch to make up for removed vectors still present in the index
+            fetch_k = min(top_k + self.stale_vectors, self.index.ntotal)
+            with span("faiss_search"):
+                scores, indices = self.index.search(query_embeddings, fetch_k)
             
+            # Each hit is materialized once even if several queries return it
+            materialized = {}
             results = []
-            for i, (distance, idx) in enumerate(zip(distances[0], indices[0])):
-                if idx < len(self.documents):  # Valid index
-                    results.append({
-                        "file_name": self.file_names[idx],
-                        "content": self.documents[idx][:500] + "..." if len(self.documents[idx]) > 500 else self.documents[idx],
-                        "similarity_score": float(1 / (1 + distance)),  # Convert distance to similarity
-                        "rank": i + 1
-                    })
+            for row_scores, row_indices in zip(scores, indices):
+                hits = []
+                for score, chunk_id in zip(row_scores, row_indices):
+                    if len(hits) == top_k:
+                        break
+                    chunk_id = int(chunk_id)
+                    if chunk_id < 0:
+                        continue
+                    if chunk_id not in materialized:
+                        chunk = self._chunk(chunk_id)
+                        materialized[chunk_id] = self._result(chunk) if chunk else None
+                    if materialized[chunk_id] is not None:  # Valid, not removed
+                        hits.append(dict(
+                            materialized[chunk_id],
+                            similarity_score=float(score),  # cosine similarity
+                            rank=len(hits) + 1
+                        ))
+                results.append(hits)
             
             return results
             
         except Exception as e:
             logger.error(f"Error searching related documents: {str(e)}")
-            return []
\ No newline at end of file
+            return [[] for _ in queries]
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import CACHE_REQUESTS
+from utils import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+MEMORY_ENTRIES = int(os.environ.get("CIA_RESPONSE_CACHE_ENTRIES", "256"))
+DISK_TTL_SECONDS = int(os.environ.get("CIA_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+DISK_MAX_BYTES = int(os.environ.get("CIA_RESPONSE_CACHE_BYTES", str(256 * 1024 * 1024)))
+# The disk tier is rescanned at least this often, to drop expired entries and count other processes' writes
+DISK_SCAN_SECONDS = 3600
+
+
+def response_key(model_id: str, params: Dict, prompt: str) -> str:
+    """Cache key for one generation request"""
+    payload = json.dumps({"model": model_id, "params": params, "prompt": prompt}, sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+
+class _Flight:
+    """One computation in progress; followers wait for its text or replay its pieces as they arrive"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pieces: List[str] = []
+        self._done = False
+        self._value: Optional[str] = None
+        self._error: Optional[BaseException] = None
+
+    def feed(self, pieces: Iterable[str]) -> str:
+        """Publish each piece as it is produced; returns their concatenation"""
+        for piece in pieces:
+            with self._cond:
+                self._pieces.append(piece)
+                self._cond.notify_all()
+        return "".join(self._pieces).strip()
+
+    def finish(self, value: Optional[str] = None, error: Optional[BaseException] = None):
+        with self._cond:
+            self._value, self._error, self._done = value, error, True
+            self._cond.notify_all()
+
+    def result(self) -> str:
+        with self._cond:
+            self._cond.wait_for(lambda: self._done)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def stream(self) -> Iterator[str]:
+        seen = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._done or len(self._pieces) > seen)
+                new, done = self._pieces[seen:], self._done
+            yield from new
+            seen += len(new)
+            if done:
+                break
+        if self._error is not None:
+            raise self._error
+        if not seen:
+            yield self._value  # computed in one go by get_or_compute
+
+
+class ResponseCache:
+    """Two-tier cache of generated text: in-memory LRU over an on-disk store with TTL and size cap.
+
+    get_or_compute and stream_or_compute collapse concurrent requests for the same key into
+    one computation.
+    """
+
+    def __init__(self, memory_entries: int = MEMORY_ENTRIES, ttl_seconds: int = DISK_TTL_SECONDS,
+                 max_bytes: int = DISK_MAX_BYTES, cache_dir: Optional[str] = None):
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or get_cache_dir("responses")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        # Size and count of the disk tier, kept up to date between scans; None until the first
+        self._disk_bytes: Optional[int] = None
+        self._disk_entries = 0
+        self._last_scan = 0.0
+        self._scan_lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key: str, value: str):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry["created_at"] > self.ttl_seconds:
+            self._remove_disk(path)
+            return None
+        try:
+            os.utime(path)  # mtime doubles as last-access time for eviction
+        except OSError:
+            pass  # evicted meanwhile; the value read is still good
+        return entry["value"]
+
+    def _write_disk(self, key: str, value: str):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"created_at": time.time(), "value": value}, f)
+                size = f.tell()
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = None
+            os.replace(tmp_path, path)
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += size - (replaced or 0)
+                    self._disk_entries += replaced is None
+                scan = (self._disk_bytes is None or self._disk_bytes > self.max_bytes
+                        or time.time() - self._last_scan > DISK_SCAN_SECONDS)
+            if scan:
+                self._evict_disk()
+        except OSError as e:
+            logger.warning(f"Could not write response cache entry: {str(e)}")
+
+    def _remove_disk(self, path: str):
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except OSError:
+            return  # removed meanwhile
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+                self._disk_entries -= 1
+
+    def _evict_disk(self):
+        """Scan the disk tier: drop expired entries, then least recently used ones until under max_bytes.
+
+        Writes only call this when the running size goes over max_bytes, or every DISK_SCAN_SECONDS.
+        """
+        if not self._scan_lock.acquire(blocking=False):
+            return  # another thread is scanning
+        try:
+            entries = []
+            total = 0
+            now = time.time()
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                        if now - stat.st_mtime > self.ttl_seconds:
+                            os.remove(entry.path)
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            evicted = 0
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            with self._lock:
+                self._disk_bytes = total
+                self._disk_entries = len(entries) - evicted
+                self._last_scan = now
+        finally:
+            self._scan_lock.release()
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        """Call with _lock held"""
+        if key not in self._memory:
+            return None
+        self._memory.move_to_end(key)
+        self.memory_hits += 1
+        CACHE_REQUESTS.inc(cache="response", result="hit")
+        return self._memory[key]
+
+    def _disk_hit(self, key: str, value: str):
+        """Call with _lock held"""
+        self.disk_hits += 1
+        self._remember(key, value)
+        CACHE_REQUESTS.inc(cache="response", result="hit")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._memory_get(key)
+        if value is not None:
+            return value
+        value = self._read_disk(key)
+        with self._lock:
+            if value is not None:
+                self._disk_hit(key, value)
+                return value
+        CACHE_REQUESTS.inc(cache="response", result="miss")
+        return None
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._remember(key, value)
+        self._write_disk(key, value)
+
+    def _lookup(self, key: str) -> Tuple[Optional[str], Optional[_Flight], bool]:
+        """(cached value, None, False), or (None, flight, whether the caller leads it) on a miss.
+
+        The last look at the memory tier and the flight registration happen under one lock
+        hold, so a leader that finishes meanwhile is found in memory rather than followed by
+        a second computation.
+        """
+        with self._lock:
+            value = self._memory_get(key)
+            if value is not None:
+                return value, None, False
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.deduplicated += 1
+                CACHE_REQUESTS.inc(cache="response", result="miss")
+                return None, flight, False
+        value = self._read_disk(key)
+        with self._lock:
+            if value is not None:
+                self._disk_hit(key, value)
+                return value, None, False
+            value = self._memory_get(key)
+            if value is not None:
+                return value, None, False
+            CACHE_REQUESTS.inc(cache="response", result="miss")
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.deduplicated += 1
+                return None, flight, False
+            flight = self._inflight[key] = _Flight()
+            self.misses += 1
+            return None, flight, True
+
+    def _lead(self, key: str, flight: _Flight, compute: Callable[[], str]) -> str:
+        try:
+            value = compute()
+            self.put(key, value)
+            flight.finish(value)
+            return value
+        except Exception as e:
+            flight.finish(error=e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        value, flight, owner = self._lookup(key)
+        if value is not None:
+            return value
+        if not owner:
+            return flight.result()
+        return self._lead(key, flight, compute)
+
+    def stream_or_compute(self, key: str, produce: Callable[[], Iterable[str]]) -> Iterator[str]:
+        """Pieces of the text for key, as produce generates them unless it is cached.
+
+        Concurrent callers for the same key share one produce; each gets every piece. produce
+        is drained on its own thread, so the text is cached even if the caller stops reading.
+        """
+        value, flight, owner = self._lookup(key)
+        if value is not None:
+            yield value
+            return
+        if owner:
+            def lead():
+                try:
+                    self._lead(key, flight, lambda: flight.feed(produce()))
+                except Exception:
+                    pass  # raised to every reader by flight.stream
+            threading.Thread(target=lead, name="response-stream", daemon=True).start()
+        yield from flight.stream()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "deduplicated": self.deduplicated,
+                "disk_entries": self._disk_entries,
+                "disk_bytes": self._disk_bytes,
+            }
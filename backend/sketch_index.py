@@ -0,0 +1,92 @@
+import heapq
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+# Words per shingle; char shingles are used for text with few whitespace breaks
+SHINGLE_SIZE = 3
+CHAR_SHINGLE_SIZE = 8
+# Number of smallest shingle hashes kept per document (bottom-k sketch)
+SKETCH_SIZE = 128
+
+
+def _hash(piece: str) -> int:
+    return zlib.crc32(piece.encode("utf-8"))
+
+
+def shingle_hashes(text: str) -> Set[int]:
+    """Hash the word shingles of a text, falling back to char shingles for dense data"""
+    tokens = text.split()
+    if not tokens:
+        return set()
+
+    # Minified JSON, long CSV rows etc. have too few words to sketch well
+    if len(tokens) * 32 < len(text):
+        compact = " ".join(tokens)
+        if len(compact) <= CHAR_SHINGLE_SIZE:
+            return {_hash(compact)}
+        return {_hash(compact[i:i + CHAR_SHINGLE_SIZE])
+                for i in range(len(compact) - CHAR_SHINGLE_SIZE + 1)}
+
+    if len(tokens) <= SHINGLE_SIZE:
+        return {_hash(" ".join(tokens))}
+    return {_hash(" ".join(tokens[i:i + SHINGLE_SIZE]))
+            for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+
+def build_sketch(text: str) -> Tuple[int, ...]:
+    """Bottom-k MinHash sketch of a text"""
+    return tuple(heapq.nsmallest(SKETCH_SIZE, shingle_hashes(text)))
+
+
+def merge_sketches(sketch_a: Tuple[int, ...], sketch_b: Tuple[int, ...]) -> Tuple[int, ...]:
+    """Sketch of the union of two documents, e.g. chunks of one large file"""
+    return tuple(heapq.nsmallest(SKETCH_SIZE, set(sketch_a) | set(sketch_b)))
+
+
+def estimate_similarity(sketch_a: Tuple[int, ...], sketch_b: Tuple[int, ...]) -> float:
+    """Estimate the Jaccard similarity of two documents from their sketches"""
+    if not sketch_a or not sketch_b:
+        return 0.0
+    set_a, set_b = set(sketch_a), set(sketch_b)
+    union_sketch = heapq.nsmallest(SKETCH_SIZE, set_a | set_b)
+    shared = sum(1 for h in union_sketch if h in set_a and h in set_b)
+    return shared / len(union_sketch)
+
+
+class SketchIndex:
+    """Inverted index from sketch hashes to documents, used to find near-duplicate candidates"""
+
+    def __init__(self):
+        self._postings: Dict[int, List[str]] = defaultdict(list)
+        self._sketches: Dict[str, Tuple[int, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._sketches)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sketches
+
+    def keys(self) -> List[str]:
+        return list(self._sketches)
+
+    def add(self, key: str, sketch: Tuple[int, ...]):
+        self._sketches[key] = sketch
+        for h in sketch:
+            self._postings[h].append(key)
+
+    def candidates(self, sketch: Tuple[int, ...], top_n: int = 3) -> List[Tuple[str, float]]:
+        """Return up to top_n (key, estimated similarity) pairs, best first"""
+        shared_counts: Dict[str, int] = defaultdict(int)
+        for h in sketch:
+            for key in self._postings.get(h, ()):
+                shared_counts[key] += 1
+
+        if not shared_counts:
+            return []
+
+        # Only estimate the documents sharing the most sketch hashes
+        shortlist = heapq.nsmallest(top_n * 4, shared_counts.items(), key=lambda kv: (-kv[1], kv[0]))
+        scored = [(key, estimate_similarity(sketch, self._sketches[key])) for key, _ in shortlist]
+        scored.sort(key=lambda kv: (-kv[1], kv[0]))
+        return scored[:top_n]
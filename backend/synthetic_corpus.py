@@ -0,0 +1,159 @@
+import os
+import json
+import random
+import logging
+from typing import Dict, List, Sequence
+
+from utils import ensure_directory
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_ENCODINGS = ("utf-8", "latin-1", "utf-16")
+VOCABULARY_SIZE = 2000
+# Words that need more than ASCII, so the chosen encodings actually differ on disk
+ACCENTED_WORDS = ["café", "naïve", "résumé", "déjà", "façade", "jalapeño", "über", "coöperate"]
+LINE_WORDS = (6, 16)
+
+
+def make_vocabulary(rng: random.Random, size: int = VOCABULARY_SIZE) -> List[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = {"".join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(size)}
+    return sorted(words) + ACCENTED_WORDS
+
+
+def _zipf_weights(n: int) -> List[float]:
+    """Word frequencies fall off like natural language rather than uniformly"""
+    return [1.0 / (rank + 1) for rank in range(n)]
+
+
+def make_line(rng: random.Random, vocabulary: Sequence[str], weights: Sequence[float]) -> str:
+    return " ".join(rng.choices(vocabulary, weights=weights, k=rng.randint(*LINE_WORDS)))
+
+
+def make_document(rng: random.Random, size: int, vocabulary: Sequence[str], weights: Sequence[float]) -> List[str]:
+    """Lines of text adding up to roughly size characters, with a heading every few paragraphs"""
+    lines, total = [], 0
+    while total < size:
+        if rng.random() < 0.05:
+            line = "# " + make_line(rng, vocabulary, weights).title()
+        elif rng.random() < 0.1:
+            line = ""
+        else:
+            line = make_line(rng, vocabulary, weights)
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+def mutate(rng: random.Random, lines: List[str], edit_fraction: float,
+           vocabulary: Sequence[str], weights: Sequence[float]) -> List[str]:
+    """Replace, insert and delete about edit_fraction of the lines, at least one edit"""
+    lines = list(lines)
+    for _ in range(max(1, int(len(lines) * edit_fraction))):
+        position = rng.randrange(len(lines) + 1)
+        operation = rng.random()
+        if operation < 0.5 and position < len(lines):
+            lines[position] = make_line(rng, vocabulary, weights)
+        elif operation < 0.8 or position >= len(lines):
+            lines.insert(position, make_line(rng, vocabulary, weights))
+        else:
+            del lines[position]
+    return lines
+
+
+def _write(path: str, lines: List[str], encoding: str):
+    # errors="replace" keeps accented words from failing in encodings without them
+    with open(path, 'w', encoding=encoding, errors="replace", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def generate_corpus(root: str, files: int = 100, file_size: int = 8192, size_jitter: float = 0.5,
+                    change_rate: float = 0.2, rename_rate: float = 0.05, delete_rate: float = 0.02,
+                    add_rate: float = 0.02, edit_fraction: float = 0.05,
+                    encodings: Sequence[str] = ("utf-8",), seed: int = 0) -> Dict:
+    """Write root/old and root/new document trees and return what was changed.
+
+    Every file gets one of encodings. Of the old files, change_rate are edited, rename_rate
+    are renamed (and edited with probability change_rate), delete_rate are deleted, and
+    add_rate * files new ones are added. The same arguments always produce the same trees.
+    The returned ground truth is also written to root/truth.json.
+    """
+    for encoding in encodings:
+        if encoding not in SUPPORTED_ENCODINGS:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    weights = _zipf_weights(len(vocabulary))
+    rng.shuffle(vocabulary)  # so the frequent words are not all short
+
+    old_folder = os.path.join(root, "old")
+    new_folder = os.path.join(root, "new")
+    ensure_directory(old_folder)
+    ensure_directory(new_folder)
+    truth = {"modified": [], "renamed": [], "deleted": [], "added": [], "unchanged": 0}
+
+    def sized() -> int:
+        return max(64, int(file_size * (1 + size_jitter * (2 * rng.random() - 1))))
+
+    for i in range(files):
+        name = f"doc_{i:06d}.md"
+        encoding = rng.choice(encodings)
+        lines = make_document(rng, sized(), vocabulary, weights)
+        _write(os.path.join(old_folder, name), lines, encoding)
+
+        roll = rng.random()
+        if roll < delete_rate:
+            truth["deleted"].append(name)
+            continue
+        if roll < delete_rate + rename_rate:
+            new_name = f"renamed_{i:06d}.md"
+            edited = rng.random() < change_rate
+            if edited:
+                lines = mutate(rng, lines, edit_fraction, vocabulary, weights)
+            truth["renamed"].append({"old": name, "new": new_name, "edited": edited})
+            name = new_name
+        elif roll < delete_rate + rename_rate + change_rate:
+            lines = mutate(rng, lines, edit_fraction, vocabulary, weights)
+            truth["modified"].append(name)
+        else:
+            truth["unchanged"] += 1
+        _write(os.path.join(new_folder, name), lines, encoding)
+
+    for i in range(int(files * add_rate)):
+        name = f"added_{i:06d}.md"
+        _write(os.path.join(new_folder, name), make_document(rng, sized(), vocabulary, weights),
+               rng.choice(encodings))
+        truth["added"].append(name)
+
+    truth.update({
+        "old_folder": old_folder,
+        "new_folder": new_folder,
+        "params": {
+            "files": files, "file_size": file_size, "size_jitter": size_jitter, "change_rate": change_rate,
+            "rename_rate": rename_rate, "delete_rate": delete_rate, "add_rate": add_rate,
+            "edit_fraction": edit_fraction, "encodings": list(encodings), "seed": seed,
+        },
+    })
+    with open(os.path.join(root, "truth.json"), 'w') as f:
+        json.dump(truth, f, indent=2)
+    logger.info(f"Generated {files} old files under {root}: {len(truth['modified'])} modified, "
+                f"{len(truth['renamed'])} renamed, {len(truth['deleted'])} deleted, {len(truth['added'])} added")
+    return truth
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate old/new synthetic document trees")
+    parser.add_argument("root")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--file-size", type=int, default=8192)
+    parser.add_argument("--change-rate", type=float, default=0.2)
+    parser.add_argument("--rename-rate", type=float, default=0.05)
+    parser.add_argument("--encodings", default="utf-8", help="Comma-separated, e.g. utf-8,latin-1")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    generate_corpus(args.root, files=args.files, file_size=args.file_size, change_rate=args.change_rate,
+                    rename_rate=args.rename_rate, encodings=args.encodings.split(","), seed=args.seed)
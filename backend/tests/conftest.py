@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Modules import each other by bare name, as when run from backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# utils reads the cache root at import time, so point it somewhere disposable first
+os.environ.setdefault("CIA_CACHE_DIR", tempfile.mkdtemp(prefix="cia-tests-"))
+
+from benchmark import HashingEmbedder  # noqa: E402
+from embedding_cache import EmbeddingCache  # noqa: E402
+
+
+def write_corpus(folder, files):
+    for name, text in files.items():
+        path = os.path.join(folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding="utf-8") as f:
+            f.write(text)
+
+
+def corpus_text(seed: int, lines: int = 40) -> str:
+    words = ["api", "token", "auth", "review", "deploy", "schema", "cache", "index", "update", "guide"]
+    return "".join(" ".join(words[(seed * 7 + i * j) % len(words)] + str((seed + i + j) % 97) for j in range(12)) + "\n"
+                   for i in range(lines))
+
+
+@pytest.fixture
+def make_engine(tmp_path):
+    """RagEngine factory with a model-free embedder and its own embedding cache"""
+    from rag_engine import RagEngine
+
+    cache = EmbeddingCache("hashing-test", max_entries=50_000, cache_dir=str(tmp_path / "embeddings"))
+
+    def make(**options):
+        options.setdefault("chunk_window", 200)
+        options.setdefault("chunk_overlap", 40)
+        return RagEngine("hashing-test", embedding_cache=cache, embedder=HashingEmbedder(32), **options)
+
+    return make
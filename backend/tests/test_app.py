@@ -0,0 +1,103 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+def _tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+@pytest.fixture
+def client():
+    # Without the context manager startup hooks, and so model preloading, do not run
+    return TestClient(app.app)
+
+
+def test_snapshot_from_a_streamed_body_and_a_form(client):
+    def chunks(data):
+        for start in range(0, len(data), 100):
+            yield data[start:start + 100]
+
+    archive = _tar({"a.txt": b"alpha\n" * 500, "docs/b.txt": b"beta\n"})
+    streamed = client.post("/snapshots", content=chunks(archive), headers={"Content-Type": "application/gzip"})
+    assert streamed.status_code == 200, streamed.text
+    body = streamed.json()
+    assert body["files"] == body["uploaded_files"] == 2
+    with open(os.path.join(body["folder"], "docs", "b.txt"), 'rb') as f:
+        assert f.read() == b"beta\n"
+
+    # The same files as a form, one of them by digest only, give the same snapshot
+    digest = app.blob_store.put(io.BytesIO(b"beta\n"))[0]
+    form = client.post("/snapshots", files={"archive": ("v1.tar.gz", _tar({"a.txt": b"alpha\n" * 500}))},
+                       data={"files": json.dumps({"docs/b.txt": digest})})
+    assert form.status_code == 200 and form.json()["snapshot"] == body["snapshot"]
+    # Known files alone need no body
+    assert client.post("/snapshots", params={"files": json.dumps({"b.txt": digest})}).status_code == 200
+
+
+def test_invalid_snapshots_are_rejected(client):
+    conflict = client.post("/snapshots", content=_tar({"a": b"file", "a/b": b"nested"}),
+                           headers={"Content-Type": "application/x-tar"})
+    assert conflict.status_code == 400 and "both a file and a directory" in conflict.json()["detail"]
+    assert client.post("/snapshots", content=b"not an archive").status_code == 400
+    assert client.post("/snapshots", params={"files": json.dumps({"a": "0" * 32})}).status_code == 400
+
+
+def test_ready_follows_model_loading(client, monkeypatch):
+    from model_loader import LazyModel, warm_up_in_order
+
+    release, attempts = threading.Event(), []
+
+    def load():
+        attempts.append(1)
+        release.wait(10)
+        if len(attempts) == 1:
+            raise RuntimeError("weights missing")
+        return "model"
+
+    models = {"rag_engine": LazyModel("rag_engine", lambda: "engine"),
+              "llama_analyzer": LazyModel("llama_analyzer", load)}
+    for name, model in models.items():
+        monkeypatch.setattr(app, name, model)
+
+    not_loaded = client.get("/ready")
+    assert not_loaded.status_code == 503
+    assert {status["state"] for status in not_loaded.json()["detail"].values()} == {"not_loaded"}
+
+    warm_up_in_order(list(models.values()))
+    deadline = time.time() + 10
+    while models["llama_analyzer"].state != "loading" and time.time() < deadline:
+        time.sleep(0.01)
+    loading = client.get("/ready")
+    assert loading.status_code == 503
+    assert loading.json()["detail"]["rag_engine"]["state"] == "ready"
+    assert loading.json()["detail"]["llama_analyzer"]["state"] == "loading"
+
+    # A failed warm-up is reported and the next use retries it
+    release.set()
+    while models["llama_analyzer"].state == "loading" and time.time() < deadline:
+        time.sleep(0.01)
+    failed = client.get("/ready")
+    assert failed.status_code == 503
+    assert failed.json()["detail"]["llama_analyzer"] == {"state": "failed", "error": "weights missing",
+                                                         "load_seconds": None}
+    assert models["llama_analyzer"].get() == "model"
+    ready = client.get("/ready")
+    assert ready.status_code == 200
+    assert ready.json()["llama_analyzer"]["state"] == "ready"
+    assert ready.json()["llama_analyzer"]["error"] is None
+    assert ready.json()["llama_analyzer"]["load_seconds"] >= 0
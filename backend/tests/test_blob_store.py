@@ -0,0 +1,61 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import blob_store
+from blob_store import BlobStore, UploadError
+
+
+def _tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+
+def _store(tmp_path):
+    return BlobStore(root=str(tmp_path / "blobs"), snapshot_root=str(tmp_path / "snapshots"))
+
+
+def test_snapshot_links_uploaded_files(tmp_path):
+    store = _store(tmp_path)
+    unpacked = list(store.unpack(_tar({"a.txt": b"alpha", "docs/b.txt": b"beta", "../x": b"escape"})))
+    files = {path: digest for path, digest, _, _ in unpacked}
+    assert sorted(files) == ["a.txt", "docs/b.txt"]
+
+    snapshot_id, folder = store.snapshot(files)
+    with open(os.path.join(folder, "docs", "b.txt"), 'rb') as f:
+        assert f.read() == b"beta"
+    assert store.snapshot(dict(reversed(files.items()))) == (snapshot_id, folder)
+
+
+def test_path_used_as_file_and_directory_is_rejected(tmp_path):
+    store = _store(tmp_path)
+    files = {path: digest for path, digest, _, _ in store.unpack(_tar({"a": b"file", "a/b/c": b"nested"}))}
+    with pytest.raises(UploadError, match="both a file and a directory: a$"):
+        store.snapshot(files)
+    assert os.listdir(store.snapshot_root) == []
+
+
+def test_prune_drops_old_snapshots_and_unlinked_blobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(blob_store, "BLOB_GRACE_SECONDS", -1)
+    store = _store(tmp_path)
+    digests = {name: store.put(io.BytesIO(name.encode()))[0] for name in ("old", "shared", "new", "loose")}
+    _, old_folder = store.snapshot({"old.txt": digests["old"], "shared.txt": digests["shared"]})
+    os.utime(old_folder, (1, 1))
+    _, folder = store.snapshot({"new.txt": digests["new"], "shared.txt": digests["shared"]})
+
+    assert store.prune(keep=1) == (1, 2)
+    assert os.listdir(store.snapshot_root) == [os.path.basename(folder)]
+    assert store.missing(list(digests.values())) == [digests["old"], digests["loose"]]
+
+    # Within the grace period unlinked blobs stay, for snapshots still being uploaded
+    monkeypatch.setattr(blob_store, "BLOB_GRACE_SECONDS", 3600)
+    loose = store.put(io.BytesIO(b"loose"))[0]
+    assert store.prune(keep=0) == (1, 0) and store.has(loose)
@@ -0,0 +1,67 @@
+import diff_detector
+from conftest import corpus_text, write_corpus
+from diff_detector import compare_documents
+from metrics import CACHE_REQUESTS
+
+
+def _modified(differences):
+    return sorted(d["file"] for d in differences if d["type"] == "modified")
+
+
+def test_short_files_differing_in_one_word_are_paired(tmp_path, monkeypatch):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    write_corpus(old, {"notes.txt": "alpha beta gamma", "a/readme.txt": "one two three"})
+    write_corpus(new, {"notes.txt": "alpha beta delta", "b/readme.txt": "one two four"})
+
+    differences = compare_documents(old, new, use_cache=False, workers=1)
+    assert _modified(differences) == ["a/readme.txt → b/readme.txt", "notes.txt → notes.txt"]
+
+    # Too many leftovers to score them all: short files are still scored by size
+    monkeypatch.setattr(diff_detector, "EXHAUSTIVE_MATCH_PAIRS", 0)
+    write_corpus(new, {"long.txt": "lorem ipsum dolor sit amet " * 400})
+    differences = compare_documents(old, new, use_cache=False, workers=1)
+    assert _modified(differences) == ["a/readme.txt → b/readme.txt", "notes.txt → notes.txt"]
+
+
+def test_pair_results_are_reused_from_the_diff_cache(tmp_path, monkeypatch):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    text = corpus_text(5)
+    write_corpus(old, {"guide.txt": text, "same.txt": "unchanged\n"})
+    write_corpus(new, {"renamed.txt": text.replace("api", "API", 3), "same.txt": "unchanged\n"})
+
+    scored = []
+    score = diff_detector._score_pair_args
+    monkeypatch.setattr(diff_detector, "_score_pair_args", lambda paths: scored.append(paths) or score(paths))
+    hits = CACHE_REQUESTS.value(cache="diff", result="hit")
+
+    first = compare_documents(old, new, workers=1)
+    assert _modified(first) == ["guide.txt → renamed.txt"] and len(scored) == 1
+    assert compare_documents(old, new, workers=1) == first
+    assert len(scored) == 1 and CACHE_REQUESTS.value(cache="diff", result="hit") == hits + 1
+
+    # Results are keyed by content, so the same pair in other folders is a hit too
+    copy_old, copy_new = str(tmp_path / "copy_old"), str(tmp_path / "copy_new")
+    write_corpus(copy_old, {"guide.txt": text})
+    write_corpus(copy_new, {"renamed.txt": text.replace("api", "API", 3)})
+    assert _modified(compare_documents(copy_old, copy_new, workers=1)) == ["guide.txt → renamed.txt"]
+    assert len(scored) == 1
+    # Without the cache every pair is scored
+    compare_documents(old, new, use_cache=False, workers=1)
+    assert len(scored) == 2
+
+
+def test_worker_pool_gives_the_serial_results(tmp_path):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    old_files = {f"doc{i}.txt": f"{words[i % 8]} {i} release notes\nsteps {i * 7} and {words[i * 3 % 8]}\n"
+                 for i in range(40)}
+    write_corpus(old, old_files)
+    write_corpus(new, {f"moved/doc{i}.txt": text.replace("steps", "stages") for i, text in
+                       enumerate(old_files.values())})
+
+    serial = compare_documents(old, new, use_cache=False, workers=1)
+    assert len([d for d in serial if d["type"] == "modified"]) == 40
+    assert compare_documents(old, new, use_cache=False, workers=2) == serial
+
+    pairs = [(text, text.upper()) for text in old_files.values()]
+    assert diff_detector.get_detailed_diffs(pairs, workers=2) == diff_detector.get_detailed_diffs(pairs, workers=1)
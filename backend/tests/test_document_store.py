@@ -0,0 +1,47 @@
+import os
+
+from conftest import corpus_text, write_corpus
+from document_store import scratch_dir
+from rag_engine import prune_index_cache
+
+
+def _segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(".blob"))
+
+
+def test_segments_live_with_the_cache_entry(make_engine, tmp_path):
+    folder = str(tmp_path / "corpus")
+    write_corpus(folder, {f"doc{i}.txt": corpus_text(i) for i in range(6)})
+
+    # Uncached rebuilds leave nothing behind once their engines are closed
+    for _ in range(3):
+        engine = make_engine()
+        engine.build_index(folder, use_cache=False)
+        engine.close()
+    assert _segments(scratch_dir()) == []
+
+    built = make_engine()
+    built.build_index(folder)
+    entry = built._cache_path(built.fingerprint)
+    assert _segments(entry) == built.store.segments
+    built.close()
+
+    # An update saves the old segment, linked, next to its new one
+    loaded = make_engine()
+    assert loaded.load_index(built.fingerprint, folder)
+    write_corpus(folder, {"doc0.txt": "quokka zebra walrus\n" * 20})
+    loaded.update_index(folder, ["doc0.txt"])
+    updated = loaded._cache_path(loaded.fingerprint)
+    assert len(_segments(updated)) == 2
+    first = os.path.join(updated, built.store.segments[0])
+    assert os.stat(first).st_nlink == 2
+
+    # Pruning the original entry leaves the updated one, and the engine using it, readable
+    os.utime(entry, (0, 0))
+    prune_index_cache(keep=1)
+    assert not os.path.exists(entry) and os.stat(first).st_nlink == 1
+    hits = loaded.search_related(corpus_text(3, 2), top_k=10)
+    assert hits and all(hit["content"] for hit in hits)
+    assert loaded.read_passage("doc3.txt", 0, 20) == corpus_text(3)[:20]
+    loaded.close()
+    assert _segments(scratch_dir()) == []
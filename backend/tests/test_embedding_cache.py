@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+import embedding_cache
+from embedding_cache import KEY_LOG_FILE, EmbeddingCache
+
+
+def _vectors(*values):
+    return np.array([[value] * 4 for value in values], dtype=np.float32)
+
+
+def _log_lines(cache_dir):
+    with open(os.path.join(cache_dir, KEY_LOG_FILE)) as f:
+        return f.read().splitlines()
+
+
+def test_key_log_replays_slots_and_recency(tmp_path):
+    cache_dir = str(tmp_path)
+    cache = EmbeddingCache("m", max_entries=2, cache_dir=cache_dir)
+    cache.put_many(["a", "b"], _vectors(1, 2))
+    lines = _log_lines(cache_dir)
+    cache.put_many(["c"], _vectors(3))  # evicts a
+    # Writes only append
+    assert _log_lines(cache_dir)[:len(lines)] == lines
+
+    # A read of b is persisted lazily, so c becomes the least recently used
+    cache.get_many(["b"])
+    cache.flush()
+
+    reopened = EmbeddingCache("m", max_entries=2, cache_dir=cache_dir)
+    reopened.put_many(["d"], _vectors(4))
+    found, missing = reopened.get_many(["a", "b", "c", "d"])
+    assert missing == [0, 2] and found[1][0] == 2 and found[3][0] == 4
+
+    # An interrupted append leaves a partial record that is ignored
+    with open(os.path.join(cache_dir, KEY_LOG_FILE), 'a') as f:
+        f.write("e 1")
+    again = EmbeddingCache("m", max_entries=2, cache_dir=cache_dir)
+    assert again.get_many(["b", "d", "e"])[1] == [2]
+
+
+def test_key_log_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "RECENCY_FLUSH_KEYS", 1)
+    cache_dir = str(tmp_path)
+    cache = EmbeddingCache("m", max_entries=4, cache_dir=cache_dir)
+    cache.put_many(["a", "b"], _vectors(1, 2))
+    for _ in range(3000):
+        cache.get_many(["a"])
+    assert len(_log_lines(cache_dir)) <= 1 + embedding_cache.LOG_COMPACT_RATIO * 1024
+    assert len(EmbeddingCache("m", max_entries=4, cache_dir=cache_dir).get_many(["a", "b"])[0]) == 2
+
+
+def _put_keys(cache_dir, prefix, count):
+    cache = EmbeddingCache("m", max_entries=64, cache_dir=cache_dir)
+    for start in range(0, count, 5):
+        keys = [f"{prefix}{i}" for i in range(start, start + 5)]
+        cache.put_many(keys, _vectors(*(int(key[1:]) + (100 if prefix == "b" else 0) for key in keys)))
+
+
+def test_caches_sharing_a_directory_do_not_claim_the_same_slot(tmp_path):
+    cache_dir = str(tmp_path)
+    first = EmbeddingCache("m", max_entries=4, cache_dir=cache_dir)
+    second = EmbeddingCache("m", max_entries=4, cache_dir=cache_dir)
+    first.put_many(["a"], _vectors(1))
+    second.put_many(["b"], _vectors(2))
+    found, missing = first.get_many(["a", "b"])
+    assert missing == [] and found[0][0] == 1 and found[1][0] == 2
+
+    # Processes writing concurrently keep every key on its own row
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_put_keys, args=(str(tmp_path / "shared"), prefix, 30)) for prefix in "ab"]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    keys = [f"a{i}" for i in range(30)] + [f"b{i}" for i in range(30)]
+    found, missing = EmbeddingCache("m", max_entries=64, cache_dir=str(tmp_path / "shared")).get_many(keys)
+    assert missing == []
+    assert [found[i][0] for i in range(60)] == list(range(30)) + list(range(100, 130))
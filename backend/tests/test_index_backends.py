@@ -0,0 +1,80 @@
+import faiss
+import numpy as np
+import pytest
+
+from conftest import corpus_text, write_corpus
+from index_backends import (HNSW_MIN_VECTORS, INDEX_KINDS, IVF_PQ_MIN_VECTORS, PQ_MIN_TRAIN, IndexBuilder,
+                            base_index, choose_index_kind, normalize, supports_removal)
+
+INDEX_TYPES = {
+    "flat": faiss.IndexFlatIP,
+    "hnsw": faiss.IndexHNSWFlat,
+    "ivf_flat": faiss.IndexIVFFlat,
+    "ivf_pq": faiss.IndexIVFPQ,
+}
+DIMENSION = 32
+
+
+def _clustered(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 100), DIMENSION)).astype('float32')
+    return centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, DIMENSION)).astype('float32')
+
+
+@pytest.mark.parametrize("kind", INDEX_KINDS)
+def test_builder_streams_batches_into_each_backend(kind):
+    n = PQ_MIN_TRAIN + 2000
+    vectors = _clustered(n)
+    builder = IndexBuilder(kind, expected_vectors=n)
+    for start in range(0, n, 1000):
+        builder.add(vectors[start:start + 1000], np.arange(start, min(start + 1000, n)) + 7)
+    index = builder.finish()
+
+    assert isinstance(base_index(index), INDEX_TYPES[kind])
+    assert index.ntotal == n
+    assert supports_removal(index) == (kind != "hnsw")
+    # IDs are the ones given, and every vector finds itself among its neighbours
+    _, found = index.search(normalize(vectors[:200]), 10)
+    assert np.mean([i + 7 in row for i, row in enumerate(found)]) >= 0.95
+
+
+def test_auto_kind_follows_the_expected_size():
+    assert choose_index_kind(0) == "flat"
+    assert choose_index_kind(HNSW_MIN_VECTORS - 1) == "flat"
+    assert choose_index_kind(HNSW_MIN_VECTORS) == "hnsw"
+    assert choose_index_kind(IVF_PQ_MIN_VECTORS) == "ivf_pq"
+    assert IndexBuilder("auto", expected_vectors=HNSW_MIN_VECTORS).kind == "hnsw"
+    with pytest.raises(ValueError):
+        IndexBuilder("annoy")
+
+
+def test_small_corpora_fall_back_to_simpler_backends():
+    few = IndexBuilder("ivf_flat", expected_vectors=100)
+    few.add(_clustered(100), np.arange(100))
+    assert isinstance(base_index(few.finish()), faiss.IndexFlatIP) and few.kind == "flat"
+
+    # Enough to train the coarse quantizer, too few for 8-bit PQ codebooks
+    vectors = _clustered(2000)
+    pq = IndexBuilder("ivf_pq", expected_vectors=len(vectors))
+    pq.add(vectors, np.arange(len(vectors)))
+    assert isinstance(base_index(pq.finish()), faiss.IndexIVFFlat) and pq.kind == "ivf_flat"
+
+
+def test_search_over_fetches_past_vectors_hnsw_cannot_remove(make_engine, tmp_path):
+    folder = str(tmp_path / "corpus")
+    query = "quokka zebra walrus narwhal okapi tapir"
+    files = {f"doc{i}.txt": corpus_text(i) for i in range(8)}
+    files.update({f"copy{i}.txt": f"{query}\n" for i in range(6)})
+    write_corpus(folder, files)
+    engine = make_engine(index_kind="hnsw", chunk_window=100, chunk_overlap=0)
+    engine.build_index(folder, use_cache=False)
+    assert not supports_removal(engine.index)
+    ntotal = engine.index.ntotal
+
+    # The removed copies stay in the graph, nearest to the query, and are skipped
+    assert engine.remove_documents([f"copy{i}.txt" for i in range(6)]) == 6
+    assert engine.index.ntotal == ntotal and engine.stale_vectors == 6
+    hits = engine.search_related(query, top_k=3)
+    assert len(hits) == 3
+    assert all(hit["file_name"].startswith("doc") for hit in hits)
+    assert [hit["rank"] for hit in hits] == [1, 2, 3]
@@ -0,0 +1,149 @@
+import os
+import time
+import threading
+
+import faiss
+import pytest
+
+from conftest import corpus_text, write_corpus
+from index_backends import base_index
+from index_registry import IndexRegistry
+from manifest import scan_folder
+
+OPTIONS = {"chunk_window": 100, "chunk_overlap": 0}
+
+
+@pytest.fixture
+def registry_for(make_engine):
+    def make(memory_budget=2 ** 40, **options):
+        base = make_engine(**{**OPTIONS, **options})
+        return IndexRegistry(lambda: base, memory_budget=memory_budget)
+    return make
+
+
+def _corpus(tmp_path, name, files=12):
+    folder = str(tmp_path / name)
+    write_corpus(folder, {f"doc{i}.txt": corpus_text(i + len(name)) for i in range(files)})
+    return folder
+
+
+def _files(hits):
+    return {hit["file_name"] for hit in hits}
+
+
+def test_two_folders_held_at_once(registry_for, tmp_path):
+    registry = registry_for()
+    first, second = _corpus(tmp_path, "first"), _corpus(tmp_path, "second")
+    write_corpus(second, {"only_second.txt": "walrus narwhal okapi\n" * 10})
+
+    with registry.acquire(first) as engine_a, registry.acquire(second) as engine_b:
+        assert engine_a is not engine_b
+        assert engine_b.store.document_count == engine_a.store.document_count + 1
+        assert "only_second.txt" in _files(engine_b.search_related("walrus narwhal okapi", top_k=3))
+        assert "only_second.txt" not in _files(engine_a.search_related("walrus narwhal okapi", top_k=3))
+        assert [index["refs"] for index in registry.stats()["indexes"]] == [1, 1]
+    with registry.acquire(first) as again:
+        assert again is engine_a
+
+
+def test_update_rekeys_and_stale_entries_are_dropped(registry_for, tmp_path):
+    registry = registry_for()
+    folder = _corpus(tmp_path, "corpus")
+    with registry.acquire(folder) as engine:
+        old_fingerprint = engine.fingerprint
+
+    write_corpus(folder, {"doc1.txt": "quokka zebra walrus\n" * 10})
+    summary = registry.update(folder, ["doc1.txt"])
+    assert summary["mode"] == "incremental" and summary["updated"] == 1
+    [index] = registry.stats()["indexes"]
+    assert index["fingerprint"] == engine.fingerprint != old_fingerprint
+    # The updated entry is found under the fingerprint of the new contents
+    with registry.acquire(folder) as updated:
+        assert updated is engine
+
+    # Contents changed without an update: a new entry, and the old one goes once released
+    write_corpus(folder, {"doc2.txt": "tapir okapi\n" * 10})
+    with registry.acquire(folder) as rebuilt:
+        assert rebuilt is not engine
+        assert len(registry.stats()["indexes"]) == 2
+    assert [index["fingerprint"] for index in registry.stats()["indexes"]] == [rebuilt.fingerprint]
+
+
+def test_update_onto_contents_already_held_closes_the_copy(registry_for, tmp_path):
+    registry = registry_for()
+    folder = _corpus(tmp_path, "corpus")
+    old_manifest = scan_folder(folder)
+    with registry.acquire(folder, manifest=old_manifest) as old_engine:
+        write_corpus(folder, {"doc1.txt": "quokka zebra walrus\n" * 10})
+        # The update checks out the old entry and waits for this read lock to go
+        updater = threading.Thread(target=registry.update, args=(folder, ["doc1.txt"]))
+        updater.start()
+        while registry.stats()["indexes"][0]["refs"] < 2:
+            time.sleep(0.01)
+        # Meanwhile another request indexes the new contents
+        with registry.acquire(folder) as new_engine:
+            pass
+        closed = []
+        close = old_engine.close
+        old_engine.close = lambda: closed.append(close())
+    updater.join()
+
+    assert old_engine.fingerprint == new_engine.fingerprint and closed
+    assert [index["fingerprint"] for index in registry.stats()["indexes"]] == [new_engine.fingerprint]
+    with registry.acquire(folder) as engine:
+        assert engine is new_engine
+
+
+def test_eviction_and_reload_from_cache(registry_for, tmp_path):
+    registry = registry_for(memory_budget=1, index_kind="ivf_flat")
+    folder = _corpus(tmp_path, "corpus")
+    with registry.acquire(folder) as engine:
+        assert isinstance(base_index(engine.index), faiss.IndexIVFFlat)
+        expected = _files(engine.search_related(corpus_text(3, 2), top_k=5))
+    assert registry.stats()["indexes"] == []
+
+    with registry.acquire(folder) as reloaded:
+        assert reloaded is not engine and reloaded.mapped_index_path is not None
+        assert _files(reloaded.search_related(corpus_text(3, 2), top_k=5)) == expected
+    assert registry.stats()["indexes"] == []
+
+    # Updating an evicted folder reloads its memory-mapped IVF index and updates a copy
+    write_corpus(folder, {"doc1.txt": "quokka zebra walrus\n" * 10})
+    os.remove(os.path.join(folder, "doc2.txt"))
+    summary = registry.update(folder, ["doc1.txt", "doc2.txt"])
+    assert summary["mode"] == "incremental" and summary["removed"] == 1
+    with registry.acquire(folder) as updated:
+        assert "doc2.txt" not in _files(updated.search_related(corpus_text(2 + len("corpus"), 2), top_k=10))
+
+
+def test_readers_run_alongside_a_writer(registry_for, tmp_path):
+    registry = registry_for()
+    folder = _corpus(tmp_path, "corpus")
+    with registry.acquire(folder):
+        pass
+
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        try:
+            while not stop.is_set():
+                with registry.acquire(folder) as engine:
+                    hits = engine.search_related(corpus_text(5, 2), top_k=3)
+                    assert hits and all(hit["content"] for hit in hits)
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        for round_ in range(5):
+            write_corpus(folder, {"doc1.txt": f"revision {round_} quokka zebra\n" * 10})
+            assert registry.update(folder, ["doc1.txt"])["updated"] == 1
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+    assert errors == []
+    assert len(registry.stats()["indexes"]) == 1
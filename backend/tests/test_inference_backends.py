@@ -0,0 +1,87 @@
+import os
+
+import pytest
+import torch
+from tokenizers import ByteLevelBPETokenizer
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+from inference_backends import SHARED_PROMPT_PREFIX, CpuInt8Backend
+
+# Any small causal LM can be given; by default a randomly initialized GPT-2 is built offline
+TEST_GENERATOR = os.environ.get("CIA_TEST_GENERATOR")
+PARAMS = {"max_new_tokens": 24, "min_new_tokens": 24, "do_sample": False}
+PROMPTS = [
+    SHARED_PROMPT_PREFIX + "CHANGES DETECTED:\n1. auth token renamed (Type: modified)\n",
+    SHARED_PROMPT_PREFIX + "CHANGES DETECTED:\n1. deploy guide removed (Type: deleted)\n",
+]
+
+
+def _tiny_gpt2(folder: str) -> str:
+    """A two-layer GPT-2 with a byte-level BPE tokenizer trained on the test prompts"""
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(PROMPTS, vocab_size=300, special_tokens=["<|endoftext|>"], show_progress=False)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer._tokenizer, eos_token="<|endoftext|>",
+                                   pad_token="<|endoftext|>", model_max_length=1024)
+    fast.save_pretrained(folder)
+    torch.manual_seed(0)
+    # Wide initial weights, so greedy decoding does not settle on one token
+    config = GPT2Config(vocab_size=len(fast), n_positions=1024, n_embd=32, n_layer=2, n_head=2,
+                        initializer_range=0.5, bos_token_id=fast.eos_token_id, eos_token_id=fast.eos_token_id)
+    GPT2LMHeadModel(config).save_pretrained(folder)
+    return folder
+
+
+@pytest.fixture(scope="module")
+def backend(tmp_path_factory):
+    model = TEST_GENERATOR or _tiny_gpt2(str(tmp_path_factory.mktemp("tiny-gpt2")))
+    return CpuInt8Backend(model, threads=1)
+
+
+def _snapshot(cache):
+    return [tuple(tensor.clone() for tensor in layer) for layer in cache]
+
+
+def test_prefix_cache_matches_full_prompt(backend, monkeypatch):
+    before = _snapshot(backend._prefix_cache)
+    hits = backend.stats()["prefix_cache_hits"]
+    passed = []
+    generate = backend.model.generate
+
+    def spy(*args, **kwargs):
+        passed.append(kwargs["past_key_values"])
+        return generate(*args, **kwargs)
+
+    monkeypatch.setattr(backend.model, "generate", spy)
+    cached = [backend.generate(prompt, **PARAMS) for prompt in PROMPTS + PROMPTS]
+    assert backend.stats()["prefix_cache_hits"] == hits + len(cached)
+    assert all(cached) and cached[:len(PROMPTS)] == cached[len(PROMPTS):]
+
+    # Each call extends its own copy; the shared prefix keys/values stay as computed
+    shared = {tensor.data_ptr() for layer in backend._prefix_cache for tensor in layer}
+    assert all(not shared & {tensor.data_ptr() for layer in cache for tensor in layer} for cache in passed)
+    after = backend._prefix_cache
+    assert len(after) == len(before)
+    for layer_before, layer_after in zip(before, after):
+        for tensor_before, tensor_after in zip(layer_before, layer_after):
+            assert torch.equal(tensor_before, tensor_after)
+
+    monkeypatch.setattr(backend.model, "generate", generate)
+    monkeypatch.setattr(backend, "_prefix_for", lambda input_ids: None)
+    assert [backend.generate(prompt, **PARAMS) for prompt in PROMPTS] == cached[:len(PROMPTS)]
+
+
+def test_remote_backend_needs_a_final_reply(monkeypatch):
+    import inference_sidecar
+    from inference_backends import RemoteBackend
+
+    replies = []
+    monkeypatch.setattr(inference_sidecar, "sidecar_call",
+                        lambda *args, **kwargs: {"model": "stub", "backend": "stub", "done": True})
+    monkeypatch.setattr(inference_sidecar, "sidecar_request", lambda *args, **kwargs: iter(replies))
+    backend = RemoteBackend(socket="unused")
+
+    replies[:] = [{"text": "a "}, {"text": "b"}, {"done": True, "texts": ["a b"]}]
+    assert backend.generate("prompt") == "a b"
+    replies[:] = [{"text": "a "}, {"done": True}]
+    with pytest.raises(inference_sidecar.SidecarError):
+        backend.generate("prompt")
@@ -0,0 +1,42 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from inference_sidecar import InferenceSidecar
+
+
+class _Backend:
+    name = "fake"
+    model_name = "fake"
+    tokenizer = None
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.streaming = threading.Semaphore(0)
+
+    def generate(self, prompt, streamer=None, **params):
+        self.streaming.release()
+        assert self.release.wait(10)
+        return prompt
+
+    def generate_batch(self, prompts, batch_size=4, **params):
+        return [prompt.upper() for prompt in prompts]
+
+
+def test_streams_do_not_hold_up_batched_generation(make_engine):
+    backend = _Backend()
+    sidecar = InferenceSidecar(backend, make_engine(), registry=object(), socket_path="unused",
+                               window=0.001, max_streams=1)
+    stream = {"op": "generate", "prompts": ["streamed"], "stream": True}
+    with ThreadPoolExecutor(3) as pool:
+        first = pool.submit(sidecar.handle, None, stream)
+        assert backend.streaming.acquire(timeout=10)
+        # A second stream waits for the one slot; batched requests go ahead
+        second = pool.submit(sidecar.handle, None, stream)
+        reply = pool.submit(sidecar.handle, None, {"op": "generate", "prompts": ["a", "b"]}).result(timeout=10)
+        assert reply == {"texts": ["A", "B"]}
+        assert not backend.streaming.acquire(timeout=0.2)
+        assert sidecar.streams_active == 1
+
+        backend.release.set()
+        assert first.result(timeout=10) == second.result(timeout=10) == {"texts": ["streamed"]}
+    assert sidecar.streams == 2 and sidecar.streams_active == 0
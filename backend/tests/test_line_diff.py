@@ -0,0 +1,93 @@
+import difflib
+import random
+
+import pytest
+
+from diff_detector import get_detailed_diff
+from line_diff import EditLimitExceeded, diff_files, diff_opcodes, unique_matches
+
+
+def _apply(a, b, opcodes):
+    """b rebuilt from a and the inserted lines; checks the opcodes tile both sequences"""
+    rebuilt, i, j = [], 0, 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert (i1, j1) == (i, j)
+        if tag == "equal":
+            assert a[i1:i2] == b[j1:j2]
+            rebuilt.extend(a[i1:i2])
+        else:
+            rebuilt.extend(b[j1:j2])
+        i, j = i2, j2
+    assert (i, j) == (len(a), len(b))
+    return rebuilt
+
+
+def _matched(opcodes):
+    return sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == "equal")
+
+
+def _write(path, lines):
+    path.write_text("".join(f"{line}\n" for line in lines))
+    return str(path)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_opcodes_rebuild_the_new_sequence(seed):
+    rng = random.Random(seed)
+    alphabet = "abcdefgh"[:rng.randint(2, 8)]
+    a = [rng.choice(alphabet) for _ in range(rng.randint(0, 30))]
+    b = [rng.choice(alphabet) for _ in range(rng.randint(0, 30))]
+    opcodes = list(diff_opcodes(a, b))
+    assert _apply(a, b, opcodes) == b
+    # Consecutive opcodes never share a tag, as with difflib
+    assert all(x[0] != y[0] for x, y in zip(opcodes, opcodes[1:]))
+    # Unique lines anchor the path, so it matches at least what they and the ends allow
+    anchors, _ = unique_matches(a, b)
+    assert _matched(opcodes) >= len(anchors)
+
+
+@pytest.mark.parametrize("old, new", [
+    ("abcdef", "abXdef"),    # replace
+    ("abcdef", "abdef"),     # delete
+    ("abcdef", "abcXYdef"),  # insert
+    ("abcdef", "Xbcdeg"),    # changes at both ends
+    ("", "abc"),
+    ("abc", ""),
+    ("abc", "abc"),
+])
+def test_opcodes_match_difflib_on_simple_edits(old, new):
+    a, b = list(old), list(new)
+    assert list(diff_opcodes(a, b)) == difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+def test_diff_files_matches_get_detailed_diff(tmp_path):
+    old = [f"line {i}" for i in range(60)]
+    new = old[:10] + ["inserted"] + old[10:30] + ["changed 30"] + old[31:55] + old[57:]
+    details = diff_files(_write(tmp_path / "old.txt", old), _write(tmp_path / "new.txt", new))
+    expected = get_detailed_diff("".join(f"{line}\n" for line in old), "".join(f"{line}\n" for line in new))
+    ratio = details.pop("ratio")
+    assert details == expected
+    assert ratio == pytest.approx(difflib.SequenceMatcher(None, old, new).ratio())
+
+
+def test_edit_limit(tmp_path):
+    a = [f"row {i}" for i in range(100)]
+    b = [line + " changed" if i % 10 == 0 else line for i, line in enumerate(a)]
+    edits = 2 * 10  # each changed row is one delete and one insert
+    assert _matched(list(diff_opcodes(a, b, max_edits=edits))) == 90
+    with pytest.raises(EditLimitExceeded):
+        list(diff_opcodes(a, b, max_edits=edits - 2))
+
+
+def test_dissimilar_files_are_rejected_early(tmp_path):
+    rng = random.Random(0)
+    old = [f"row {i} {rng.random()}" for i in range(3000)]
+    shuffled = old[:]
+    rng.shuffle(shuffled)
+    halved = [line if i % 2 else line + " changed" for i, line in enumerate(old)]
+    old_path = _write(tmp_path / "old.txt", old)
+
+    assert diff_files(old_path, _write(tmp_path / "shuffled.txt", shuffled), min_ratio=0.6) is None
+    assert diff_files(old_path, _write(tmp_path / "halved.txt", halved), min_ratio=0.6) is None
+    edited = [line + " changed" if i % 10 == 0 else line for i, line in enumerate(old)]
+    assert diff_files(old_path, _write(tmp_path / "edited.txt", edited), min_ratio=0.6)["ratio"] == pytest.approx(0.9)
@@ -0,0 +1,59 @@
+from llama_model import LlamaAnalyzer, group_by_token_budget
+from response_cache import ResponseCache
+
+DIFFERENCES = [
+    {"file": "auth.md", "type": "modified", "description": "Token lifetime changed", "details": {}},
+    {"file": "deploy.md", "type": "deleted", "description": "Deploy guide removed", "details": {}},
+]
+
+
+def _analyzer(tmp_path, **config):
+    return LlamaAnalyzer(response_cache=ResponseCache(cache_dir=str(tmp_path / "responses")),
+                         config={"backend": "stub", **config})
+
+
+def test_stream_falls_back_when_planning_fails(tmp_path, monkeypatch):
+    analyzer = _analyzer(tmp_path)
+    assert analyzer.generator is not None
+
+    def fail(*args):
+        raise RuntimeError("map phase failed")
+
+    monkeypatch.setattr(analyzer, "_plan_prompt", fail)
+    expected = analyzer._rule_based_analysis(DIFFERENCES, [])
+    assert analyzer.analyze_impact(DIFFERENCES, []) == expected
+    assert list(analyzer.stream_impact(DIFFERENCES, [])) == [expected]
+
+
+def test_group_by_token_budget_keeps_order_and_budget():
+    lines = ["a b\n", "c d e\n", "f\n", "g h i j k l m\n", "n o\n"]
+    groups = group_by_token_budget(lines, lambda line: len(line.split()), 4)
+    assert [line for group in groups for line in group] == lines
+    assert groups == [["a b\n"], ["c d e\n", "f\n"], ["g h i j k l m\n"], ["n o\n"]]
+
+
+def test_oversized_change_sets_are_mapped_and_reduced_within_budget(tmp_path, monkeypatch):
+    budget = 300
+    analyzer = _analyzer(tmp_path, prompt_token_budget=budget)
+    differences = [{"file": f"guide{i}.md", "type": "modified",
+                    "description": f"Section {i} on token refresh rewritten", "details": {}} for i in range(60)]
+    small = analyzer._plan_prompt(DIFFERENCES, [])
+    assert small == analyzer._create_analysis_prompt(DIFFERENCES, [])
+
+    mapped = []
+    run_map = analyzer._run_map
+    monkeypatch.setattr(analyzer, "_run_map", lambda prompts: mapped.append(prompts) or run_map(prompts))
+    prompt = analyzer._plan_prompt(differences, [])
+    assert "PARTIAL ANALYSES" in prompt
+    assert analyzer.count_tokens(prompt) <= budget
+
+    # Every change line is summarized in exactly one map prompt, and each prompt fits the budget
+    parts = mapped[0]
+    assert len(parts) > 1
+    assert all(analyzer.count_tokens(part) <= budget for part in parts)
+    for line in analyzer._change_lines(differences):
+        assert sum(line in part for part in parts) == 1
+
+    # Summaries are cached per prompt, so planning again generates nothing
+    monkeypatch.setattr(analyzer.generator, "generate_batch", None)
+    assert analyzer._plan_prompt(differences, []) == prompt
@@ -0,0 +1,39 @@
+import os
+
+import manifest
+from conftest import corpus_text, write_corpus
+from manifest import DiffCache, load_manifest, scan_folder
+
+
+def test_unchanged_files_are_not_read_again(tmp_path, monkeypatch):
+    folder = str(tmp_path / "corpus")
+    write_corpus(folder, {f"doc{i}.txt": corpus_text(i) for i in range(4)})
+    first = scan_folder(folder, workers=1)
+    assert load_manifest(folder) == first
+
+    read = []
+    fingerprint = manifest._fingerprint_file
+    monkeypatch.setattr(manifest, "_fingerprint_file", lambda path, size: read.append(path) or fingerprint(path, size))
+    assert scan_folder(folder, workers=1) == first and read == []
+
+    # A changed size or mtime is read again; the other entries are reused as they were
+    write_corpus(folder, {"doc1.txt": corpus_text(99)})
+    os.utime(os.path.join(folder, "doc2.txt"), ns=(1, 1))
+    second = scan_folder(folder, workers=1)
+    assert sorted(os.path.basename(path) for path in read) == ["doc1.txt", "doc2.txt"]
+    assert second["doc1.txt"]["digest"] != first["doc1.txt"]["digest"]
+    assert second["doc2.txt"]["digest"] == first["doc2.txt"]["digest"]
+    assert second["doc0.txt"] == first["doc0.txt"]
+
+    # Without persist nothing is reused or saved
+    read.clear()
+    scan_folder(folder, persist=False, workers=1)
+    assert len(read) == 4 and load_manifest(folder) == second
+
+
+def test_diff_cache_round_trip(tmp_path):
+    cache = DiffCache(str(tmp_path))
+    assert cache.get("ab" * 16, "cd" * 16) is None
+    cache.put("ab" * 16, "cd" * 16, {"similar": True, "details": {"ratio": 0.9}})
+    assert cache.get("ab" * 16, "cd" * 16) == {"similar": True, "details": {"ratio": 0.9}}
+    assert cache.get("cd" * 16, "ab" * 16) is None
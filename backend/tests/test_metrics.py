@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from metrics import STAGE_SECONDS, Counter, Gauge, Histogram, Registry, collect_timings, span
+
+
+def test_render_in_the_text_format():
+    registry = Registry()
+    requests = registry._get_or_create(Counter, "cia_test_total", "Lookups", ("path",))
+    requests.inc(path='a"b\\c')
+    requests.inc(2, path='a"b\\c')
+    registry._get_or_create(Gauge, "cia_test_ready", "Ready").set(1)
+    latency = registry._get_or_create(Histogram, "cia_test_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, route="/")
+
+    assert registry.render().splitlines() == [
+        "# HELP cia_test_ready Ready",
+        "# TYPE cia_test_ready gauge",
+        "cia_test_ready 1",
+        "# HELP cia_test_seconds Latency",
+        "# TYPE cia_test_seconds histogram",
+        'cia_test_seconds_bucket{route="/",le="0.1"} 1',
+        'cia_test_seconds_bucket{route="/",le="1"} 2',
+        'cia_test_seconds_bucket{route="/",le="+Inf"} 3',
+        'cia_test_seconds_sum{route="/"} 5.55',
+        'cia_test_seconds_count{route="/"} 3',
+        "# HELP cia_test_total Lookups",
+        "# TYPE cia_test_total counter",
+        'cia_test_total{path="a\\"b\\\\c"} 3',
+    ]
+
+
+def test_misuse_is_rejected():
+    registry = Registry()
+    requests = registry._get_or_create(Counter, "cia_test_total", "Lookups", ("path",))
+    assert registry._get_or_create(Counter, "cia_test_total", "Lookups", ("path",)) is requests
+    with pytest.raises(ValueError):
+        registry._get_or_create(Gauge, "cia_test_total", "Lookups", ("path",))
+    with pytest.raises(ValueError):
+        requests.inc(route="/")
+    with pytest.raises(ValueError):
+        requests.inc(-1, path="/")
+
+
+def _run_span(stage):
+    with span(stage):
+        pass
+
+
+def test_spans_reach_only_the_active_timings():
+    def count():
+        return STAGE_SECONDS._values.get(("test_stage",), [None, 0.0, 0])[2]
+
+    before = count()
+    with collect_timings() as timings:
+        with span("test_stage"):
+            pass
+        with span("test_stage"):
+            # Another thread has its own context, so its spans are not this request's
+            worker = threading.Thread(target=_run_span, args=("test_stage",))
+            worker.start()
+            worker.join()
+    with span("test_stage"):
+        pass
+
+    assert timings.to_dict()["test_stage"]["count"] == 2
+    assert timings.to_dict()["test_stage"]["seconds"] >= 0
+    assert count() == before + 4
+
+
+def test_metrics_endpoint_renders_requests_and_models():
+    from fastapi.testclient import TestClient
+
+    import app
+
+    client = TestClient(app.app)
+    assert client.get("/").status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE cia_http_request_duration_seconds histogram" in lines
+    assert 'cia_http_request_duration_seconds_count{method="GET",route="/",status="200"}' in response.text
+    assert f'cia_model_ready{{model="rag_engine"}} {int(app.rag_engine.ready)}' in lines
+    assert 'cia_jobs_active 0' in lines
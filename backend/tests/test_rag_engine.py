@@ -0,0 +1,98 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from conftest import corpus_text, write_corpus
+from index_backends import INDEX_KINDS, PQ_MIN_TRAIN, base_index, normalize
+
+INDEX_TYPES = {
+    "flat": faiss.IndexFlatIP,
+    "hnsw": faiss.IndexHNSWFlat,
+    "ivf_flat": faiss.IndexIVFFlat,
+    "ivf_pq": faiss.IndexIVFPQ,
+}
+NEW_TEXT = "quokka zebra walrus narwhal okapi tapir\n" * 6
+
+
+def _corpus(kind: str):
+    # ivf_pq falls back to ivf_flat below PQ_MIN_TRAIN vectors
+    files = 110 if kind == "ivf_pq" else 12
+    lines = 120 if kind == "ivf_pq" else 40
+    return {f"doc{i}.txt": corpus_text(i, lines) for i in range(files)}
+
+
+@pytest.mark.parametrize("kind", INDEX_KINDS)
+def test_build_cached_load_and_update(kind, make_engine, tmp_path):
+    folder = str(tmp_path / "corpus")
+    write_corpus(folder, _corpus(kind))
+    options = {"index_kind": kind, "chunk_window": 100, "chunk_overlap": 0}
+
+    built = make_engine(**options)
+    built.build_index(folder)
+    assert isinstance(base_index(built.index), INDEX_TYPES[kind])
+    if kind == "ivf_pq":
+        assert built.index.ntotal >= PQ_MIN_TRAIN
+
+    # A second engine gets the index from the cache, memory-mapped where faiss allows it
+    loaded = make_engine(**options)
+    assert loaded.load_index(built.fingerprint, folder)
+    assert loaded.store.chunk_count == built.store.chunk_count
+
+    write_corpus(folder, {"doc1.txt": NEW_TEXT})
+    os.remove(os.path.join(folder, "doc2.txt"))
+    summary = loaded.update_index(folder, ["doc1.txt", "doc2.txt"])
+    assert summary["mode"] == "incremental"
+    assert summary["updated"] == 1 and summary["removed"] == 1
+    assert loaded.mapped_index_path is None
+
+    hits = loaded.search_related(NEW_TEXT.splitlines()[0], top_k=5)
+    assert "doc1.txt" in [hit["file_name"] for hit in hits]
+    assert all(hit["file_name"] != "doc2.txt"
+               for hit in loaded.search_related(corpus_text(2, 2), top_k=10))
+
+    # The updated index was cached under its new fingerprint and can be changed again
+    reloaded = make_engine(**options)
+    assert reloaded.load_index(loaded.fingerprint, folder)
+    assert reloaded.store.chunk_count == loaded.store.chunk_count
+    write_corpus(folder, {"doc3.txt": NEW_TEXT})
+    assert reloaded.update_index(folder, ["doc3.txt"])["updated"] == 1
+
+
+def test_update_reindexes_every_changed_file(make_engine, tmp_path):
+    folder = str(tmp_path / "corpus")
+    write_corpus(folder, _corpus("flat"))
+    engine = make_engine(chunk_window=100, chunk_overlap=0)
+    engine.build_index(folder)
+
+    # doc2 changed too but was not reported; the index saved under the new fingerprint has it
+    write_corpus(folder, {"doc1.txt": NEW_TEXT, "doc2.txt": NEW_TEXT.upper(), "new.txt": NEW_TEXT})
+    os.remove(os.path.join(folder, "doc3.txt"))
+    summary = engine.update_index(folder, ["doc1.txt"])
+    assert summary["updated"] == 3 and summary["removed"] == 1
+
+    reloaded = make_engine(chunk_window=100, chunk_overlap=0)
+    assert reloaded.load_index(engine.fingerprint, folder)
+    assert sorted(reloaded.digests) == sorted(os.listdir(folder))
+    rebuilt = make_engine(chunk_window=100, chunk_overlap=0)
+    rebuilt.build_index(folder, use_cache=False)
+    assert reloaded.store.chunk_count == rebuilt.store.chunk_count
+    hits = reloaded.search_related(NEW_TEXT.upper().splitlines()[0], top_k=3)
+    assert hits[0]["file_name"] == "doc2.txt"
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf_flat"])
+def test_related_contexts_leave_the_embedding_cache_alone(kind, make_engine, tmp_path):
+    folder = str(tmp_path / "corpus")
+    write_corpus(folder, {f"doc{i}.txt": corpus_text(i) for i in range(12)})
+    engine = make_engine(index_kind=kind, chunk_window=100, chunk_overlap=0)
+    engine.build_index(folder, use_cache=False)
+
+    before = engine.cache_stats()
+    contexts = engine.related_contexts([corpus_text(3, 2), corpus_text(7, 2)])
+    assert len(contexts) > 1 and engine.cache_stats() == before
+
+    # Vectors read back from the index (averaged for merged passages) track encoding them again
+    expected = normalize(engine._encode([context["content"] for context in contexts]))
+    assert ((engine.passage_vectors(contexts) * expected).sum(axis=1) > 0.95).all()
@@ -0,0 +1,89 @@
+import os
+import time
+import threading
+
+import pytest
+
+from response_cache import ResponseCache
+
+
+def test_streams_share_one_generation(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    release = threading.Event()
+    calls = []
+
+    def produce():
+        calls.append(1)
+        yield "first "
+        release.wait(5)
+        yield "second"
+
+    leader = cache.stream_or_compute("k", produce)
+    assert next(leader) == "first "
+    # A streamed and a plain follower both join the leader's generation mid-stream
+    follower = cache.stream_or_compute("k", produce)
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(cache.get_or_compute("k", lambda: "recomputed")))
+    waiter.start()
+    assert next(follower) == "first "
+    while cache.stats()["deduplicated"] < 2:
+        time.sleep(0.01)
+    release.set()
+    assert list(follower) == ["second"]
+    # The leader's reader going away does not stop the text from being cached
+    leader.close()
+    waiter.join(5)
+
+    assert waited == ["first second"] and len(calls) == 1
+    assert list(cache.stream_or_compute("k", produce)) == ["first second"]
+    assert cache.stats()["misses"] == 1 and cache.stats()["deduplicated"] == 2
+
+
+def test_stream_errors_reach_every_reader(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+
+    def produce():
+        yield "partial"
+        raise RuntimeError("model failed")
+
+    pieces = []
+    with pytest.raises(RuntimeError, match="model failed"):
+        for piece in cache.stream_or_compute("k", produce):
+            pieces.append(piece)
+    assert pieces == ["partial"] and cache.get("k") is None
+
+
+def test_disk_tier_is_scanned_only_over_budget(tmp_path):
+    cache = ResponseCache(memory_entries=1, max_bytes=1000, cache_dir=str(tmp_path))
+    scans = []
+    evict = cache._evict_disk
+    cache._evict_disk = lambda: scans.append(1) or evict()
+
+    cache.put("first", "x" * 100)
+    assert len(scans) == 1  # the first write counts what is already there
+    for i in range(20):
+        cache.put(f"k{i}", "x" * 100)
+    assert 1 < len(scans) < 20
+    sizes = [entry.stat().st_size for entry in os.scandir(str(tmp_path)) if entry.name.endswith(".json")]
+    stats = cache.stats()
+    assert stats["disk_entries"] == len(sizes) and stats["disk_bytes"] == sum(sizes)
+    assert stats["disk_bytes"] <= 1000 + max(sizes)
+    # The most recently written entries are the ones kept
+    assert cache.get("k19") is not None and cache.get("first") is None
+
+
+def test_leader_finishing_during_a_lookup_is_not_recomputed(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    read_disk = cache._read_disk
+    interleaved = []
+
+    def read_disk_while_another_request_finishes(key):
+        value = read_disk(key)
+        if not interleaved:
+            interleaved.append(None)
+            interleaved[0] = cache.get_or_compute(key, lambda: "leader")
+        return value
+
+    cache._read_disk = read_disk_while_another_request_finishes
+    assert cache.get_or_compute("k", lambda: "recomputed") == "leader"
+    assert interleaved == ["leader"] and cache.stats()["misses"] == 1
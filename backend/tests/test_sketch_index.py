@@ -0,0 +1,64 @@
+import os
+import random
+
+import diff_detector
+from conftest import write_corpus
+from diff_detector import MATCH_CANDIDATES, compare_documents
+from sketch_index import SketchIndex, build_sketch, estimate_similarity, merge_sketches
+
+VOCABULARY = [f"w{i}" for i in range(2000)]
+
+
+def _document(seed: int, lines: int = 30) -> str:
+    rng = random.Random(seed)
+    return "".join(" ".join(rng.choices(VOCABULARY, k=10)) + "\n" for _ in range(lines))
+
+
+def _edit(text: str, seed: int) -> str:
+    lines = text.splitlines(keepends=True)
+    lines[random.Random(seed).randrange(len(lines))] = "an edited line of text\n"
+    return "".join(lines)
+
+
+def test_sketch_similarity_tracks_jaccard():
+    text = _document(1)
+    assert estimate_similarity(build_sketch(text), build_sketch(text)) == 1.0
+    assert estimate_similarity(build_sketch(text), build_sketch(_edit(text, 1))) > 0.8
+    assert estimate_similarity(build_sketch(text), build_sketch(_document(2))) < 0.05
+    assert estimate_similarity(build_sketch(text), ()) == 0.0
+    # The sketch of a file read in pieces is the sketch of the whole, up to the shingles across the cut
+    half = len(text.splitlines()) // 2
+    head, tail = "".join(text.splitlines(True)[:half]), "".join(text.splitlines(True)[half:])
+    assert estimate_similarity(merge_sketches(build_sketch(head), build_sketch(tail)), build_sketch(text)) > 0.9
+
+
+def test_candidates_recall_edited_documents():
+    index = SketchIndex()
+    for i in range(300):
+        index.add(f"doc{i}", build_sketch(_document(i)))
+    for i in range(300):
+        candidates = index.candidates(build_sketch(_edit(_document(i), i)), top_n=MATCH_CANDIDATES)
+        assert candidates[0][0] == f"doc{i}" and candidates[0][1] > 0.8
+    assert index.candidates(build_sketch("nothing in common here at all"), top_n=3) == []
+
+
+def test_renamed_files_are_paired_without_scoring_every_pair(tmp_path, monkeypatch):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    write_corpus(old, {f"a/doc{i}.txt": _document(i) for i in range(120)})
+    write_corpus(new, {f"b/doc{i}.txt": _edit(_document(i), i) for i in range(120)})
+    # Short files share no shingles after a one-word edit; an orphan is scored by size alone
+    write_corpus(old, {"short.txt": "alpha beta gamma", "tiny.txt": "x"})
+    write_corpus(new, {"short_renamed.txt": "alpha beta delta", "huge.txt": _document(999, 400)})
+    monkeypatch.setattr(diff_detector, "EXHAUSTIVE_MATCH_PAIRS", 0)
+
+    scored = []
+    score = diff_detector._score_pair_args
+    monkeypatch.setattr(diff_detector, "_score_pair_args", lambda paths: scored.append(paths) or score(paths))
+    differences = compare_documents(old, new, use_cache=False, workers=1)
+
+    # Every renamed file is scored against its origin, and few other pairs are
+    pairs = {(os.path.relpath(o, old), os.path.relpath(n, new)) for o, n in scored}
+    assert {(f"a/doc{i}.txt", f"b/doc{i}.txt") for i in range(120)} <= pairs
+    assert len(scored) <= 122 * MATCH_CANDIDATES
+    assert ("short.txt", "short_renamed.txt") in pairs and not any(n == "huge.txt" for _, n in pairs)
+    assert "short.txt → short_renamed.txt" in {d["file"] for d in differences if d["type"] == "modified"}
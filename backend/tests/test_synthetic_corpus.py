@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+from synthetic_corpus import generate_corpus
+
+OPTIONS = {"files": 60, "file_size": 1500, "rename_rate": 0.1, "delete_rate": 0.05, "add_rate": 0.05,
+           "encodings": ("utf-8", "latin-1", "utf-16"), "seed": 3}
+
+
+def _tree(folder):
+    contents = {}
+    for name in os.listdir(folder):
+        with open(os.path.join(folder, name), 'rb') as f:
+            contents[name] = f.read()
+    return contents
+
+
+def test_same_arguments_give_the_same_trees(tmp_path):
+    first = generate_corpus(str(tmp_path / "a"), **OPTIONS)
+    second = generate_corpus(str(tmp_path / "b"), **OPTIONS)
+    for side in ("old_folder", "new_folder"):
+        assert _tree(first[side]) == _tree(second[side])
+    assert {k: v for k, v in first.items() if not k.endswith("_folder")} == \
+        {k: v for k, v in second.items() if not k.endswith("_folder")}
+    other = generate_corpus(str(tmp_path / "c"), **dict(OPTIONS, seed=4))
+    assert _tree(other["old_folder"]) != _tree(first["old_folder"])
+
+
+def test_ground_truth_describes_the_trees(tmp_path):
+    truth = generate_corpus(str(tmp_path), **OPTIONS)
+    with open(tmp_path / "truth.json") as f:
+        assert json.load(f) == json.loads(json.dumps(truth))
+    old, new = _tree(truth["old_folder"]), _tree(truth["new_folder"])
+    renamed = {pair["old"]: pair for pair in truth["renamed"]}
+    assert all(truth[kind] for kind in ("modified", "renamed", "deleted", "added"))
+    assert len(old) == OPTIONS["files"]
+    assert len(truth["modified"]) + len(renamed) + len(truth["deleted"]) + truth["unchanged"] == len(old)
+    assert len(new) == len(old) - len(truth["deleted"]) + len(truth["added"])
+
+    for name, data in old.items():
+        if name in truth["deleted"]:
+            assert name not in new
+        elif name in renamed:
+            assert name not in new
+            assert (new[renamed[name]["new"]] != data) == renamed[name]["edited"]
+        elif name in truth["modified"]:
+            assert new[name] != data
+        else:
+            assert new[name] == data
+    assert all(name in new and name not in old for name in truth["added"])
+
+    # Every requested encoding is used
+    found = set()
+    for data in old.values():
+        if data.startswith(b"\xff\xfe"):
+            found.add("utf-16")
+        elif not data.isascii():
+            try:
+                data.decode("utf-8")
+                found.add("utf-8")
+            except UnicodeDecodeError:
+                found.add("latin-1")
+    assert found == set(OPTIONS["encodings"])
+
+
+def test_differ_agrees_on_exact_changes(tmp_path):
+    from diff_detector import compare_documents
+
+    truth = generate_corpus(str(tmp_path), **dict(OPTIONS, encodings=("utf-8",)))
+    differences = compare_documents(truth["old_folder"], truth["new_folder"], use_cache=False, workers=1)
+    by_type = {kind: {d["file"] for d in differences if d["type"] == kind}
+               for kind in ("modified", "deleted", "added")}
+    # Renames show up as a deleted and an added file besides the pairing
+    moved = truth["renamed"]
+    assert by_type["deleted"] == set(truth["deleted"]) | {pair["old"] for pair in moved}
+    assert by_type["added"] == set(truth["added"]) | {pair["new"] for pair in moved}
+    for pair in moved:
+        if not pair["edited"]:
+            assert f"{pair['old']} → {pair['new']}" in by_type["modified"]
+    # Edits in place are only reported for files that were edited
+    in_place = {old for old, _, new in (d.partition(" → ") for d in by_type["modified"]) if old == new}
+    assert in_place and in_place <= set(truth["modified"])
+
+
+def test_unknown_encodings_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        generate_corpus(str(tmp_path), files=1, encodings=("cp1252",))
@@ -0,0 +1,88 @@
+import os
+
+from conftest import write_corpus
+from diff_detector import compare_documents
+from manifest import scan_folder
+from tree_walker import IgnoreRules, looks_binary, walk_tree
+from utils import decode_bytes
+
+
+def _write_bytes(folder, name, data: bytes):
+    path = os.path.join(folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_ignore_rules():
+    rules = IgnoreRules(["# comment", "*.log", "!keep.log", "build/", "/top.txt", "docs/**/draft*", "a?c.md"])
+    assert rules.match("x/error.log", False) is True
+    assert rules.match("x/keep.log", False) is False
+    assert rules.match("build", True) is True
+    assert rules.match("build", False) is None  # directories only
+    assert rules.match("top.txt", False) is True
+    assert rules.match("sub/top.txt", False) is None  # anchored to the base
+    assert rules.match("docs/a/b/draft1.md", False) is True
+    assert rules.match("abc.md", False) is True and rules.match("a/c.md", False) is None
+
+    nested = IgnoreRules(["*.tmp"], base="sub")
+    assert nested.match("sub/x.tmp", False) is True
+    assert nested.match("other/x.tmp", False) is None
+
+
+def test_walk_applies_ignore_files_and_patterns(tmp_path):
+    root = str(tmp_path)
+    write_corpus(root, {
+        ".gitignore": "*.log\nbuild/\n",
+        "doc.txt": "a", "error.log": "a", "build/out.txt": "a", ".git/config": "a",
+        "sub/.ciaignore": "!important.log\nsecret.txt\n", "sub/important.log": "a", "sub/secret.txt": "a",
+        "sub/notes.md": "a", "node_modules/pkg/index.js": "a",
+    })
+    assert list(walk_tree(root)) == ["doc.txt", "sub/important.log", "sub/notes.md"]
+    assert list(walk_tree(root, exclude=["*.md"])) == ["doc.txt", "sub/important.log"]
+    assert list(walk_tree(root, include=["*.md"])) == ["sub/notes.md"]
+    assert "error.log" in walk_tree(root, ignore_files=False)
+
+
+def test_binary_sniffing(tmp_path):
+    assert looks_binary(b"PK\x03\x04\x00\x00")
+    assert not looks_binary(b"plain text\n")
+    assert not looks_binary("utf-16 text".encode("utf-16"))
+    assert not looks_binary("utf-32 text".encode("utf-32"))
+
+    root = str(tmp_path)
+    _write_bytes(root, "image.png", b"\x89PNG\r\n\x00\x00" * 10)
+    _write_bytes(root, "wide.txt", "wide text\n".encode("utf-16"))
+    manifest = scan_folder(root, persist=False)
+    assert manifest["image.png"]["binary"] and not manifest["wide.txt"]["binary"]
+
+
+def test_text_is_decoded_by_its_byte_order_mark():
+    for encoding in ("utf-16", "utf-16-be", "utf-32", "utf-32-le", "utf-8-sig"):
+        data = "héllo wörld\n".encode(encoding)
+        if encoding.endswith(("-be", "-le")):
+            data = {"utf-16-be": b"\xfe\xff", "utf-32-le": b"\xff\xfe\x00\x00"}[encoding] + data
+        assert decode_bytes(data) == "héllo wörld\n"
+    assert decode_bytes("héllo".encode("utf-8")) == "héllo"
+    assert decode_bytes("héllo".encode("latin-1")) == "héllo"
+
+
+def test_files_over_the_size_limit_are_reported(tmp_path, make_engine):
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    write_corpus(old, {"big.csv": "a,b\n" * 100, "small.txt": "alpha beta gamma\n"})
+    write_corpus(new, {"big.csv": "a,c\n" * 100, "small.txt": "alpha beta gamma\n"})
+
+    files = walk_tree(old, max_file_bytes=100)
+    assert files["big.csv"].too_large and not files["small.txt"].too_large
+    old_manifest = scan_folder(old, persist=False, max_file_bytes=100)
+    new_manifest = scan_folder(new, persist=False, max_file_bytes=100)
+    assert old_manifest["big.csv"]["skipped"] == "too_large"
+
+    differences = compare_documents(old, new, use_cache=False, workers=1,
+                                    old_manifest=old_manifest, new_manifest=new_manifest)
+    assert [(d["file"], d["type"]) for d in differences] == [("big.csv", "skipped")]
+    assert differences[0]["details"] == {"reason": "too_large", "size": 400}
+
+    engine = make_engine()
+    engine.build_index(new, use_cache=False, manifest=new_manifest)
+    assert engine.store.document_count == 1
@@ -0,0 +1,209 @@
+import os
+import re
+import logging
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated gitignore-style patterns applied to every walk
+INCLUDE_PATTERNS = [p for p in os.environ.get("CIA_INCLUDE", "").split(",") if p.strip()]
+EXCLUDE_PATTERNS = [p for p in os.environ.get("CIA_EXCLUDE", "").split(",") if p.strip()]
+# Files above this size are listed but not read, and reported as skipped; 0 means no limit
+MAX_FILE_BYTES = int(os.environ.get("CIA_MAX_FILE_BYTES", "0"))
+# Threads reading and fingerprinting files
+IO_WORKERS = int(os.environ.get("CIA_IO_WORKERS", "0")) or min(32, (os.cpu_count() or 1) + 4)
+# Per-directory ignore files, read like .gitignore
+IGNORE_FILES = (".gitignore", ".ciaignore")
+# Version control and tool directories, and the ignore files themselves, are never documents
+DEFAULT_EXCLUDES = (".git/", ".hg/", ".svn/", "__pycache__/", "node_modules/", ".DS_Store") + IGNORE_FILES
+# Bytes looked at to decide whether a file is binary
+BINARY_SNIFF_BYTES = 8192
+# Byte order marks of the encodings whose text legitimately contains NUL bytes
+_WIDE_BOMS = (b"\xff\xfe", b"\xfe\xff")
+
+FILES_SKIPPED = counter("cia_files_skipped_total", "Files left out of ingestion", ("reason",))
+
+
+class FileInfo(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    # Over the size limit: listed so it can be reported, but never read
+    too_large: bool = False
+
+
+def over_size_limit(size: int, max_file_bytes: Optional[int] = None) -> bool:
+    max_file_bytes = MAX_FILE_BYTES if max_file_bytes is None else max_file_bytes
+    return bool(max_file_bytes) and size > max_file_bytes
+
+
+def _translate(pattern: str) -> str:
+    """Regex body for one gitignore glob: * and ? stay within a path segment, ** crosses them"""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append(f"[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "".join(parts)
+
+
+class IgnoreRules:
+    """Gitignore-style patterns, matched against paths relative to base.
+
+    Supports comments, ! negation, trailing / for directories only, and patterns
+    anchored to base by a leading or inner /. The last matching pattern wins.
+    """
+
+    def __init__(self, patterns: Sequence[str], base: str = ""):
+        self.base = base
+        self.rules: List[Tuple[re.Pattern, bool, bool]] = []
+        for line in patterns:
+            line = line.rstrip("\n")
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            anchored = "/" in line
+            line = line.lstrip("/")
+            prefix = "^" if anchored else "^(?:.*/)?"
+            self.rules.append((re.compile(prefix + _translate(line) + "$"), negate, dir_only))
+
+    @classmethod
+    def from_file(cls, file_path: str, base: str = "") -> Optional["IgnoreRules"]:
+        try:
+            with open(file_path, 'r', encoding="utf-8", errors="replace") as f:
+                rules = cls(f.readlines(), base)
+        except OSError as e:
+            logger.warning(f"Could not read ignore file {file_path}: {str(e)}")
+            return None
+        return rules if rules.rules else None
+
+    def match(self, rel_path: str, is_dir: bool) -> Optional[bool]:
+        """True if ignored, False if re-included by a negation, None if no pattern matches"""
+        if self.base:
+            if not rel_path.startswith(self.base + "/"):
+                return None
+            rel_path = rel_path[len(self.base) + 1:]
+        result = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                result = not negate
+        return result
+
+
+def _is_ignored(chain: Sequence[IgnoreRules], rel_path: str, is_dir: bool) -> bool:
+    ignored = False
+    for rules in chain:
+        result = rules.match(rel_path, is_dir)
+        if result is not None:
+            ignored = result
+    return ignored
+
+
+def looks_binary(head: bytes) -> bool:
+    """NUL bytes mark a file as binary, unless it starts with a UTF-16/32 byte order mark"""
+    return b"\0" in head[:BINARY_SNIFF_BYTES] and not head.startswith(_WIDE_BOMS)
+
+
+def iter_tree(root: str, include: Optional[Sequence[str]] = None, exclude: Optional[Sequence[str]] = None,
+              max_file_bytes: Optional[int] = None, ignore_files: bool = True) -> Iterator[Tuple[str, FileInfo]]:
+    """Yield (relative POSIX path, FileInfo) for every file under root, in no particular order.
+
+    One os.scandir per directory; ignored directories are not entered. exclude adds to
+    DEFAULT_EXCLUDES and the .gitignore / .ciaignore files found on the way; when include is
+    given, only files matching one of its patterns are kept. Files over max_file_bytes are
+    yielded with too_large set, for callers to report rather than read. Symlinked
+    directories are not followed. Defaults come from CIA_INCLUDE, CIA_EXCLUDE and
+    CIA_MAX_FILE_BYTES.
+    """
+    include = INCLUDE_PATTERNS if include is None else include
+    exclude = EXCLUDE_PATTERNS if exclude is None else exclude
+    max_file_bytes = MAX_FILE_BYTES if max_file_bytes is None else max_file_bytes
+    include_rules = IgnoreRules(include) if include else None
+    base_chain = [IgnoreRules(DEFAULT_EXCLUDES), IgnoreRules(exclude)]
+
+    # An explicit stack instead of recursion, so depth is only bounded by memory
+    stack = [(root, "", base_chain)]
+    while stack:
+        dir_path, rel_dir, chain = stack.pop()
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError as e:
+            if not rel_dir:
+                raise
+            logger.warning(f"Could not list directory {dir_path}: {str(e)}")
+            continue
+
+        if ignore_files:
+            names = {entry.name for entry in entries}
+            local = [IgnoreRules.from_file(os.path.join(dir_path, name), rel_dir)
+                     for name in IGNORE_FILES if name in names]
+            local = [rules for rules in local if rules]
+            if local:
+                chain = chain + local
+
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not _is_ignored(chain, rel_path, True):
+                        stack.append((entry.path, rel_path, chain))
+                    continue
+                if not entry.is_file():
+                    continue
+                if _is_ignored(chain, rel_path, False) or (include_rules and not include_rules.match(rel_path, False)):
+                    FILES_SKIPPED.inc(reason="ignored")
+                    continue
+                stat = entry.stat()
+            except OSError as e:
+                logger.warning(f"Could not stat {entry.path}: {str(e)}")
+                FILES_SKIPPED.inc(reason="unreadable")
+                continue
+            too_large = over_size_limit(stat.st_size, max_file_bytes)
+            if too_large:
+                logger.info(f"Not reading {rel_path}: {stat.st_size} bytes is over the {max_file_bytes} byte limit")
+                FILES_SKIPPED.inc(reason="too_large")
+            yield rel_path, FileInfo(entry.path, stat.st_size, stat.st_mtime_ns, too_large)
+
+
+def walk_tree(root: str, **options) -> Dict[str, FileInfo]:
+    """All files under root keyed by relative POSIX path, sorted; options as for iter_tree"""
+    return dict(sorted(iter_tree(root, **options)))
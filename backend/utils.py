@@ -1,14 +1,64 @@
 import os
 import json
+import codecs
 from pathlib import Path
 import logging
 
+from tree_walker import iter_tree
+
 logger = logging.getLogger(__name__)
 
+# Root for manifests, diff results and other data reused across analysis runs
+CACHE_DIR = os.environ.get(
+    "CIA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "change_impact_analysis")
+)
+
 def ensure_directory(path: str):
     """Ensure directory exists, create if not"""
     Path(path).mkdir(parents=True, exist_ok=True)
 
+def get_cache_dir(name: str) -> str:
+    """Return (and create) a named subdirectory of the cache root"""
+    path = os.path.join(CACHE_DIR, name)
+    ensure_directory(path)
+    return path
+
+# Checked in order: the UTF-32 little-endian mark starts with the UTF-16 one
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+)
+
+def decode_bytes(data: bytes) -> str:
+    """Decode file bytes by their byte order mark, else as UTF-8, falling back to latin-1"""
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            # A span cut from a larger file may end partway through a character
+            return data.decode(encoding, errors='replace')
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+def resident_memory_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current where /proc is unavailable
+        return peak_memory_bytes()
+
+def peak_memory_bytes() -> int:
+    """Highest resident set size this process has reached"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
 def load_config(config_path: str = "config.json") -> dict:
     """Load configuration from JSON file"""
     try:
@@ -18,6 +68,20 @@ def load_config(config_path: str = "config.json") -> dict:
         logger.warning(f"Config file {config_path} not found, using defaults")
         return {}
 
+def inference_config() -> dict:
+    """The "inference" section of the config file, with CIA_* environment overrides"""
+    config = dict(load_config(os.environ.get("CIA_CONFIG", "config.json")).get("inference", {}))
+    overrides = {
+        "backend": os.environ.get("CIA_INFERENCE_BACKEND"),
+        "model": os.environ.get("CIA_GENERATOR_MODEL"),
+        "threads": os.environ.get("CIA_INFERENCE_THREADS"),
+        "socket": os.environ.get("CIA_INFERENCE_SOCKET"),
+    }
+    config.update({key: value for key, value in overrides.items() if value})
+    if "threads" in config:
+        config["threads"] = int(config["threads"])
+    return config
+
 def save_analysis_results(results: dict, output_path: str):
     """Save analysis results to file"""
     try:
@@ -29,8 +93,8 @@ def save_analysis_results(results: dict, output_path: str):
 
 def validate_folder_structure(folder_path: str) -> bool:
     """Validate if folder exists and contains files"""
-    if not os.path.exists(folder_path):
+    if not os.path.isdir(folder_path):
         return False
     
-    files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-    return len(files) > 0
\ No newline at end of file
+    # Stops at the first document the walk finds instead of listing the whole tree
+    return next(iter_tree(folder_path), None) is not None
\ No newline at end of file
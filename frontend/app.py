@@ -1,11 +1,13 @@
 import streamlit as st
 import requests
+import hashlib
+import io
 import json
 import os
+import tarfile
 import plotly.express as px
 import pandas as pd
-from pathlib import Path
-import tempfile
+import time
 
 st.set_page_config(
     page_title="Change Impact Analysis",
@@ -38,22 +40,127 @@ st.markdown("**Powered by RAG + LLaMA** | Analyze document changes and their imp
 # Sidebar
 st.sidebar.header("Configuration")
 backend_url = st.sidebar.text_input("Backend URL", value="http://127.0.0.1:8000")
+stream_results = st.sidebar.checkbox("Stream results as they are generated", value=True)
 
 # Test connection
 try:
     response = requests.get(f"{backend_url}/", timeout=5)
     if response.status_code == 200:
         st.sidebar.success("✅ Backend Connected")
+        if requests.get(f"{backend_url}/ready", timeout=5).status_code != 200:
+            st.sidebar.info("⏳ Models are still loading")
     else:
         st.sidebar.error("❌ Backend Error")
 except:
     st.sidebar.error("❌ Backend Unavailable")
 
-# Ensure tmpdirs persist in session
-if "old_tmpdir" not in st.session_state:
-    st.session_state.old_tmpdir = None
-if "new_tmpdir" not in st.session_state:
-    st.session_state.new_tmpdir = None
+# Uploads persist in session: content digests the backend has, and backend folders of file sets
+if "sent_digests" not in st.session_state:
+    st.session_state.sent_digests = set()
+if "snapshots" not in st.session_state:
+    st.session_state.snapshots = {}
+
+def content_digest(data) -> str:
+    """Same BLAKE2b digest the backend files blobs under"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def upload_version(files, retry=True):
+    """Backend folder holding these files; each file's content is sent at most once per session"""
+    digests = {file.name: content_digest(file.getbuffer()) for file in files}
+    key = tuple(sorted(digests.items()))
+    if key in st.session_state.snapshots:
+        return st.session_state.snapshots[key]
+    
+    unsent = [d for d in dict.fromkeys(digests.values()) if d not in st.session_state.sent_digests]
+    missing = set()
+    if unsent:
+        response = requests.post(f"{backend_url}/blobs/missing", json={"digests": unsent}, timeout=30)
+        response.raise_for_status()
+        missing = set(response.json()["missing"])
+    
+    archive = io.BytesIO()
+    known = {}
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for file in files:
+            digest = digests[file.name]
+            if digest not in missing:
+                known[file.name] = digest
+                continue
+            info = tarfile.TarInfo(file.name)
+            info.size = file.size
+            tar.addfile(info, io.BytesIO(file.getbuffer()))
+            missing.discard(digest)  # identical files go once
+    archive.seek(0)
+    
+    response = requests.post(
+        f"{backend_url}/snapshots",
+        files={"archive": ("upload.tar.gz", archive, "application/gzip")},
+        data={"files": json.dumps(known)},
+        timeout=(10, 600)
+    )
+    if response.status_code == 400 and known and retry:
+        # The backend lost content sent earlier in the session (e.g. its cache was cleared)
+        st.session_state.sent_digests.clear()
+        return upload_version(files, retry=False)
+    if response.status_code != 200:
+        raise RuntimeError(response.json().get("detail", "Upload failed"))
+    st.session_state.sent_digests.update(digests.values())
+    folder = st.session_state.snapshots[key] = response.json()["folder"]
+    return folder
+
+def iter_sse(response):
+    """Yield (event, data) pairs from a Server-Sent Events response"""
+    event, data = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+        elif not line and event:
+            yield event, json.loads("\n".join(data))
+            event, data = None, []
+
+def stream_analysis(old_folder, new_folder):
+    """Render differences, contexts and generated text as the backend sends them"""
+    status = st.empty()
+    status.info("Comparing documents...")
+    changes_area = st.empty()
+    impact_area = st.empty()
+    results = {"differences": [], "impact_analysis": "", "related_contexts_count": 0}
+    
+    with requests.post(
+        f"{backend_url}/analyze/stream",
+        params={"old_folder": old_folder, "new_folder": new_folder},
+        stream=True,
+        timeout=(10, 600)
+    ) as response:
+        if response.status_code == 429:
+            st.warning("The backend is busy with other analyses. Please try again shortly.")
+            return None
+        if response.status_code != 200:
+            st.error(f"Analysis failed: {response.json().get('detail', 'Unknown error')}")
+            return None
+        
+        for event, data in iter_sse(response):
+            if event == "differences":
+                results["differences"] = data
+                changes_area.markdown(f"**{len(data)} changes detected:** " + ", ".join(d["file"] for d in data[:20]))
+                status.info("Retrieving related documents...")
+            elif event == "contexts":
+                results["related_contexts_count"] = len(data)
+                status.info(f"Found {len(data)} related passages, generating impact analysis...")
+            elif event == "token":
+                results["impact_analysis"] += data
+                impact_area.markdown(results["impact_analysis"])
+            elif event == "error":
+                status.error(data["detail"])
+                return None
+            elif event == "done":
+                status.empty()
+    
+    if not results["differences"]:
+        results["impact"] = "No changes detected between document versions."
+    return results
 
 # Main interface
 col1, col2 = st.columns(2)
@@ -67,13 +174,11 @@ with col1:
     )
     old_folder = None
     if old_files:
-        st.session_state.old_tmpdir = tempfile.TemporaryDirectory()
-        old_folder = st.session_state.old_tmpdir.name
-        for file in old_files:
-            file_path = Path(old_folder) / file.name
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-        st.success(f"Uploaded {len(old_files)} old files")
+        try:
+            old_folder = upload_version(old_files)
+            st.success(f"Uploaded {len(old_files)} old files")
+        except Exception as e:
+            st.error(f"Upload failed: {str(e)}")
 
 with col2:
     st.subheader("📁 New Version")
@@ -84,13 +189,11 @@ with col2:
     )
     new_folder = None
     if new_files:
-        st.session_state.new_tmpdir = tempfile.TemporaryDirectory()
-        new_folder = st.session_state.new_tmpdir.name
-        for file in new_files:
-            file_path = Path(new_folder) / file.name
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-        st.success(f"Uploaded {len(new_files)} new files")
+        try:
+            new_folder = upload_version(new_files)
+            st.success(f"Uploaded {len(new_files)} new files")
+        except Exception as e:
+            st.error(f"Upload failed: {str(e)}")
 
 # Analysis section
 st.markdown("---")
@@ -100,26 +203,53 @@ with col2:
     if st.button("🔍 Analyze Changes", type="primary", use_container_width=True):
         if not old_folder or not new_folder:
             st.error("Please upload files for both old and new versions")
+        elif stream_results:
+            try:
+                data = stream_analysis(old_folder, new_folder)
+                if data is not None:
+                    st.session_state.analysis_results = data
+                    st.success("Analysis completed successfully!")
+                    st.rerun()
+            except requests.exceptions.Timeout:
+                st.error("Backend did not respond. Please try again.")
+            except Exception as e:
+                st.error(f"Error: {str(e)}")
         else:
-            with st.spinner("Analyzing changes... This may take a few minutes."):
-                try:
-                    response = requests.post(
-                        f"{backend_url}/analyze/",
-                        params={"old_folder": old_folder, "new_folder": new_folder},
-                        timeout=300
-                    )
+            try:
+                response = requests.post(
+                    f"{backend_url}/jobs/analyze",
+                    params={"old_folder": old_folder, "new_folder": new_folder},
+                    timeout=30
+                )
+                
+                if response.status_code == 202:
+                    job_id = response.json()["job_id"]
+                    progress_bar = st.progress(0.0, text="Queued...")
+                    deadline = time.time() + 1800
+                    while time.time() < deadline:
+                        job = requests.get(f"{backend_url}/jobs/{job_id}", timeout=10).json()
+                        progress_bar.progress(job["progress"], text=f"Analyzing changes... ({job['stage']})")
+                        if job["status"] in ("succeeded", "failed"):
+                            break
+                        time.sleep(1)
                     
-                    if response.status_code == 200:
-                        data = response.json()
-                        st.session_state.analysis_results = data
+                    result = requests.get(f"{backend_url}/jobs/{job_id}/result", timeout=30)
+                    if result.status_code == 200:
+                        st.session_state.analysis_results = result.json()
                         st.success("Analysis completed successfully!")
                         st.rerun()
+                    elif result.status_code == 409:
+                        st.error("Analysis timed out. Please try again.")
                     else:
-                        st.error(f"Analysis failed: {response.json().get('detail', 'Unknown error')}")
-                except requests.exceptions.Timeout:
-                    st.error("Analysis timed out. Please try again.")
-                except Exception as e:
-                    st.error(f"Error: {str(e)}")
+                        st.error(f"Analysis failed: {result.json().get('detail', 'Unknown error')}")
+                elif response.status_code == 429:
+                    st.warning("The backend is busy with other analyses. Please try again shortly.")
+                else:
+                    st.error(f"Analysis failed: {response.json().get('detail', 'Unknown error')}")
+            except requests.exceptions.Timeout:
+                st.error("Backend did not respond. Please try again.")
+            except Exception as e:
+                st.error(f"Error: {str(e)}")
 
 # Display results
 if 'analysis_results' in st.session_state: